@@ -0,0 +1,143 @@
+﻿import os
+import sys
+import click
+
+# 基準測試在單一程序內執行，不使用提取程序池、跨程序快取版本號與指標檔案
+os.environ.setdefault('EXTRACTION_POOL_SIZE', '0')
+os.environ.setdefault('READ_CACHE_GENERATION_DB', '')
+os.environ.setdefault('METRICS_DIR', '')
+
+from benchmarks.runner import DEFAULT_THRESHOLD, run_benchmarks, compare_results, load_results, save_results
+from benchmarks.suites import ENTRY_COUNTS, collect_benchmarks
+from benchmarks.startup import import_breakdown
+from benchmarks.content_storage import load_corpus, measure_codecs
+from benchmarks.load_test import run_load_test, compare_load_results
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+def _report(name, summary):
+    click.echo(f"{name:<40} median {summary['median'] * 1000:10.3f} ms  min {summary['min'] * 1000:10.3f} ms  ({summary['rounds']} rounds)")
+
+def _run(pattern, quick, min_time):
+    entry_counts = ENTRY_COUNTS[:2] if quick else ENTRY_COUNTS
+    return run_benchmarks(collect_benchmarks(entry_counts), pattern=pattern, min_time=min_time, report=_report)
+
+@click.group()
+def cli():
+    """知識庫效能基準測試（離線執行，使用記憶體儲存後端與合成資料）"""
+
+@cli.command('run')
+@click.option('--filter', 'pattern', default=None, help='只執行名稱包含此字串的項目')
+@click.option('--quick', is_flag=True, help='略過 100k 條目的資料集')
+@click.option('--min-time', default=1.0, show_default=True, help='每個項目至少量測的秒數')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='結果輸出的 JSON 路徑')
+@click.option('--save-baseline', is_flag=True, help='將結果保存為基準（預設 benchmarks/baseline.json）')
+@click.option('--baseline', type=click.Path(dir_okay=False), default=DEFAULT_BASELINE, show_default=True)
+def run_command(pattern, quick, min_time, output, save_baseline, baseline):
+    """執行基準測試"""
+    results = _run(pattern, quick, min_time)
+    if output:
+        save_results(results, output)
+        click.echo(f"結果已保存至 {output}")
+    if save_baseline:
+        save_results(results, baseline)
+        click.echo(f"基準已保存至 {baseline}")
+
+@cli.command('compare')
+@click.argument('current', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=DEFAULT_BASELINE, show_default=True)
+@click.option('--threshold', default=DEFAULT_THRESHOLD, show_default=True, help='中位數變慢超過此比例視為回歸')
+@click.option('--filter', 'pattern', default=None, help='未指定 CURRENT 時，只執行名稱包含此字串的項目')
+@click.option('--quick', is_flag=True, help='未指定 CURRENT 時，略過 100k 條目的資料集')
+@click.option('--min-time', default=1.0, show_default=True)
+def compare_command(current, baseline, threshold, pattern, quick, min_time):
+    """與基準比較（未指定 CURRENT 結果檔時先執行基準測試），有回歸時以狀態碼 1 結束"""
+    baseline_results = load_results(baseline)
+    current_results = load_results(current) if current else _run(pattern, quick, min_time)
+    
+    rows, regressed = compare_results(baseline_results, current_results, threshold)
+    if pattern:
+        rows = [row for row in rows if pattern in row[0]]
+    
+    click.echo(f"{'benchmark':<40} {'baseline':>12} {'current':>12} {'change':>9}  status")
+    for name, before, after, change, status in rows:
+        before_text = f"{before * 1000:.3f}ms" if before is not None else '-'
+        after_text = f"{after * 1000:.3f}ms" if after is not None else '-'
+        change_text = f"{change:+.1%}" if change is not None else '-'
+        click.echo(f"{name:<40} {before_text:>12} {after_text:>12} {change_text:>9}  {status}")
+    
+    if regressed:
+        click.echo(f"❌ 有項目變慢超過 {threshold:.0%}")
+        sys.exit(1)
+    click.echo('✅ 沒有效能回歸')
+
+@cli.command('startup')
+@click.option('--module', default='main', show_default=True)
+@click.option('--limit', default=15, show_default=True)
+def startup_command(module, limit):
+    """列出匯入 MODULE 時各直接相依模組的匯入時間"""
+    for name, seconds in import_breakdown(module, limit):
+        click.echo(f"{name:<40} {seconds * 1000:10.1f} ms")
+
+@cli.command('content-storage')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True))
+def content_storage_command(paths):
+    """比較各內容壓縮格式的儲存與讀取位元組數（PATHS 為真實文件或目錄；未指定時使用壓縮率偏高的合成文件）"""
+    corpus = load_corpus(paths)
+    if not corpus:
+        click.echo('沒有可提取內容的文件')
+        return
+    
+    texts = [text for _, text in corpus]
+    text_bytes = sum(len(text.encode('utf-8')) for text in texts)
+    click.echo(f"{len(texts)} 份文件，內容共 {text_bytes:,} 位元組")
+    click.echo(f"{'codec':<8} {'stored bytes':>14} {'ratio':>7} {'avg read':>11} {'compressed':>11} {'>1MiB':>6} {'encode':>10} {'decode':>10}")
+    for result in measure_codecs(texts):
+        click.echo(
+            f"{result['codec']:<8} {result['stored_bytes']:>14,} {result['stored_bytes'] / text_bytes:>7.1%} "
+            f"{result['stored_bytes'] // len(texts):>11,} {result['compressed_documents']:>11} {result['over_document_limit']:>6} "
+            f"{result['encode_seconds'] * 1000:>8.1f}ms {result['decode_seconds'] * 1000:>8.1f}ms"
+        )
+
+@cli.command('load-test')
+@click.argument('url')
+@click.option('--user', 'user_ids', multiple=True, default=('load-test-user',), show_default=True, help='代入 URL 中 {user_id} 的用戶ID（可重複指定，依序輪流使用）')
+@click.option('--concurrency', default=16, show_default=True, help='同時請求的用戶端數')
+@click.option('--duration', default=30.0, show_default=True, help='測試秒數')
+@click.option('--timeout', default=30.0, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='結果輸出的 JSON 路徑')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=None, help='與先前保存的結果比較（如同步部署的結果）')
+def load_test_command(url, user_ids, concurrency, duration, timeout, output, baseline):
+    """對執行中的伺服器進行負載測試，回報每秒請求數與延遲百分位數
+    
+    URL 例如 http://127.0.0.1:8000/api/statistics/{user_id}/dashboard。比較同步與並行讀取時，
+    先以 ASYNC_STORAGE=false 啟動 gunicorn 並以 --output 保存結果，再以 ASYNC_STORAGE=true
+    重新啟動並以 --baseline 指定該結果。
+    """
+    result = run_load_test(url, user_ids, concurrency=concurrency, duration=duration, timeout=timeout)
+    
+    def ms(value):
+        return f"{value * 1000:.1f}ms" if value is not None else '-'
+    
+    click.echo(f"{result['requests']} 個請求，成功 {result['successful']} 個，耗時 {result['duration']:.1f} 秒")
+    click.echo(f"狀態碼: {', '.join(f'{status}={count}' for status, count in result['statuses'].items())}")
+    click.echo(
+        f"{result['requests_per_second']:.1f} req/s  p50 {ms(result['p50'])}  p95 {ms(result['p95'])}  "
+        f"p99 {ms(result['p99'])}  max {ms(result['max'])}"
+    )
+    
+    if baseline:
+        click.echo(f"{'metric':<22} {'baseline':>12} {'current':>12} {'change':>9}")
+        for metric, before, after, change in compare_load_results(load_results(baseline), result):
+            format_value = (lambda value: f"{value:.1f}") if metric == 'requests_per_second' else ms
+            before_text = format_value(before) if before is not None else '-'
+            after_text = format_value(after) if after is not None else '-'
+            change_text = f"{change:+.1%}" if change is not None else '-'
+            click.echo(f"{metric:<22} {before_text:>12} {after_text:>12} {change_text:>9}")
+    
+    if output:
+        save_results(result, output)
+        click.echo(f"結果已保存至 {output}")
+
+if __name__ == '__main__':
+    cli()
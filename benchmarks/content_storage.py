@@ -0,0 +1,80 @@
+﻿import os
+import time
+from services.file_processor import file_processor
+from utils.content_codec import CODECS, resolve_codec, encode_content, decode_content, stored_size
+from benchmarks.data import make_txt, make_docx, make_pdf
+
+# Firestore 單一文件的大小上限
+FIRESTORE_DOCUMENT_LIMIT = 1048576
+
+# 未指定文件時使用的合成文件（詞彙量小，壓縮率會高於真實文件）
+SYNTHETIC_DOCUMENTS = (
+    ('synthetic-5.pdf', lambda: make_pdf(5)),
+    ('synthetic-200.pdf', lambda: make_pdf(200)),
+    ('synthetic-500.docx', lambda: make_docx(500)),
+    ('synthetic-2000.docx', lambda: make_docx(2000)),
+    ('synthetic-10k.txt', lambda: make_txt(10240)),
+    ('synthetic-1m.txt', lambda: make_txt(1048576)),
+    ('synthetic-3m.txt', lambda: make_txt(3145728))
+)
+
+
+def _walk(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+def load_corpus(paths=()):
+    """以 FileProcessor 提取文件內容，回傳 [(文件名稱, 文字)]
+    
+    paths 可包含文件或目錄（遞迴讀取支援的文件類型）；未指定時使用合成文件。
+    """
+    if paths:
+        files = [
+            (path, os.path.basename(path)) for path in _walk(paths)
+            if file_processor.validate_file_format(os.path.basename(path))[0]
+        ]
+    else:
+        files = [(build(), name) for name, build in SYNTHETIC_DOCUMENTS]
+    
+    corpus = []
+    for (_, filename), (success, _, processed_data) in zip(files, file_processor.process_files(files)):
+        if success and processed_data.get('content'):
+            corpus.append((filename, processed_data['content']))
+    return corpus
+
+
+def measure_codecs(texts):
+    """以各壓縮格式（含不壓縮）編碼 texts，回傳每種格式的儲存大小與編解碼耗時
+    
+    儲存大小即完整讀取條目時內容欄位的傳輸量；列表與統計的讀取不含內容欄位，不受壓縮影響。
+    """
+    results = []
+    for codec in ('none',) + CODECS:
+        if codec != 'none' and resolve_codec(codec) != codec:
+            continue
+        
+        start = time.perf_counter()
+        encoded = [encode_content(text, codec) for text in texts]
+        encode_seconds = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        for value, encoding in encoded:
+            decode_content(value, encoding)
+        decode_seconds = time.perf_counter() - start
+        
+        sizes = [stored_size(value) for value, _ in encoded]
+        results.append({
+            'codec': codec,
+            'stored_bytes': sum(sizes),
+            'compressed_documents': sum(1 for _, encoding in encoded if encoding),
+            'over_document_limit': sum(1 for size in sizes if size >= FIRESTORE_DOCUMENT_LIMIT),
+            'encode_seconds': encode_seconds,
+            'decode_seconds': decode_seconds
+        })
+    return results
@@ -0,0 +1,109 @@
+﻿import io
+import random
+from datetime import datetime, timedelta
+from docx import Document
+
+# 合成資料使用的詞彙（中英混合，產生 CJK 二元組與英文單字）
+CJK_WORDS = (
+    '機器學習', '深度學習', '神經網路', '資料庫', '知識管理', '自然語言', '搜尋引擎', '統計分析',
+    '雲端服務', '文件處理', '效能優化', '使用者', '演算法', '分散式', '快取', '索引'
+)
+LATIN_WORDS = (
+    'python', 'flask', 'firestore', 'index', 'query', 'cache', 'latency', 'throughput',
+    'document', 'vector', 'token', 'batch', 'shard', 'cursor', 'page', 'upload'
+)
+CATEGORIES = ('技術', '研究', '會議', '筆記', '專案', '教學', '參考', '其他')
+FILE_TYPES = ('pdf', 'docx', 'txt', 'md')
+
+def make_text(rng, word_count):
+    """產生指定詞數的中英混合文字"""
+    words = []
+    for _ in range(word_count):
+        words.append(rng.choice(CJK_WORDS) if rng.random() < 0.6 else rng.choice(LATIN_WORDS))
+    return ' '.join(words)
+
+def make_entries(count, seed=0, days=365, content_words=40, now=None):
+    """產生 count 筆合成知識條目，上傳日期平均分布於最近 days 天"""
+    rng = random.Random(seed)
+    now = now or datetime.utcnow()
+    entries = []
+    for i in range(count):
+        file_type = rng.choice(FILE_TYPES)
+        entries.append({
+            'id': f"bench{i:07d}",
+            'title': make_text(rng, 4),
+            'category': rng.choice(CATEGORIES),
+            'tags': rng.sample(CJK_WORDS, 2),
+            'content': make_text(rng, content_words),
+            'upload_date': now - timedelta(seconds=rng.randrange(days * 86400)),
+            'status': 'completed',
+            'file_info': {
+                'original_name': f"document-{i}.{file_type}",
+                'file_type': file_type,
+                'file_size': rng.randrange(1024, 2097152),
+                'content_hash': f"{rng.getrandbits(256):064x}"
+            }
+        })
+    return entries
+
+def make_txt(size_bytes, seed=0, encoding='utf-8'):
+    """產生約 size_bytes 位元組的文字文件"""
+    rng = random.Random(seed)
+    lines = []
+    size = 0
+    while size < size_bytes:
+        line = make_text(rng, 12)
+        lines.append(line)
+        size += len(line.encode(encoding)) + 1
+    return '\n'.join(lines).encode(encoding)
+
+def make_docx(paragraphs, seed=0):
+    """產生指定段落數的 Word 文件"""
+    rng = random.Random(seed)
+    document = Document()
+    for _ in range(paragraphs):
+        document.add_paragraph(make_text(rng, 30))
+    
+    output = io.BytesIO()
+    document.save(output)
+    return output.getvalue()
+
+def make_pdf(pages, lines_per_page=40, seed=0):
+    """產生指定頁數的 PDF 文件（標準 Helvetica 字型，僅含英文文字）"""
+    rng = random.Random(seed)
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        None,  # 頁面樹，頁面物件建立後再填入
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'
+    ]
+    page_numbers = []
+    for _ in range(pages):
+        lines = [b'BT /F1 10 Tf 12 TL 50 780 Td']
+        for _ in range(lines_per_page):
+            words = ' '.join(rng.choice(LATIN_WORDS) for _ in range(12))
+            lines.append(f"({words}) Tj T*".encode('ascii'))
+        lines.append(b'ET')
+        stream = b'\n'.join(lines)
+        objects.append(b'<< /Length ' + str(len(stream)).encode('ascii') + b' >>\nstream\n' + stream + b'\nendstream')
+        objects.append(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> '
+            b'/Contents ' + str(len(objects)).encode('ascii') + b' 0 R >>'
+        )
+        page_numbers.append(len(objects))
+    
+    kids = ' '.join(f"{number} 0 R" for number in page_numbers)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode('ascii')
+    
+    output = io.BytesIO()
+    output.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(output.tell())
+        output.write(f"{number} 0 obj\n".encode('ascii') + body + b'\nendobj\n')
+    
+    xref_offset = output.tell()
+    output.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode('ascii'))
+    for offset in offsets:
+        output.write(f"{offset:010d} 00000 n \n".encode('ascii'))
+    output.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode('ascii'))
+    return output.getvalue()
@@ -0,0 +1,83 @@
+﻿import time
+import threading
+import statistics
+import urllib.error
+import urllib.request
+from collections import Counter
+from itertools import cycle
+
+def _percentile(latencies, fraction):
+    """最近排名法的百分位數（latencies 已排序）"""
+    if not latencies:
+        return None
+    index = min(len(latencies) - 1, max(0, int(round(fraction * len(latencies))) - 1))
+    return latencies[index]
+
+
+def run_load_test(url_template, user_ids, concurrency=16, duration=30.0, timeout=30.0):
+    """以 concurrency 個執行緒持續請求 duration 秒，回傳吞吐量與延遲百分位數
+    
+    url_template 中的 {user_id} 依序以 user_ids 代入，分散至多個用戶以免觸發單一用戶的
+    准入限制（429 會計入狀態碼統計，但不計入吞吐量）。量測儲存後端的讀取時應以
+    READ_CACHE_TTL=0 啟動伺服器，否則重複的請求會由讀取快取回應。
+    """
+    urls = cycle([url_template.format(user_id=user_id) for user_id in user_ids])
+    urls_lock = threading.Lock()
+    latencies = []
+    statuses = Counter()
+    results_lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    
+    def worker():
+        while time.perf_counter() < deadline:
+            with urls_lock:
+                url = next(urls)
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(url, timeout=timeout) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except (urllib.error.URLError, OSError):
+                status = 'error'
+            elapsed = time.perf_counter() - start
+            with results_lock:
+                statuses[status] += 1
+                if isinstance(status, int) and status < 400:
+                    latencies.append(elapsed)
+    
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    
+    latencies.sort()
+    return {
+        'url': url_template,
+        'concurrency': concurrency,
+        'duration': elapsed,
+        'requests': sum(statuses.values()),
+        'successful': len(latencies),
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'mean': statistics.fmean(latencies) if latencies else None,
+        'p50': _percentile(latencies, 0.5),
+        'p95': _percentile(latencies, 0.95),
+        'p99': _percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else None,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)}
+    }
+
+
+def compare_load_results(baseline, current):
+    """比較兩次負載測試（如 ASYNC_STORAGE 停用與啟用），回傳 [(指標, 基準, 目前, 變化比例)]"""
+    rows = []
+    for metric in ('requests_per_second', 'p50', 'p95', 'p99'):
+        before = baseline.get(metric)
+        after = current.get(metric)
+        change = (after - before) / before if before and after is not None else None
+        rows.append((metric, before, after, change))
+    return rows
@@ -0,0 +1,298 @@
+﻿import copy
+import uuid
+from datetime import datetime, timezone
+from services.storage_backend import StorageBackend
+from services.read_cache import GenerationStore, ReadCache
+from utils.time_utils import to_utc_naive
+
+class InMemoryStorage(StorageBackend):
+    """記憶體儲存後端（基準測試用，不需 Firestore 或資料庫檔案）
+    
+    統計計數器與每日上傳彙總在寫入時以與 Firestore 後端相同的貢獻值更新，
+    讀取成本與正式後端的計數器讀取相近。讀取快取預設停用，量測的是實際計算。
+    """
+    
+    backend_name = 'memory'
+    
+    def __init__(self, cache_ttl=0):
+        super().__init__()
+        self.generations = GenerationStore()
+        self.read_cache = ReadCache(self.generations, ttl=cache_ttl, max_entries=1000, max_bytes=33554432)
+        self._profiles = {}
+        self._entries = {}
+        self._counters = {}
+        self._rollups = {}
+        self._modified = {}
+    
+    # 資料載入
+    
+    def load_entries(self, user_id, knowledge_items):
+        """直接寫入既有條目（保留 upload_date），回傳條目 ID 列表"""
+        knowledge_ids = []
+        for knowledge_data in knowledge_items:
+            knowledge_id = knowledge_data.get('id') or uuid.uuid4().hex[:20]
+            data = {key: value for key, value in knowledge_data.items() if key != 'id'}
+            self._store(user_id, knowledge_id, data)
+            knowledge_ids.append(knowledge_id)
+        
+        self.read_cache.invalidate(user_id)
+        return knowledge_ids
+    
+    def _store(self, user_id, knowledge_id, knowledge_data):
+        entries = self._entries.setdefault(user_id, {})
+        self._apply_contribution(user_id, entries.get(knowledge_id), -1)
+        entries[knowledge_id] = knowledge_data
+        self._apply_contribution(user_id, knowledge_data, 1)
+        self._modified[user_id] = datetime.now(timezone.utc).replace(tzinfo=None)
+    
+    def _apply_contribution(self, user_id, knowledge_data, sign):
+        counters = self._counters.setdefault(user_id, {})
+        for path, delta in self._statistics_contribution(knowledge_data).items():
+            counters[path] = counters.get(path, 0) + sign * delta
+        
+        day, contribution = self._rollup_contribution(knowledge_data)
+        if day is None:
+            return
+        
+        rollup = self._rollups.setdefault(user_id, {}).setdefault(day, {'date': day})
+        for path, delta in contribution.items():
+            target = rollup
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = target.get(path[-1], 0) + sign * delta
+    
+    def _project(self, knowledge_id, knowledge_data, fields):
+        """依讀取欄位投影條目（fields 為 None 時回傳完整條目）"""
+        if fields is None:
+            knowledge = copy.deepcopy(knowledge_data)
+        else:
+            knowledge = {}
+            for field in fields:
+                source = knowledge_data
+                parts = field.split('.')
+                for part in parts[:-1]:
+                    source = source.get(part) or {}
+                if parts[-1] in source:
+                    target = knowledge
+                    for part in parts[:-1]:
+                        target = target.setdefault(part, {})
+                    target[parts[-1]] = copy.deepcopy(source[parts[-1]])
+        
+        knowledge['id'] = knowledge_id
+        return knowledge
+    
+    # 用戶資料
+    
+    def get_user_profile(self, user_id):
+        """獲取用戶資料"""
+        self._record_reads(1)
+        return copy.deepcopy(self._profiles.get(user_id))
+    
+    def create_user_profile(self, user_id, profile_data):
+        """創建用戶資料"""
+        profile_data.update({
+            'created_at': datetime.now(),
+            'last_active': datetime.now()
+        })
+        self._profiles[user_id] = copy.deepcopy(profile_data)
+        return True
+    
+    def list_user_ids(self):
+        """列出所有用戶ID"""
+        return sorted(set(self._entries) | set(self._profiles))
+    
+    # 知識條目
+    
+    def create_knowledge_entry(self, user_id, knowledge_data, knowledge_id=None):
+        """創建知識條目（指定的條目 ID 已存在時不重複寫入）"""
+        if knowledge_id is None:
+            return self.create_knowledge_entries(user_id, [knowledge_data])[0]
+        
+        if knowledge_id not in self._entries.get(user_id, {}):
+            self._prepare_knowledge_data(knowledge_data)
+            self._store(user_id, knowledge_id, copy.deepcopy(knowledge_data))
+            self.read_cache.invalidate(user_id)
+        return knowledge_id
+    
+    def create_knowledge_entries(self, user_id, knowledge_items):
+        """批量創建知識條目"""
+        knowledge_ids = []
+        for knowledge_data in knowledge_items:
+            self._prepare_knowledge_data(knowledge_data)
+            knowledge_id = uuid.uuid4().hex[:20]
+            self._store(user_id, knowledge_id, copy.deepcopy(knowledge_data))
+            knowledge_ids.append(knowledge_id)
+        
+        if knowledge_ids:
+            self.read_cache.invalidate(user_id)
+        return knowledge_ids
+    
+    def get_knowledge_entry(self, user_id, knowledge_id):
+        """獲取單一知識條目"""
+        self._record_reads(1)
+        knowledge_data = self._entries.get(user_id, {}).get(knowledge_id)
+        return self._project(knowledge_id, knowledge_data, None) if knowledge_data is not None else None
+    
+    def get_knowledge_entries(self, user_id, knowledge_ids, fields=None):
+        """一次讀取多筆知識條目"""
+        entries = self._entries.get(user_id, {})
+        found = {
+            knowledge_id: self._project(knowledge_id, entries[knowledge_id], fields)
+            for knowledge_id in knowledge_ids if knowledge_id in entries
+        }
+        self._record_reads(len(found))
+        return found
+    
+    def find_knowledge_by_hash(self, user_id, content_hash):
+        """依文件內容雜湊尋找既有知識條目"""
+        self._record_reads(1)
+        for knowledge_id, knowledge_data in self._entries.get(user_id, {}).items():
+            if (knowledge_data.get('file_info') or {}).get('content_hash') == content_hash:
+                return knowledge_id
+        return None
+    
+    def stream_knowledge_entries(self, user_id, since=None, fields=None, category=None):
+        """逐筆讀取用戶所有知識條目"""
+        since = to_utc_naive(since)
+        count = 0
+        for knowledge_id, knowledge_data in list(self._entries.get(user_id, {}).items()):
+            if since is not None and (to_utc_naive(knowledge_data.get('upload_date')) or datetime.min) < since:
+                continue
+            if category and knowledge_data.get('category') != category:
+                continue
+            count += 1
+            yield self._project(knowledge_id, knowledge_data, fields)
+        self._record_reads(count)
+    
+    def update_knowledge_entry(self, user_id, knowledge_id, updates, expected_last_modified=None):
+        """更新知識條目（updates 的鍵可使用 a.b 表示巢狀欄位）"""
+        knowledge_data = self._entries.get(user_id, {}).get(knowledge_id)
+        if knowledge_data is None:
+            return False
+        if expected_last_modified is not None and knowledge_data.get('last_modified') != expected_last_modified:
+            return False
+        
+        knowledge_data = copy.deepcopy(knowledge_data)
+        updates['last_modified'] = datetime.now()
+        for key, value in updates.items():
+            target = knowledge_data
+            parts = key.split('.')
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+        
+        self._store(user_id, knowledge_id, knowledge_data)
+        self.read_cache.invalidate(user_id)
+        return True
+    
+    def delete_knowledge_entry(self, user_id, knowledge_id):
+        """刪除知識條目"""
+        knowledge_data = self._entries.get(user_id, {}).pop(knowledge_id, None)
+        self._apply_contribution(user_id, knowledge_data, -1)
+        if knowledge_data is not None:
+            self._modified[user_id] = datetime.now(timezone.utc).replace(tzinfo=None)
+        self.read_cache.invalidate(user_id)
+        return True
+    
+    def update_knowledge_entries(self, user_id, knowledge_ids, updates):
+        """批量更新知識條目"""
+        entries = self._entries.get(user_id, {})
+        updates = {**updates, 'last_modified': datetime.now()}
+        updated = {}
+        for knowledge_id in knowledge_ids:
+            if knowledge_id in entries:
+                knowledge_data = self._merge_updates(copy.deepcopy(entries[knowledge_id]), updates)
+                self._store(user_id, knowledge_id, knowledge_data)
+                updated[knowledge_id] = copy.deepcopy(knowledge_data)
+        
+        if updated:
+            self.read_cache.invalidate(user_id)
+        return updated, [knowledge_id for knowledge_id in knowledge_ids if knowledge_id not in updated]
+    
+    def delete_knowledge_entries(self, user_id, knowledge_ids):
+        """批量刪除知識條目"""
+        entries = self._entries.get(user_id, {})
+        deleted = []
+        for knowledge_id in knowledge_ids:
+            knowledge_data = entries.pop(knowledge_id, None)
+            if knowledge_data is not None:
+                self._apply_contribution(user_id, knowledge_data, -1)
+                deleted.append(knowledge_id)
+        
+        if deleted:
+            self._modified[user_id] = datetime.now(timezone.utc).replace(tzinfo=None)
+            self.read_cache.invalidate(user_id)
+        return deleted, [knowledge_id for knowledge_id in knowledge_ids if knowledge_id not in deleted]
+    
+    # 列表與統計
+    
+    def _load_knowledge_page(self, user_id, category, limit, cursor, fields):
+        """依 (upload_date, 條目 ID) 由新到舊排序後取一頁"""
+        candidates = [
+            (to_utc_naive(knowledge_data.get('upload_date')), knowledge_id)
+            for knowledge_id, knowledge_data in self._entries.get(user_id, {}).items()
+            if knowledge_data.get('upload_date') and (not category or knowledge_data.get('category') == category)
+        ]
+        if cursor:
+            position = (to_utc_naive(cursor['upload_date']), cursor['id'])
+            candidates = [candidate for candidate in candidates if candidate < position]
+        
+        candidates.sort(reverse=True)
+        entries = self._entries[user_id] if candidates else {}
+        page = [self._project(knowledge_id, entries[knowledge_id], fields) for _, knowledge_id in candidates[:limit]]
+        self._record_reads(len(page))
+        
+        next_position = None
+        if len(candidates) > limit and page:
+            next_position = {'upload_date': page[-1].get('upload_date'), 'id': page[-1]['id']}
+        return page, next_position
+    
+    def _load_user_statistics(self, user_id):
+        """由寫入時維護的計數器組合統計資料"""
+        counters = self._counters.get(user_id, {})
+        self._record_reads(1)
+        
+        category_counts = {}
+        file_type_counts = {}
+        for path, count in counters.items():
+            if path[0] == 'categories':
+                category_counts[path[1]] = count
+            elif path[0] == 'file_types':
+                file_type_counts[path[1]] = count
+        
+        return self._build_statistics(
+            counters.get(('total_knowledge',), 0), counters.get(('bytes_stored',), 0),
+            category_counts, file_type_counts
+        )
+    
+    def _load_upload_rollups(self, user_id, start_day, end_day):
+        """讀取日期區間內的每日上傳彙總"""
+        rollups = {
+            day: copy.deepcopy(rollup) for day, rollup in self._rollups.get(user_id, {}).items()
+            if start_day <= day <= end_day
+        }
+        self._record_reads(len(rollups))
+        return rollups
+    
+    def _load_user_last_modified(self, user_id):
+        """讀取寫入時記錄的最後修改時間"""
+        self._record_reads(1)
+        return self._modified.get(user_id)
+    
+    def rebuild_user_statistics(self, user_id):
+        """掃描所有條目重新計算計數器與每日彙總"""
+        entries = self._entries.get(user_id, {})
+        self._counters[user_id] = {}
+        self._rollups[user_id] = {}
+        for knowledge_data in entries.values():
+            self._apply_contribution(user_id, knowledge_data, 1)
+        self._record_reads(len(entries))
+        self.read_cache.invalidate(user_id)
+        
+        statistics = self._load_user_statistics(user_id)
+        return {
+            'total_knowledge': statistics['total_knowledge'],
+            'bytes_stored': statistics['bytes_stored'],
+            'categories': statistics['category_counts'],
+            'file_types': statistics['file_type_counts']
+        }
@@ -0,0 +1,101 @@
+﻿import gc
+import json
+import time
+import platform
+import statistics
+from datetime import datetime, timezone
+
+# 未指定時的回歸判定門檻（中位數變慢超過 20%）
+DEFAULT_THRESHOLD = 0.2
+
+def measure(func, min_rounds=5, max_rounds=200, min_time=1.0):
+    """重複執行 func 並回傳每次耗時（秒）
+    
+    先執行一次暖身，之後至少執行 min_rounds 次，累計時間未達 min_time 時
+    繼續執行，最多 max_rounds 次。量測期間停用垃圾回收以降低抖動。
+    """
+    func()
+    timings = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while len(timings) < max_rounds and (len(timings) < min_rounds or sum(timings) < min_time):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return timings
+
+def summarize(timings):
+    return {
+        'rounds': len(timings),
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0
+    }
+
+def run_benchmarks(benchmarks, pattern=None, min_time=1.0, report=None):
+    """執行基準測試，回傳可保存為 JSON 的結果"""
+    results = {}
+    for benchmark in benchmarks:
+        if pattern and pattern not in benchmark.name:
+            continue
+        
+        func = benchmark.setup()
+        results[benchmark.name] = summarize(measure(func, min_time=min_time))
+        if report:
+            report(benchmark.name, results[benchmark.name])
+    
+    return {
+        'metadata': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine()
+        },
+        'results': results
+    }
+
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """比較兩次結果的中位數，回傳 (比較列表, 是否有回歸)
+    
+    每筆比較為 (名稱, 基準中位數, 目前中位數, 變化比例, 狀態)，狀態為
+    regression、improvement、ok、new 或 missing。
+    """
+    rows = []
+    regressed = False
+    baseline_results = baseline.get('results', {})
+    current_results = current.get('results', {})
+    
+    for name in sorted(set(baseline_results) | set(current_results)):
+        if name not in current_results:
+            rows.append((name, baseline_results[name]['median'], None, None, 'missing'))
+            continue
+        if name not in baseline_results:
+            rows.append((name, None, current_results[name]['median'], None, 'new'))
+            continue
+        
+        before = baseline_results[name]['median']
+        after = current_results[name]['median']
+        change = (after - before) / before if before else 0.0
+        if change > threshold:
+            status = 'regression'
+            regressed = True
+        elif change < -threshold:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append((name, before, after, change, status))
+    
+    return rows, regressed
+
+def load_results(path):
+    with open(path, 'r', encoding='utf-8') as result_file:
+        return json.load(result_file)
+
+def save_results(results, path):
+    with open(path, 'w', encoding='utf-8') as result_file:
+        json.dump(results, result_file, indent=2, ensure_ascii=False)
@@ -0,0 +1,38 @@
+﻿import os
+import sys
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _run_import(module, extra_args=()):
+    return subprocess.run(
+        [sys.executable, *extra_args, '-c', f"import {module}"],
+        cwd=REPO_ROOT, capture_output=True, text=True, check=True
+    )
+
+def cold_start(module='main'):
+    """回傳在新的直譯器中匯入模組的函式（量測含直譯器啟動的冷啟動時間）"""
+    def run():
+        _run_import(module)
+    return run
+
+def import_breakdown(module='main', limit=15):
+    """以 -X importtime 取得匯入 module 時各直接相依模組的累計匯入時間（秒），由大到小排序"""
+    result = _run_import(module, ('-X', 'importtime'))
+    costs = []
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|', 2)
+        # 名稱前的縮排表示匯入層級；子模組列在父模組之前
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((name.strip(), int(cumulative) / 1e6))
+        elif depth == 0:
+            if name.strip() == module:
+                costs = children + [(module, int(cumulative) / 1e6)]
+            children = []
+    
+    costs.sort(key=lambda item: item[1], reverse=True)
+    return costs[:limit]
@@ -0,0 +1,267 @@
+﻿from services.file_processor import file_processor, FileProcessor
+from services.extraction_pool import ExtractionPool
+from services.knowledge_service import KnowledgeService
+from services.search_index import SearchIndexManager, UserSearchIndex, INDEXED_FIELDS
+from services.passage_index import UserPassageIndex
+from services.statistics_service import StatisticsService
+from benchmarks.data import make_entries, make_txt, make_docx, make_pdf
+from benchmarks.memory_storage import InMemoryStorage
+from benchmarks.startup import cold_start
+
+BENCHMARK_USER = 'benchmark-user'
+
+# 各文件類型的測試規模（小、中、大）
+PDF_PAGES = (5, 50, 200)
+DOCX_PARAGRAPHS = (50, 500, 2000)
+TXT_SIZES = (10240, 1048576, 8388608)
+
+# 長 PDF 分頁提取引擎各後端的測試頁數與平行程序數
+# （pdfplumber 每頁約需 0.1 秒，以較短的文件量測）
+PAGE_ENGINE_PAGES = {'pypdf2': (300, 600), 'pdfplumber': (50,)}
+PAGE_ENGINE_WORKERS = 4
+
+# 段落檢索的條目數與每筆條目的字數（每筆約切分為數個段落）
+RETRIEVAL_COUNTS = (1000, 5000)
+RETRIEVAL_CONTENT_WORDS = 400
+
+# 搜尋與統計的合成條目數
+ENTRY_COUNTS = (1000, 10000, 100000)
+
+# 建立倒排索引的量測只用於較小的資料集（大型資料集建立一次需數十秒）
+INDEX_BUILD_MAX_ENTRIES = 10000
+
+class Benchmark:
+    """單一基準測試項目：setup 準備資料並回傳待量測的函式"""
+    
+    def __init__(self, name, setup, size):
+        self.name = name
+        self.setup = setup
+        self.size = size
+
+class Dataset:
+    """載入合成條目的記憶體儲存後端、搜尋索引與服務"""
+    
+    def __init__(self, count):
+        self.count = count
+        self.entries = make_entries(count, content_words=20)
+        self.storage = InMemoryStorage()
+        self.storage.load_entries(BENCHMARK_USER, self.entries)
+        
+        self.search_index = SearchIndexManager(
+            loader=lambda user_id: self.storage.stream_knowledge_entries(user_id, fields=INDEXED_FIELDS),
+            generations=self.storage.generations
+        )
+        self.search_index.get_index(BENCHMARK_USER)
+        
+        self.knowledge_service = KnowledgeService()
+        self.knowledge_service.storage = self.storage
+        self.knowledge_service.search_index = self.search_index
+        
+        self.statistics_service = StatisticsService()
+        self.statistics_service.storage = self.storage
+
+_dataset = None
+
+def get_dataset(count):
+    """取得指定條目數的資料集（只保留最近使用的一份，避免同時佔用大量記憶體）"""
+    global _dataset
+    if _dataset is None or _dataset.count != count:
+        _dataset = None
+        _dataset = Dataset(count)
+    return _dataset
+
+def _extraction(extension, content):
+    def run():
+        success, text = file_processor.extract_text(extension, content)
+        if not success:
+            raise RuntimeError(text)
+    return run
+
+_page_pool = None
+
+def _get_page_pool():
+    """分頁提取量測共用的程序池（子程序只在第一次量測時啟動）"""
+    global _page_pool
+    if _page_pool is None:
+        _page_pool = ExtractionPool(
+            max_workers=PAGE_ENGINE_WORKERS, task_timeout=600, max_tasks_per_child=0, start_method='spawn'
+        )
+    return _page_pool
+
+def _page_extraction(pages, backend, parallel):
+    """以分頁提取引擎提取整份 PDF（不經過提取快取）"""
+    processor = FileProcessor()
+    processor.pdf_backend = backend
+    processor.extraction_pool = _get_page_pool() if parallel else ExtractionPool(0, 0, 0, 'spawn')
+    content = make_pdf(pages)
+    
+    def run():
+        success, text, _ = processor.extract_pdf_pages(content)
+        if not success:
+            raise RuntimeError(text)
+    return run
+
+def _call(func, *args, **kwargs):
+    """呼叫回傳 (success, message, data) 的服務方法，失敗時拋出例外"""
+    def run():
+        result = func(*args, **kwargs)
+        if not result[0]:
+            raise RuntimeError(result[1])
+    return run
+
+def _index_build(dataset):
+    def run():
+        index = UserSearchIndex()
+        for knowledge in dataset.entries:
+            index.add_document(knowledge['id'], knowledge)
+    return run
+
+def _search(dataset, query, category):
+    def run():
+        dataset.search_index.search(BENCHMARK_USER, query, category=category, limit=50)
+    return run
+
+def _rebuild(dataset):
+    def run():
+        if dataset.storage.rebuild_user_statistics(BENCHMARK_USER) is None:
+            raise RuntimeError('重建統計資料失敗')
+    return run
+
+def extraction_benchmarks():
+    benchmarks = []
+    for pages in PDF_PAGES:
+        benchmarks.append(Benchmark(
+            f"extract.pdf.{pages}p", lambda pages=pages: _extraction('pdf', make_pdf(pages)), pages
+        ))
+    for paragraphs in DOCX_PARAGRAPHS:
+        benchmarks.append(Benchmark(
+            f"extract.docx.{paragraphs}para", lambda paragraphs=paragraphs: _extraction('docx', make_docx(paragraphs)), paragraphs
+        ))
+    for size in TXT_SIZES:
+        benchmarks.append(Benchmark(
+            f"extract.txt.{size // 1024}k", lambda size=size: _extraction('txt', make_txt(size)), size
+        ))
+    # Big5 文件需先嘗試 UTF-8 解碼失敗後才成功
+    benchmarks.append(Benchmark(
+        'extract.txt_big5.1024k', lambda: _extraction('txt', make_txt(1048576, encoding='big5')), 1048576
+    ))
+    # GBK 文件的常用字多半也能以 Big5 解碼，逐一嘗試時要到較後面才失敗
+    benchmarks.append(Benchmark(
+        'extract.txt_gbk.1024k', lambda: _extraction('txt', make_txt(1048576, encoding='gbk')), 1048576
+    ))
+    # 結尾含一個無法解碼位元組的 UTF-8 文件
+    benchmarks.append(Benchmark(
+        'extract.txt_badtail.1024k', lambda: _extraction('txt', make_txt(1048576) + b'\xff'), 1048576
+    ))
+    return benchmarks
+
+def page_engine_benchmarks():
+    """長 PDF 分頁提取：依序提取與分派至程序池平行提取，兩種後端分別量測"""
+    benchmarks = []
+    for backend, page_counts in PAGE_ENGINE_PAGES.items():
+        for pages in page_counts:
+            for mode, parallel in (('serial', False), (f"parallel{PAGE_ENGINE_WORKERS}", True)):
+                benchmarks.append(Benchmark(
+                    f"extract.pdf_pages.{backend}.{mode}.{pages}p",
+                    lambda pages=pages, backend=backend, parallel=parallel: _page_extraction(pages, backend, parallel),
+                    pages
+                ))
+    return benchmarks
+
+def _passage_index(entries):
+    index = UserPassageIndex()
+    for knowledge in entries:
+        index.add_document(knowledge['id'], knowledge)
+    index.compact()
+    return index
+
+def _passage_index_build(count):
+    entries = make_entries(count, content_words=RETRIEVAL_CONTENT_WORDS)
+    def run():
+        _passage_index(entries)
+    return run
+
+def _retrieve(index, query, category=None):
+    def run():
+        index.retrieve(query, k=5, category=category)
+    return run
+
+def retrieval_benchmarks():
+    benchmarks = []
+    for count in RETRIEVAL_COUNTS:
+        benchmarks.append(Benchmark(
+            f"retrieve.index_build.{count}", lambda count=count: _passage_index_build(count), count
+        ))
+        index_holder = {}
+        def get_index(count=count, holder=index_holder):
+            if 'index' not in holder:
+                holder['index'] = _passage_index(make_entries(count, content_words=RETRIEVAL_CONTENT_WORDS))
+            return holder['index']
+        for label, query, category in (('term', 'firestore', None), ('multi', '機器學習 python 神經網路', None), ('category', '資料庫', '技術')):
+            benchmarks.append(Benchmark(
+                f"retrieve.{label}.{count}",
+                lambda query=query, category=category, get_index=get_index: _retrieve(get_index(), query, category),
+                count
+            ))
+    return benchmarks
+
+def search_benchmarks(count):
+    benchmarks = []
+    if count <= INDEX_BUILD_MAX_ENTRIES:
+        benchmarks.append(Benchmark(f"search.index_build.{count}", lambda: _index_build(get_dataset(count)), count))
+    
+    queries = (
+        ('term', 'firestore', None),
+        ('cjk', '神經網路', None),
+        ('multi', '機器學習 python', None),
+        ('category', '資料庫', '技術')
+    )
+    for label, query, category in queries:
+        benchmarks.append(Benchmark(
+            f"search.{label}.{count}",
+            lambda query=query, category=category: _search(get_dataset(count), query, category),
+            count
+        ))
+    
+    benchmarks.append(Benchmark(
+        f"knowledge.search_page.{count}",
+        lambda: _call(get_dataset(count).knowledge_service.search_knowledge_page, BENCHMARK_USER, '神經網路', limit=20),
+        count
+    ))
+    benchmarks.append(Benchmark(
+        f"knowledge.list_page.{count}",
+        lambda: _call(get_dataset(count).knowledge_service.get_knowledge_page, BENCHMARK_USER, category='研究', limit=50),
+        count
+    ))
+    return benchmarks
+
+def statistics_benchmarks(count):
+    return [
+        Benchmark(
+            f"statistics.dashboard.{count}",
+            lambda: _call(get_dataset(count).statistics_service.get_dashboard_statistics, BENCHMARK_USER),
+            count
+        ),
+        Benchmark(
+            f"statistics.trend_90d.{count}",
+            lambda: _call(get_dataset(count).statistics_service.get_upload_trend, BENCHMARK_USER, days=90, tz_name='Asia/Taipei'),
+            count
+        ),
+        Benchmark(
+            f"statistics.rebuild.{count}",
+            lambda: _rebuild(get_dataset(count)),
+            count
+        )
+    ]
+
+def startup_benchmarks():
+    # 在新的直譯器中匯入 main（建立 Flask app），含直譯器本身的啟動時間
+    return [Benchmark('startup.import_main', cold_start, 1)]
+
+def collect_benchmarks(entry_counts=ENTRY_COUNTS):
+    """依執行順序列出所有基準測試（同一資料集的項目相鄰，減少重複建立）"""
+    benchmarks = startup_benchmarks() + extraction_benchmarks() + page_engine_benchmarks() + retrieval_benchmarks()
+    for count in entry_counts:
+        benchmarks.extend(search_benchmarks(count))
+        benchmarks.extend(statistics_benchmarks(count))
+    return benchmarks
@@ -0,0 +1,51 @@
+﻿import click
+from services.storage import storage
+
+def register_commands(app):
+    """註冊 Flask CLI 管理指令"""
+    
+    @app.cli.command('rebuild-statistics')
+    @click.argument('user_ids', nargs=-1)
+    def rebuild_statistics(user_ids):
+        """重建用戶統計計數器（未指定用戶時處理所有用戶）"""
+        if not user_ids:
+            user_ids = storage.list_user_ids()
+        
+        for user_id in user_ids:
+            totals = storage.rebuild_user_statistics(user_id)
+            if totals is None:
+                click.echo(f"❌ {user_id}: 重建失敗")
+            else:
+                click.echo(f"✅ {user_id}: {totals['total_knowledge']} 筆知識條目")
+    
+    @app.cli.command('migrate-content')
+    @click.argument('user_ids', nargs=-1)
+    @click.option('--dry-run', is_flag=True, help='只計算改寫前後的內容大小，不寫入')
+    def migrate_content(user_ids, dry_run):
+        """將既有知識條目內容改寫為 CONTENT_COMPRESSION 設定的壓縮格式（未指定用戶時處理所有用戶）"""
+        if not storage.supports_content_compression:
+            click.echo(f"❌ {storage.backend_name} 儲存後端不壓縮條目內容")
+            return
+        
+        if not user_ids:
+            user_ids = storage.list_user_ids()
+        
+        totals = {'scanned': 0, 'rewritten': 0, 'chunked': 0, 'bytes_before': 0, 'bytes_after': 0}
+        for user_id in user_ids:
+            try:
+                report = storage.migrate_content_encoding(user_id, dry_run=dry_run)
+            except Exception as e:
+                click.echo(f"❌ {user_id}: 改寫失敗 ({e})")
+                continue
+            
+            for key, value in report.items():
+                totals[key] += value
+            click.echo(
+                f"✅ {user_id}: 改寫 {report['rewritten']}/{report['scanned']} 筆（分塊 {report['chunked']} 筆），"
+                f"內容 {report['bytes_before']:,} → {report['bytes_after']:,} 位元組"
+            )
+        
+        click.echo(
+            f"{'預估' if dry_run else '完成'}：改寫 {totals['rewritten']}/{totals['scanned']} 筆（分塊 {totals['chunked']} 筆），"
+            f"內容 {totals['bytes_before']:,} → {totals['bytes_after']:,} 位元組"
+        )
@@ -1,4 +1,5 @@
 ﻿import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -7,9 +8,129 @@ class Config:
     # Firebase 配置
     FIREBASE_CREDENTIALS = os.environ.get("FIREBASE_CREDENTIALS")
     
+    # 儲存後端配置（firestore 或 sqlite；sqlite 為嵌入式資料庫，不需外部服務）
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firestore")
+    SQLITE_DB_PATH = os.environ.get("SQLITE_DB_PATH", "knowledge.sqlite3")
+    
+    # worker 啟動後於背景預先建立儲存後端連線並載入提取函式庫（見 gunicorn.conf.py）
+    WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "false").lower() in ("1", "true", "yes")
+    # 以非同步用戶端並行執行同一請求中互不相依的讀取（如儀表板的統計計數器與每日彙總）
+    ASYNC_STORAGE = os.environ.get("ASYNC_STORAGE", "false").lower() in ("1", "true", "yes")
+    
     # 檔案上傳配置
     MAX_FILE_SIZE = int(os.environ.get("MAX_FILE_SIZE", 10485760))  # 10MB
     ALLOWED_EXTENSIONS = os.environ.get("ALLOWED_EXTENSIONS", "pdf,doc,docx,txt,md").split(',')
+    MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", 10))
+    # 單一請求的大小上限（批量上傳的所有文件加上表單欄位）
+    MAX_CONTENT_LENGTH = int(os.environ.get("MAX_CONTENT_LENGTH", MAX_FILE_SIZE * MAX_BATCH_FILES + 1048576))
+    UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 65536))  # 64KB
+    UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None
+    
+    # 文字提取程序池配置（EXTRACTION_POOL_SIZE 設為 0 時於請求執行緒中直接提取）
+    EXTRACTION_POOL_SIZE = int(os.environ.get("EXTRACTION_POOL_SIZE", 2))
+    EXTRACTION_TASK_TIMEOUT = float(os.environ.get("EXTRACTION_TASK_TIMEOUT", 60))
+    EXTRACTION_MAX_TASKS_PER_CHILD = int(os.environ.get("EXTRACTION_MAX_TASKS_PER_CHILD", 50))
+    EXTRACTION_START_METHOD = os.environ.get("EXTRACTION_START_METHOD", "spawn")
+    
+    # PDF 提取配置（後端可為 auto / pypdf2 / pdfplumber）
+    # 上傳時只同步提取前 PDF_SYNC_PAGE_LIMIT 頁或 PDF_SYNC_TIME_BUDGET 秒內的頁面，其餘頁面於背景補齊（0 表示不限制）
+    PDF_EXTRACTION_BACKEND = os.environ.get("PDF_EXTRACTION_BACKEND", "auto")
+    PDF_PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", 25))
+    PDF_SYNC_PAGE_LIMIT = int(os.environ.get("PDF_SYNC_PAGE_LIMIT", 0))
+    PDF_SYNC_TIME_BUDGET = float(os.environ.get("PDF_SYNC_TIME_BUDGET", 0))
+    
+    # 非同步上傳任務配置（任務佇列與待處理文件保存於 UPLOAD_JOB_DIR，建議與 UPLOAD_SPOOL_DIR 位於同一檔案系統）
+    UPLOAD_JOB_DIR = os.environ.get("UPLOAD_JOB_DIR", os.path.join(tempfile.gettempdir(), "line-bot-upload-jobs"))
+    UPLOAD_JOB_WORKERS = int(os.environ.get("UPLOAD_JOB_WORKERS", 2))
+    UPLOAD_JOB_POLL_INTERVAL = float(os.environ.get("UPLOAD_JOB_POLL_INTERVAL", 1.0))
+    UPLOAD_JOB_MAX_ATTEMPTS = int(os.environ.get("UPLOAD_JOB_MAX_ATTEMPTS", 3))
+    UPLOAD_JOB_RETENTION_HOURS = float(os.environ.get("UPLOAD_JOB_RETENTION_HOURS", 24))
+    # 處理中文件的心跳間隔與逾時秒數（逾時表示處理程序已結束，文件重新排入佇列）
+    UPLOAD_JOB_HEARTBEAT_INTERVAL = float(os.environ.get("UPLOAD_JOB_HEARTBEAT_INTERVAL", 10))
+    UPLOAD_JOB_HEARTBEAT_TIMEOUT = float(os.environ.get("UPLOAD_JOB_HEARTBEAT_TIMEOUT", 60))
+    
+    # 文字提取快取配置（EXTRACTION_CACHE_DIR 設為空字串時停用磁碟層）
+    EXTRACTION_CACHE_MEMORY_BYTES = int(os.environ.get("EXTRACTION_CACHE_MEMORY_BYTES", 67108864))  # 64MB
+    EXTRACTION_CACHE_DIR = os.environ.get("EXTRACTION_CACHE_DIR", os.path.join(tempfile.gettempdir(), "line-bot-extraction-cache"))
+    EXTRACTION_CACHE_DISK_BYTES = int(os.environ.get("EXTRACTION_CACHE_DISK_BYTES", 1073741824))  # 1GB
+    
+    # 用戶准入控制配置（上傳、其他寫入與讀取 API 請求分別計算額度，數值為 0 時不限制；超過額度時回傳 429）
+    # 額度保存於 ADMISSION_DB，同一主機的 worker 共用；設為空字串時僅限制單一程序
+    ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "true").lower() in ("1", "true", "yes")
+    ADMISSION_DB = os.environ.get("ADMISSION_DB", os.path.join(tempfile.gettempdir(), "line-bot-admission.sqlite3"))
+    ADMISSION_SLOT_TIMEOUT = float(os.environ.get("ADMISSION_SLOT_TIMEOUT", 600))
+    UPLOAD_REQUESTS_PER_MINUTE = float(os.environ.get("UPLOAD_REQUESTS_PER_MINUTE", 20))
+    UPLOAD_REQUEST_BURST = int(os.environ.get("UPLOAD_REQUEST_BURST", 5))
+    UPLOAD_BYTES_PER_MINUTE = int(os.environ.get("UPLOAD_BYTES_PER_MINUTE", 104857600))  # 100MB
+    UPLOAD_MAX_CONCURRENT = int(os.environ.get("UPLOAD_MAX_CONCURRENT", 2))
+    READ_REQUESTS_PER_MINUTE = float(os.environ.get("READ_REQUESTS_PER_MINUTE", 600))
+    READ_REQUEST_BURST = int(os.environ.get("READ_REQUEST_BURST", 100))
+    READ_BYTES_PER_MINUTE = int(os.environ.get("READ_BYTES_PER_MINUTE", 268435456))  # 256MB（以回應大小計算）
+    READ_MAX_CONCURRENT = int(os.environ.get("READ_MAX_CONCURRENT", 8))
+    WRITE_REQUESTS_PER_MINUTE = float(os.environ.get("WRITE_REQUESTS_PER_MINUTE", 120))
+    WRITE_REQUEST_BURST = int(os.environ.get("WRITE_REQUEST_BURST", 20))
+    WRITE_BYTES_PER_MINUTE = int(os.environ.get("WRITE_BYTES_PER_MINUTE", 67108864))  # 64MB（以請求本文大小計算）
+    WRITE_MAX_CONCURRENT = int(os.environ.get("WRITE_MAX_CONCURRENT", 4))
+    
+    # 分頁配置（列表、搜尋與分類 API 每頁筆數上限）
+    MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 100))
+    
+    # 批量更新與刪除 API 單次請求的條目數上限
+    BULK_MAX_ENTRIES = int(os.environ.get("BULK_MAX_ENTRIES", 1000))
+    
+    # 讀取快取配置（READ_CACHE_TTL 設為 0 時停用；READ_CACHE_GENERATION_DB 設為空字串時僅於單一程序內失效）
+    READ_CACHE_TTL = float(os.environ.get("READ_CACHE_TTL", 30))
+    READ_CACHE_MAX_ENTRIES = int(os.environ.get("READ_CACHE_MAX_ENTRIES", 1000))
+    READ_CACHE_MAX_BYTES = int(os.environ.get("READ_CACHE_MAX_BYTES", 33554432))  # 32MB
+    READ_CACHE_GENERATION_DB = os.environ.get("READ_CACHE_GENERATION_DB", os.path.join(tempfile.gettempdir(), "line-bot-cache-generations.sqlite3"))
+    
+    # 指標配置（METRICS_DIR 為各 worker 指標檔案的共用目錄，設為空字串時 /metrics 只輸出單一程序的指標）
+    METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "line-bot-metrics"))
+    METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+    
+    # HTTP 回應配置（超過 RESPONSE_COMPRESSION_MIN_BYTES 的 JSON 回應以 brotli 或 gzip 壓縮；brotli 需另行安裝）
+    RESPONSE_COMPRESSION = os.environ.get("RESPONSE_COMPRESSION", "true").lower() in ("1", "true", "yes")
+    RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", 1024))
+    RESPONSE_GZIP_LEVEL = int(os.environ.get("RESPONSE_GZIP_LEVEL", 6))
+    RESPONSE_BROTLI_QUALITY = int(os.environ.get("RESPONSE_BROTLI_QUALITY", 5))
+    
+    # 儀表板回應的瀏覽器快取秒數（期滿後 DASHBOARD_STALE_WHILE_REVALIDATE 秒內先顯示舊資料並於背景重新驗證）
+    DASHBOARD_CACHE_MAX_AGE = int(os.environ.get("DASHBOARD_CACHE_MAX_AGE", 10))
+    DASHBOARD_STALE_WHILE_REVALIDATE = int(os.environ.get("DASHBOARD_STALE_WHILE_REVALIDATE", 60))
+    
+    # 搜尋索引配置
+    SEARCH_INDEX_MAX_USERS = int(os.environ.get("SEARCH_INDEX_MAX_USERS", 100))
+    SEARCH_INDEX_MAX_CONTENT_CHARS = int(os.environ.get("SEARCH_INDEX_MAX_CONTENT_CHARS", 200000))
+    
+    # 段落檢索配置（段落長度與重疊以字元計）
+    PASSAGE_INDEX_MAX_USERS = int(os.environ.get("PASSAGE_INDEX_MAX_USERS", 50))
+    PASSAGE_INDEX_DELTA_LIMIT = int(os.environ.get("PASSAGE_INDEX_DELTA_LIMIT", 256))
+    PASSAGE_CHARS = int(os.environ.get("PASSAGE_CHARS", 500))
+    PASSAGE_OVERLAP = int(os.environ.get("PASSAGE_OVERLAP", 100))
+    RETRIEVE_MAX_K = int(os.environ.get("RETRIEVE_MAX_K", 20))
+    
+    # 知識內容壓縮配置（zlib / zstd / none；zstd 需另行安裝 zstandard，超過門檻且壓縮後變小的內容才壓縮）
+    CONTENT_COMPRESSION = os.environ.get("CONTENT_COMPRESSION", "zlib")
+    CONTENT_COMPRESSION_MIN_BYTES = int(os.environ.get("CONTENT_COMPRESSION_MIN_BYTES", 2048))
+    CONTENT_ZLIB_LEVEL = int(os.environ.get("CONTENT_ZLIB_LEVEL", 6))
+    CONTENT_ZSTD_LEVEL = int(os.environ.get("CONTENT_ZSTD_LEVEL", 3))
+    
+    # 大型內容分塊配置（Firestore 超過 CONTENT_CHUNK_CHARS 字元的內容分為多個區塊文件平行寫入）
+    CONTENT_CHUNK_CHARS = int(os.environ.get("CONTENT_CHUNK_CHARS", 65536))
+    CONTENT_CHUNK_WRITE_WORKERS = int(os.environ.get("CONTENT_CHUNK_WRITE_WORKERS", 4))
+    # 內容讀取 API 單次回傳的字元數上限
+    CONTENT_RANGE_MAX_CHARS = int(os.environ.get("CONTENT_RANGE_MAX_CHARS", 200000))
+    
+    # Firestore 批次寫入配置（單批最多 500 筆寫入、請求大小上限 10MiB）
+    FIRESTORE_BATCH_MAX_WRITES = int(os.environ.get("FIRESTORE_BATCH_MAX_WRITES", 500))
+    FIRESTORE_BATCH_MAX_BYTES = int(os.environ.get("FIRESTORE_BATCH_MAX_BYTES", 9437184))  # 9MB
+    FIRESTORE_WRITE_RETRIES = int(os.environ.get("FIRESTORE_WRITE_RETRIES", 3))
+    
+    # 統計計數器配置（熱點用戶可增加分片數以分散寫入）
+    STATISTICS_COUNTER_SHARDS = int(os.environ.get("STATISTICS_COUNTER_SHARDS", 1))
+    
+    # 上傳趨勢 API 最大查詢天數
+    TREND_MAX_DAYS = int(os.environ.get("TREND_MAX_DAYS", 400))
     
     # Flask 配置
     SECRET_KEY = os.environ.get("SECRET_KEY", "dev-secret-key")
@@ -0,0 +1,11 @@
+﻿from config import Config
+
+def post_fork(server, worker):
+    """worker 建立後預熱（WARMUP_ON_START 啟用時）
+    
+    Firestore 用戶端與提取函式庫都在 worker 程序內建立，--preload 時也不會
+    與 master 共用 gRPC 通道。
+    """
+    if Config.WARMUP_ON_START:
+        from services.warmup import start_warm_up
+        start_warm_up()
@@ -4,11 +4,25 @@ from config import Config
 from routes.knowledge_routes import knowledge_bp
 from routes.upload_routes import upload_bp
 from routes.statistics_routes import statistics_bp
+from commands import register_commands
+from services.read_cache import read_cache
+from utils.upload_spool import SpoolingRequest
+from utils.request_metrics import register_request_metrics
+from utils.admission_control import register_admission_control
+from utils.compression import register_response_compression
+from services.admission import admission
+from services.async_runtime import event_loop_runner
 
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
     
+    # 上傳文件直接串流至大小受限的暫存檔
+    app.request_class = SpoolingRequest
+    
+    # async def 視圖在各執行緒的常駐事件迴圈上執行，非同步用戶端可跨請求重用
+    app.async_to_sync = event_loop_runner.to_sync
+    
     # 啟用 CORS
     CORS(app, origins=[
     "https://line-bot-knowledge.vercel.app/",
@@ -21,10 +35,27 @@ def create_app():
     app.register_blueprint(upload_bp, url_prefix='/api')
     app.register_blueprint(statistics_bp, url_prefix='/api')
     
+    # 註冊管理指令
+    register_commands(app)
+    
+    # 請求計時、儲存後端用量與 /metrics 端點
+    register_request_metrics(app)
+    
+    # 用戶請求額度與並行數限制（回應大小於壓縮後計入）
+    register_admission_control(app)
+    
+    # 大型 JSON 回應壓縮
+    register_response_compression(app)
+    
     # 健康檢查端點
     @app.route('/health')
     def health_check():
-        return {"status": "healthy", "message": "LINE AI BOT API is running"}
+        return {
+            "status": "healthy",
+            "message": "LINE AI BOT API is running",
+            "read_cache": read_cache.get_stats(),
+            "admission": admission.get_stats()
+        }
     
     return app
 
@@ -1,9 +1,11 @@
 ﻿from flask import Blueprint, request, jsonify
 from services.knowledge_service import knowledge_service
+from utils.http_cache import conditional_get
 
 knowledge_bp = Blueprint('knowledge', __name__)
 
 @knowledge_bp.route('/knowledge/<user_id>', methods=['GET'])
+@conditional_get()
 def get_knowledge_list(user_id):
     """獲取知識列表 API"""
     try:
@@ -12,18 +14,30 @@ def get_knowledge_list(user_id):
         search = request.args.get('search')
         limit = int(request.args.get('limit', 50))
         
-        # 獲取知識列表
-        success, message, data = knowledge_service.get_knowledge_list(
+        # 解析回傳欄位（例如 fields=id,title）
+        fields_valid, fields_message, fields = knowledge_service.parse_fields(request.args.get('fields'))
+        if not fields_valid:
+            return jsonify({
+                'success': False,
+                'message': fields_message,
+                'data': []
+            }), 400
+        
+        # 獲取知識列表（以 cursor 取得下一頁）
+        success, message, data = knowledge_service.get_knowledge_page(
             user_id=user_id,
             category=category,
             search_term=search,
-            limit=limit
+            limit=limit,
+            fields=fields,
+            cursor=request.args.get('cursor')
         )
         
         if success:
             return jsonify({
                 'success': True,
-                'data': data,
+                'data': data['items'],
+                'next_cursor': data['next_cursor'],
                 'message': message
             })
         else:
@@ -33,6 +47,13 @@ def get_knowledge_list(user_id):
                 'data': []
             }), 500
     
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': f'無效的查詢參數: {str(e)}',
+            'data': []
+        }), 400
+    
     except Exception as e:
         return jsonify({
             'success': False,
@@ -154,11 +175,82 @@ def delete_knowledge(user_id, knowledge_id):
             'message': f'刪除知識條目時發生錯誤: {str(e)}'
         }), 500
 
+def _bulk_targets(user_id, data):
+    """由請求內容（ids 或 filter.category）或查詢參數 category 決定批量操作的條目"""
+    filters = data.get('filter')
+    category = (filters.get('category') if isinstance(filters, dict) else None) or request.args.get('category')
+    return knowledge_service.resolve_bulk_targets(user_id, knowledge_ids=data.get('ids'), category=category)
+
+def _bulk_response(action, results):
+    """批量操作的回應（各條目的結果依請求順序排列）"""
+    success_count = sum(1 for success, _, _ in results if success)
+    return jsonify({
+        'success': True,
+        'message': f'{action}完成，成功: {success_count}/{len(results)}',
+        'results': [
+            {'knowledge_id': knowledge_id, 'success': success, 'message': message}
+            for success, message, knowledge_id in results
+        ]
+    })
+
+@knowledge_bp.route('/knowledge/<user_id>/bulk', methods=['PUT'])
+def bulk_update_knowledge(user_id):
+    """批量更新知識條目 API（ids=條目 ID 列表，或 filter={"category": ...}；updates=套用到每筆條目的更新內容）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        updates = data.get('updates')
+        
+        if not isinstance(updates, dict) or not updates:
+            return jsonify({
+                'success': False,
+                'message': '請提供更新內容'
+            }), 400
+        
+        valid, message, knowledge_ids = _bulk_targets(user_id, data)
+        if not valid:
+            return jsonify({
+                'success': False,
+                'message': message
+            }), 400
+        
+        results = knowledge_service.bulk_update_knowledge(user_id, knowledge_ids, updates)
+        return _bulk_response('批量更新', results)
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'批量更新知識條目時發生錯誤: {str(e)}'
+        }), 500
+
+@knowledge_bp.route('/knowledge/<user_id>/bulk', methods=['DELETE'])
+def bulk_delete_knowledge(user_id):
+    """批量刪除知識條目 API（ids=條目 ID 列表，或 filter={"category": ...} / 查詢參數 category）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        
+        valid, message, knowledge_ids = _bulk_targets(user_id, data)
+        if not valid:
+            return jsonify({
+                'success': False,
+                'message': message
+            }), 400
+        
+        results = knowledge_service.bulk_delete_knowledge(user_id, knowledge_ids)
+        return _bulk_response('批量刪除', results)
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'批量刪除知識條目時發生錯誤: {str(e)}'
+        }), 500
+
 @knowledge_bp.route('/knowledge/<user_id>/search', methods=['GET'])
 def search_knowledge(user_id):
     """搜尋知識內容 API"""
     try:
         query = request.args.get('q')
+        category = request.args.get('category')
+        limit = int(request.args.get('limit', 50))
         
         if not query:
             return jsonify({
@@ -167,16 +259,29 @@ def search_knowledge(user_id):
                 'data': []
             }), 400
         
+        fields_valid, fields_message, fields = knowledge_service.parse_fields(request.args.get('fields'))
+        if not fields_valid:
+            return jsonify({
+                'success': False,
+                'message': fields_message,
+                'data': []
+            }), 400
+        
         # 搜尋知識
-        success, message, data = knowledge_service.search_knowledge(
+        success, message, data = knowledge_service.search_knowledge_page(
             user_id=user_id,
-            query=query
+            query=query,
+            category=category,
+            limit=limit,
+            fields=fields,
+            cursor=request.args.get('cursor')
         )
         
         if success:
             return jsonify({
                 'success': True,
-                'data': data,
+                'data': data['items'],
+                'next_cursor': data['next_cursor'],
                 'message': message
             })
         else:
@@ -186,6 +291,13 @@ def search_knowledge(user_id):
                 'data': []
             }), 500
     
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': f'無效的查詢參數: {str(e)}',
+            'data': []
+        }), 400
+    
     except Exception as e:
         return jsonify({
             'success': False,
@@ -193,7 +305,102 @@ def search_knowledge(user_id):
             'data': []
         }), 500
 
+@knowledge_bp.route('/knowledge/<user_id>/retrieve', methods=['GET'])
+def retrieve_passages(user_id):
+    """段落檢索 API（回傳與查詢最相關的 k 個段落）"""
+    try:
+        query = request.args.get('q')
+        category = request.args.get('category')
+        k = int(request.args.get('k', 5))
+        
+        if not query:
+            return jsonify({
+                'success': False,
+                'message': '請提供查詢內容',
+                'data': []
+            }), 400
+        
+        success, message, passages = knowledge_service.retrieve_passages(
+            user_id=user_id,
+            query=query,
+            k=k,
+            category=category
+        )
+        
+        if success:
+            return jsonify({
+                'success': True,
+                'data': passages,
+                'message': message
+            })
+        else:
+            return jsonify({
+                'success': False,
+                'message': message,
+                'data': []
+            }), 500
+    
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': f'無效的查詢參數: {str(e)}',
+            'data': []
+        }), 400
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'檢索段落時發生錯誤: {str(e)}',
+            'data': []
+        }), 500
+
+@knowledge_bp.route('/knowledge/<user_id>/<knowledge_id>/content', methods=['GET'])
+@conditional_get()
+def get_knowledge_content(user_id, knowledge_id):
+    """讀取知識內容 API（以 start/end 指定字元範圍，或以 page/end_page 指定頁碼範圍）"""
+    try:
+        def int_arg(name):
+            value = request.args.get(name)
+            return int(value) if value not in (None, '') else None
+        
+        data = knowledge_service.read_knowledge_content(
+            user_id=user_id,
+            knowledge_id=knowledge_id,
+            start=int_arg('start'),
+            end=int_arg('end'),
+            page=int_arg('page'),
+            end_page=int_arg('end_page')
+        )
+        
+        if data is None:
+            return jsonify({
+                'success': False,
+                'message': '知識條目不存在',
+                'data': None
+            }), 404
+        
+        return jsonify({
+            'success': True,
+            'data': data,
+            'message': '獲取內容成功'
+        })
+    
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': f'無效的查詢參數: {str(e)}',
+            'data': None
+        }), 400
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'讀取知識內容時發生錯誤: {str(e)}',
+            'data': None
+        }), 500
+
 @knowledge_bp.route('/categories', methods=['GET'])
+@conditional_get()
 def get_categories():
     """獲取所有分類 API"""
     try:
@@ -207,12 +414,17 @@ def get_categories():
             }), 400
         
         # 獲取分類列表
-        success, message, data = knowledge_service.get_all_categories(user_id)
+        success, message, data = knowledge_service.get_categories_page(
+            user_id=user_id,
+            limit=int(request.args.get('limit', 50)),
+            cursor=request.args.get('cursor')
+        )
         
         if success:
             return jsonify({
                 'success': True,
-                'data': data,
+                'data': data['items'],
+                'next_cursor': data['next_cursor'],
                 'message': message
             })
         else:
@@ -222,6 +434,13 @@ def get_categories():
                 'data': []
             }), 500
     
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': f'無效的查詢參數: {str(e)}',
+            'data': []
+        }), 400
+    
     except Exception as e:
         return jsonify({
             'success': False,
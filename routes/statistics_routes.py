@@ -1,20 +1,39 @@
 ﻿from flask import Blueprint, request, jsonify
+from config import Config
 from services.statistics_service import statistics_service
+from utils.http_cache import conditional_get
 
 statistics_bp = Blueprint('statistics', __name__)
 
+# 儀表板定期輪詢：短時間內直接使用瀏覽器快取，過期後先顯示舊資料並於背景重新驗證
+DASHBOARD_CACHE_CONTROL = (
+    f"private, max-age={Config.DASHBOARD_CACHE_MAX_AGE}, "
+    f"stale-while-revalidate={Config.DASHBOARD_STALE_WHILE_REVALIDATE}"
+)
+
+@statistics_bp.before_request
+def reset_read_count():
+    """每個請求開始時重設儲存後端讀取計數"""
+    statistics_service.storage.reset_read_count()
+
+def _response_meta():
+    """回應中附帶本次請求的儲存後端文件讀取數"""
+    return {'storage_reads': statistics_service.storage.get_read_count()}
+
 @statistics_bp.route('/statistics/<user_id>', methods=['GET'])
-def get_user_statistics(user_id):
+@conditional_get()
+async def get_user_statistics(user_id):
     """獲取用戶統計資料 API"""
     try:
-        # 獲取統計資料
-        success, message, data = statistics_service.get_user_statistics(user_id)
+        # 獲取統計資料（ASYNC_STORAGE 啟用時計數器與每日彙總並行讀取）
+        success, message, data = await statistics_service.get_user_statistics_async(user_id)
         
         if success:
             return jsonify({
                 'success': True,
                 'data': data,
-                'message': message
+                'message': message,
+                'meta': _response_meta()
             })
         else:
             return jsonify({
@@ -31,6 +50,7 @@ def get_user_statistics(user_id):
         }), 500
 
 @statistics_bp.route('/statistics/<user_id>/category', methods=['GET'])
+@conditional_get()
 def get_category_statistics(user_id):
     """獲取分類統計 API"""
     try:
@@ -41,7 +61,8 @@ def get_category_statistics(user_id):
             return jsonify({
                 'success': True,
                 'data': data,
-                'message': message
+                'message': message,
+                'meta': _response_meta()
             })
         else:
             return jsonify({
@@ -58,6 +79,7 @@ def get_category_statistics(user_id):
         }), 500
 
 @statistics_bp.route('/statistics/<user_id>/filetype', methods=['GET'])
+@conditional_get()
 def get_file_type_statistics(user_id):
     """獲取文件類型統計 API"""
     try:
@@ -68,7 +90,8 @@ def get_file_type_statistics(user_id):
             return jsonify({
                 'success': True,
                 'data': data,
-                'message': message
+                'message': message,
+                'meta': _response_meta()
             })
         else:
             return jsonify({
@@ -85,11 +108,12 @@ def get_file_type_statistics(user_id):
         }), 500
 
 @statistics_bp.route('/statistics/<user_id>/dashboard', methods=['GET'])
-def get_dashboard_data(user_id):
+@conditional_get(DASHBOARD_CACHE_CONTROL)
+async def get_dashboard_data(user_id):
     """獲取儀表板數據 API"""
     try:
-        # 獲取基本統計
-        success, message, basic_stats = statistics_service.get_user_statistics(user_id)
+        # 單次聚合取得所有儀表板統計（ASYNC_STORAGE 啟用時計數器與每日彙總並行讀取）
+        success, message, dashboard_data = await statistics_service.get_dashboard_statistics_async(user_id)
         if not success:
             return jsonify({
                 'success': False,
@@ -97,27 +121,11 @@ def get_dashboard_data(user_id):
                 'data': None
             }), 500
         
-        # 獲取分類統計
-        success, _, category_stats = statistics_service.get_category_statistics(user_id)
-        if not success:
-            category_stats = {}
-        
-        # 獲取文件類型統計
-        success, _, file_type_stats = statistics_service.get_file_type_statistics(user_id)
-        if not success:
-            file_type_stats = {}
-        
-        # 合併所有統計資料
-        dashboard_data = {
-            'basic_statistics': basic_stats,
-            'category_statistics': category_stats,
-            'file_type_statistics': file_type_stats
-        }
-        
         return jsonify({
             'success': True,
             'data': dashboard_data,
-            'message': '儀表板數據獲取成功'
+            'message': message,
+            'meta': _response_meta()
         })
     
     except Exception as e:
@@ -125,4 +133,44 @@ def get_dashboard_data(user_id):
             'success': False,
             'message': f'獲取儀表板數據時發生錯誤: {str(e)}',
             'data': None
+        }), 500
+
+@statistics_bp.route('/statistics/<user_id>/trend', methods=['GET'])
+def get_upload_trend(user_id):
+    """獲取上傳趨勢 API（days=天數，或 from=/to= 日期 YYYY-MM-DD；tz=時區，例如 Asia/Taipei）"""
+    try:
+        success, message, data = statistics_service.get_upload_trend(
+            user_id,
+            days=request.args.get('days'),
+            start_date=request.args.get('from'),
+            end_date=request.args.get('to'),
+            tz_name=request.args.get('tz')
+        )
+        
+        if success:
+            return jsonify({
+                'success': True,
+                'data': data,
+                'message': message,
+                'meta': _response_meta()
+            })
+        else:
+            return jsonify({
+                'success': False,
+                'message': message,
+                'data': None
+            }), 500
+    
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': f'無效的查詢參數: {str(e)}',
+            'data': None
+        }), 400
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'獲取上傳趨勢時發生錯誤: {str(e)}',
+            'data': None
         }), 500
\ No newline at end of file
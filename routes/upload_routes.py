@@ -1,10 +1,93 @@
 ﻿from flask import Blueprint, request, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
 from services.file_processor import file_processor
 from services.knowledge_service import knowledge_service
+from services.upload_jobs import upload_job_queue
+from utils.upload_spool import spool_upload
+from utils.admission_control import admit_request
 from config import Config
 
 upload_bp = Blueprint('upload', __name__)
 
+# multipart 表單欄位與邊界標記的預留大小
+FORM_OVERHEAD_SIZE = 65536
+
+# 以查詢參數或此標頭提供用戶ID時，准入控制在讀取上傳內容之前判定
+USER_ID_HEADER = 'X-User-Id'
+
+def request_user_id():
+    """不需解析表單即可取得的用戶ID（user_id 查詢參數或 X-User-Id 標頭）"""
+    return request.args.get('user_id') or request.headers.get(USER_ID_HEADER)
+
+def upload_user_id():
+    """上傳請求的用戶ID（查詢參數或標頭優先，其次為表單欄位）"""
+    return request_user_id() or request.form.get('user_id')
+
+@upload_bp.before_request
+def check_request_size():
+    """在讀取請求內容前拒絕超過大小限制的上傳，並進行准入判定
+    
+    用戶ID以查詢參數或 X-User-Id 標頭提供時，額度不足的上傳在讀取內容前即被拒絕；
+    只在表單欄位提供用戶ID的請求須先接收並解析完整上傳，才能在提取文字前判定。
+    """
+    content_length = request.content_length
+    if request.endpoint == 'upload.upload_file' and content_length and content_length > Config.MAX_FILE_SIZE + FORM_OVERHEAD_SIZE:
+        raise RequestEntityTooLarge()
+    
+    # 確保本程序已啟動上傳任務的背景執行緒（接續處理先前中斷的任務）
+    upload_job_queue.start()
+    
+    if request.method != 'POST':
+        return None
+    
+    early_user_id = request_user_id()
+    if early_user_id:
+        rejection = admit_request(early_user_id, 'upload', content_length or 0)
+        if rejection is not None:
+            return rejection
+    
+    # 解析表單，文件在解析時即串流寫入暫存檔
+    request.files
+    
+    form_user_id = request.form.get('user_id')
+    if early_user_id and form_user_id and form_user_id != early_user_id:
+        return jsonify({
+            'success': False,
+            'message': '用戶ID不一致'
+        }), 400
+    if form_user_id and not early_user_id:
+        return admit_request(form_user_id, 'upload', content_length or 0)
+
+@upload_bp.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(e):
+    """請求大小超過限制"""
+    max_size_mb = Config.MAX_FILE_SIZE / 1024 / 1024
+    return jsonify({
+        'success': False,
+        'message': f'文件大小超過限制 ({max_size_mb}MB)'
+    }), 413
+
+def is_async_request():
+    """是否以非同步任務處理上傳（?async=1 或表單欄位 async=true）"""
+    value = request.args.get('async') or request.form.get('async') or ''
+    return value.lower() in ('1', 'true', 'yes')
+
+def job_status_url(job_id):
+    return f"{request.script_root}/api/upload/jobs/{job_id}"
+
+def defer_remaining_pages(user_id, knowledge_id, file_content, filename, processed_data):
+    """只提取部分頁面時，將剩餘頁面排入背景任務並回傳提取狀態"""
+    extraction = processed_data['file_info']['extraction']
+    start_page, _ = processed_data['deferred_pages']
+    job_id = upload_job_queue.defer_extraction(user_id, knowledge_id, file_content, filename, start_page)
+    return {
+        'status': extraction['status'],
+        'pages_extracted': extraction['pages_extracted'],
+        'page_count': extraction['page_count'],
+        'job_id': job_id,
+        'status_url': job_status_url(job_id)
+    }
+
 @upload_bp.route('/upload', methods=['POST'])
 def upload_file():
     """文件上傳 API"""
@@ -24,10 +107,11 @@ def upload_file():
             }), 400
         
         # 獲取其他參數
-        user_id = request.form.get('user_id')
+        user_id = upload_user_id()
         category = request.form.get('category', '未分類')
         tags = request.form.get('tags', '')
         title = request.form.get('title', file.filename)
+        skip_duplicate = request.form.get('skip_duplicate', 'false').lower() in ('1', 'true', 'yes')
         
         if not user_id:
             return jsonify({
@@ -42,11 +126,43 @@ def upload_file():
                 'message': f'不支援的文件格式。支援格式: {", ".join(Config.ALLOWED_EXTENSIONS)}'
             }), 400
         
-        # 讀取文件內容
-        file_content = file.read()
+        # 取得上傳暫存檔，超過大小限制時不進行處理
+        file_content = spool_upload(file)
+        is_valid_size, size_message = file_processor.check_file_size(file_content)
+        if not is_valid_size:
+            return jsonify({
+                'success': False,
+                'message': size_message
+            }), 413
         
-        # 處理文件
-        success, message, processed_data = file_processor.process_file(file_content, file.filename)
+        # 相同文件已存在時直接回傳既有條目
+        if skip_duplicate:
+            content_hash = file_processor.compute_content_hash(file_content)
+            is_duplicate, _, existing_id = knowledge_service.find_duplicate(user_id, content_hash)
+            if is_duplicate:
+                return jsonify({
+                    'success': True,
+                    'knowledge_id': existing_id,
+                    'duplicate': True,
+                    'message': '文件已存在，未重複上傳'
+                })
+        
+        # 非同步模式：保存文件並排入任務佇列後立即回應
+        if is_async_request():
+            job_id = upload_job_queue.submit(
+                user_id,
+                [(file_content, file.filename, title, tags.split(',') if tags else [])],
+                category
+            )
+            return jsonify({
+                'success': True,
+                'job_id': job_id,
+                'status_url': job_status_url(job_id),
+                'message': '文件已排入處理佇列'
+            }), 202
+        
+        # 處理文件（長 PDF 只同步提取預算內的頁面）
+        success, message, processed_data = file_processor.process_file(file_content, file.filename, deferrable=True)
         
         if not success:
             return jsonify({
@@ -65,11 +181,16 @@ def upload_file():
         )
         
         if success:
-            return jsonify({
+            response = {
                 'success': True,
                 'knowledge_id': knowledge_id,
                 'message': '文件上傳成功'
-            })
+            }
+            if processed_data.get('deferred_pages'):
+                response['extraction'] = defer_remaining_pages(
+                    user_id, knowledge_id, file_content, file.filename, processed_data
+                )
+            return jsonify(response)
         else:
             return jsonify({
                 'success': False,
@@ -94,7 +215,7 @@ def batch_upload():
             }), 400
         
         files = request.files.getlist('files')
-        user_id = request.form.get('user_id')
+        user_id = upload_user_id()
         category = request.form.get('category', '未分類')
         
         if not user_id:
@@ -103,67 +224,119 @@ def batch_upload():
                 'message': '缺少用戶ID'
             }), 400
         
+        if len(files) > Config.MAX_BATCH_FILES:
+            return jsonify({
+                'success': False,
+                'message': f'一次最多上傳 {Config.MAX_BATCH_FILES} 個文件'
+            }), 400
+        
         results = []
         success_count = 0
         
+        # 先讀取所有通過格式檢查的文件，再一次分派至提取程序池
+        pending_files = []
         for file in files:
             if file.filename == '':
                 continue
             
+            result = {'filename': file.filename}
+            results.append(result)
+            
             try:
                 # 檢查文件格式
                 if not Config.is_allowed_file(file.filename):
-                    results.append({
-                        'filename': file.filename,
+                    result.update({
                         'success': False,
                         'message': '不支援的文件格式'
                     })
                     continue
                 
-                # 讀取文件內容
-                file_content = file.read()
-                
-                # 處理文件
-                success, message, processed_data = file_processor.process_file(file_content, file.filename)
-                
-                if not success:
-                    results.append({
-                        'filename': file.filename,
+                # 取得上傳暫存檔（大小檢查於處理時進行）
+                pending_files.append((result, spool_upload(file), file.filename))
+            
+            except Exception as e:
+                result.update({
+                    'success': False,
+                    'message': f'處理文件時發生錯誤: {str(e)}'
+                })
+        
+        # 非同步模式：未通過檢查的文件直接回報，其餘文件排入同一任務
+        if is_async_request():
+            queued_files = []
+            for result, file_content, filename in pending_files:
+                is_valid_size, size_message = file_processor.check_file_size(file_content)
+                if not is_valid_size:
+                    result.update({
                         'success': False,
-                        'message': message
+                        'message': size_message
                     })
                     continue
                 
-                # 創建知識條目
-                success, create_message, knowledge_id = knowledge_service.create_knowledge(
-                    user_id=user_id,
-                    title=file.filename,
-                    category=category,
-                    tags=[],
-                    content=processed_data['content'],
-                    file_info=processed_data['file_info']
-                )
-                
-                if success:
-                    success_count += 1
-                    results.append({
-                        'filename': file.filename,
-                        'success': True,
-                        'knowledge_id': knowledge_id,
-                        'message': '上傳成功'
-                    })
-                else:
-                    results.append({
-                        'filename': file.filename,
-                        'success': False,
-                        'message': create_message
-                    })
+                result.update({
+                    'status': 'queued'
+                })
+                queued_files.append((file_content, filename, filename, []))
             
-            except Exception as e:
-                results.append({
-                    'filename': file.filename,
+            if not queued_files:
+                return jsonify({
                     'success': False,
-                    'message': f'處理文件時發生錯誤: {str(e)}'
+                    'message': '沒有可處理的文件',
+                    'results': results
+                }), 400
+            
+            job_id = upload_job_queue.submit(user_id, queued_files, category)
+            return jsonify({
+                'success': True,
+                'job_id': job_id,
+                'status_url': job_status_url(job_id),
+                'message': f'已排入處理佇列: {len(queued_files)}/{len(results)}',
+                'results': results
+            }), 202
+        
+        # 處理文件
+        processed_results = file_processor.process_files([
+            (file_content, filename) for _, file_content, filename in pending_files
+        ], deferrable=True)
+        
+        # 收集提取成功的文件，以批次寫入一次建立知識條目
+        created_results = []
+        knowledge_items = []
+        for (result, file_content, filename), (success, message, processed_data) in zip(pending_files, processed_results):
+            if not success:
+                result.update({
+                    'success': False,
+                    'message': message
+                })
+                continue
+            
+            created_results.append((result, file_content, filename, processed_data))
+            knowledge_items.append({
+                'title': filename,
+                'category': category,
+                'tags': [],
+                'content': processed_data['content'],
+                'file_info': processed_data['file_info']
+            })
+        
+        # 創建知識條目
+        create_results = knowledge_service.create_knowledge_bulk(user_id, knowledge_items) if knowledge_items else []
+        
+        for (result, file_content, filename, processed_data), (success, create_message, knowledge_id) in zip(created_results, create_results):
+            if success:
+                success_count += 1
+                result.update({
+                    'success': True,
+                    'knowledge_id': knowledge_id,
+                    'message': '上傳成功'
+                })
+                if processed_data.get('deferred_pages'):
+                    result['extraction'] = defer_remaining_pages(
+                        user_id, knowledge_id, file_content, filename, processed_data
+                    )
+            else:
+                result.update({
+                    'success': False,
+                    'message': create_message
                 })
         
         return jsonify({
@@ -176,4 +349,29 @@ def batch_upload():
         return jsonify({
             'success': False,
             'message': f'批量上傳過程中發生錯誤: {str(e)}'
+        }), 500
+
+@upload_bp.route('/upload/jobs/<job_id>', methods=['GET'])
+def get_upload_job(job_id):
+    """查詢非同步上傳任務進度 API"""
+    try:
+        user_id = request.args.get('user_id')
+        job = upload_job_queue.get_job(job_id)
+        
+        # 指定用戶ID時僅回傳該用戶的任務
+        if job is None or (user_id and job['user_id'] != user_id):
+            return jsonify({
+                'success': False,
+                'message': '找不到上傳任務'
+            }), 404
+        
+        return jsonify({
+            'success': True,
+            'data': job
+        })
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'查詢上傳任務時發生錯誤: {str(e)}'
         }), 500
\ No newline at end of file
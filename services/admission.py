@@ -0,0 +1,293 @@
+﻿import os
+import math
+import time
+import uuid
+import sqlite3
+import threading
+from config import Config
+from services.metrics import metrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS token_buckets (
+    user_id TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, bucket)
+);
+CREATE TABLE IF NOT EXISTS admission_slots (
+    slot_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    request_class TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    acquired_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_admission_slots_user ON admission_slots (user_id, request_class);
+"""
+
+# 准入類別：upload 為文件上傳（提取文字佔用大量 CPU），write 為其他寫入請求（含批量更新與刪除），
+# read 為 GET/HEAD 請求
+REQUEST_CLASSES = ('upload', 'write', 'read')
+
+# 並行數已滿時建議的重試秒數（無法預知其他請求何時完成）
+CONCURRENCY_RETRY_AFTER = 1.0
+
+
+class AdmissionLimits:
+    """單一准入類別的額度：每分鐘請求數與位元組數（令牌桶），以及同時處理的請求數
+    
+    各數值為 0 時不限制。位元組令牌桶的容量為一分鐘的額度；單一請求超過容量時
+    只需令牌桶為滿即可通過，超出的部分由之後的請求等待補充。
+    """
+    
+    def __init__(self, requests_per_minute, request_burst, bytes_per_minute, max_concurrent):
+        self.requests_per_minute = requests_per_minute
+        self.request_burst = max(1, request_burst)
+        self.bytes_per_minute = bytes_per_minute
+        self.max_concurrent = max_concurrent
+    
+    def buckets(self, request_bytes):
+        """回傳本次請求使用的令牌桶 [(名稱, 每秒補充量, 容量, 消耗量)]"""
+        buckets = []
+        if self.requests_per_minute > 0:
+            buckets.append(('requests', self.requests_per_minute / 60.0, self.request_burst, 1))
+        if self.bytes_per_minute > 0:
+            buckets.append(('bytes', self.bytes_per_minute / 60.0, self.bytes_per_minute, request_bytes))
+        return buckets
+
+
+class AdmissionController:
+    """以用戶為單位的准入控制（令牌桶限流與並行數上限）
+    
+    每次請求在處理前取得一個並行名額並從令牌桶扣除請求數與位元組數，額度不足時
+    拒絕並回傳建議的重試秒數；名額在請求結束時釋放。指定 db_path 時狀態保存於
+    SQLite 檔案，同一主機的多個 worker 共用額度；未指定時僅限制目前程序。
+    異常結束的 worker 未釋放的名額在其程序不存在或超過 slot_timeout 秒後回收。
+    """
+    
+    def __init__(self, limits, db_path=None, slot_timeout=600, enabled=True):
+        self.limits = limits
+        self.db_path = db_path
+        self.slot_timeout = slot_timeout
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._initialized = False
+        # 未指定 db_path 時的程序內狀態：(用戶ID, 令牌桶) -> [令牌數, 更新時間]；名額 ID -> (用戶ID, 類別, 程序ID, 取得時間)
+        self._buckets = {}
+        self._slots = {}
+    
+    def _connection(self):
+        """取得目前執行緒的資料庫連線（fork 後重新建立）"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+                    setup = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+                    try:
+                        setup.execute('PRAGMA journal_mode=WAL')
+                        setup.executescript(SCHEMA)
+                    finally:
+                        setup.close()
+                    self._initialized = True
+        
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+    
+    def _is_stale(self, pid, acquired_at, now):
+        """名額的持有程序已結束或持有時間超過上限"""
+        if now - acquired_at > self.slot_timeout:
+            return True
+        if pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+        return False
+    
+    def _decide(self, limits, states, active, request_bytes, now):
+        """依目前狀態判定是否准入，回傳 (拒絕原因, 重試秒數, 更新後的令牌桶狀態)
+        
+        states 為 {令牌桶名稱: (令牌數, 更新時間)}；准入時拒絕原因為 None。
+        並行數已滿或任一令牌桶不足時都不扣除令牌。
+        """
+        if limits.max_concurrent > 0 and active >= limits.max_concurrent:
+            return 'concurrency', CONCURRENCY_RETRY_AFTER, {}
+        
+        updated = {}
+        for name, rate, capacity, cost in limits.buckets(request_bytes):
+            tokens, updated_at = states.get(name, (capacity, now))
+            tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+            required = min(cost, capacity)
+            if tokens < required:
+                return name, (required - tokens) / rate, {}
+            updated[name] = tokens - cost
+        return None, 0.0, updated
+    
+    def acquire(self, user_id, request_class, request_bytes=0):
+        """嘗試准入一個請求，回傳 (名額 ID, 拒絕原因, 重試秒數)
+        
+        准入時拒絕原因為 None，請求結束後須以 release 釋放名額；拒絕時名額 ID 為 None，
+        拒絕原因為 concurrency / requests / bytes。
+        """
+        limits = self.limits[request_class]
+        slot_id = uuid.uuid4().hex
+        now = time.time()
+        
+        if self.db_path:
+            reason, retry_after = self._acquire_shared(limits, slot_id, user_id, request_class, request_bytes, now)
+        else:
+            reason, retry_after = self._acquire_local(limits, slot_id, user_id, request_class, request_bytes, now)
+        
+        metrics.inc('admission_requests_total', {'class': request_class, 'result': reason or 'admitted'})
+        if reason is None:
+            if request_bytes:
+                metrics.inc('admission_bytes_total', {'class': request_class}, request_bytes)
+            return slot_id, None, 0.0
+        return None, reason, retry_after
+    
+    def _acquire_local(self, limits, slot_id, user_id, request_class, request_bytes, now):
+        with self._lock:
+            for stale_id in [
+                other_id for other_id, (_, _, pid, acquired_at) in self._slots.items()
+                if self._is_stale(pid, acquired_at, now)
+            ]:
+                del self._slots[stale_id]
+            active = sum(1 for slot in self._slots.values() if slot[:2] == (user_id, request_class))
+            
+            states = {
+                name: tuple(self._buckets[(user_id, f"{request_class}:{name}")])
+                for name in ('requests', 'bytes') if (user_id, f"{request_class}:{name}") in self._buckets
+            }
+            reason, retry_after, updated = self._decide(limits, states, active, request_bytes, now)
+            if reason is None:
+                for name, tokens in updated.items():
+                    self._buckets[(user_id, f"{request_class}:{name}")] = [tokens, now]
+                self._slots[slot_id] = (user_id, request_class, os.getpid(), now)
+            return reason, retry_after
+    
+    def _acquire_shared(self, limits, slot_id, user_id, request_class, request_bytes, now):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            active = 0
+            for other_id, pid, acquired_at in connection.execute(
+                'SELECT slot_id, pid, acquired_at FROM admission_slots WHERE user_id = ? AND request_class = ?',
+                (user_id, request_class)
+            ).fetchall():
+                if self._is_stale(pid, acquired_at, now):
+                    connection.execute('DELETE FROM admission_slots WHERE slot_id = ?', (other_id,))
+                else:
+                    active += 1
+            
+            prefix = f"{request_class}:"
+            states = {
+                bucket[len(prefix):]: (tokens, updated_at)
+                for bucket, tokens, updated_at in connection.execute(
+                    'SELECT bucket, tokens, updated_at FROM token_buckets WHERE user_id = ? AND bucket LIKE ?',
+                    (user_id, prefix + '%')
+                )
+            }
+            reason, retry_after, updated = self._decide(limits, states, active, request_bytes, now)
+            if reason is None:
+                connection.executemany(
+                    'INSERT INTO token_buckets (user_id, bucket, tokens, updated_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (user_id, bucket) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at',
+                    [(user_id, prefix + name, tokens, now) for name, tokens in updated.items()]
+                )
+                connection.execute(
+                    'INSERT INTO admission_slots (slot_id, user_id, request_class, pid, acquired_at) VALUES (?, ?, ?, ?, ?)',
+                    (slot_id, user_id, request_class, os.getpid(), now)
+                )
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return reason, retry_after
+    
+    def release(self, slot_id):
+        """釋放並行名額"""
+        if self.db_path:
+            self._connection().execute('DELETE FROM admission_slots WHERE slot_id = ?', (slot_id,))
+        else:
+            with self._lock:
+                self._slots.pop(slot_id, None)
+    
+    def charge(self, user_id, request_class, nbytes):
+        """在請求完成後扣除位元組令牌（如回應大小），令牌可為負數，使之後的請求等待補充"""
+        limits = self.limits[request_class]
+        if nbytes <= 0 or limits.bytes_per_minute <= 0:
+            return
+        
+        rate = limits.bytes_per_minute / 60.0
+        capacity = limits.bytes_per_minute
+        bucket = f"{request_class}:bytes"
+        now = time.time()
+        
+        if self.db_path:
+            self._connection().execute(
+                'INSERT INTO token_buckets (user_id, bucket, tokens, updated_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (user_id, bucket) DO UPDATE SET '
+                'tokens = MIN(?, tokens + MAX(0, ? - updated_at) * ?) - ?, updated_at = ?',
+                (user_id, bucket, capacity - nbytes, now, capacity, now, rate, nbytes, now)
+            )
+        else:
+            with self._lock:
+                tokens, updated_at = self._buckets.get((user_id, bucket), (capacity, now))
+                tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+                self._buckets[(user_id, bucket)] = [tokens - nbytes, now]
+        metrics.inc('admission_bytes_total', {'class': request_class}, nbytes)
+    
+    def get_stats(self):
+        """目前處理中的請求數（同主機所有 worker 合計）"""
+        stats = {'enabled': self.enabled, 'shared': bool(self.db_path)}
+        if not self.enabled:
+            return stats
+        
+        in_flight = dict.fromkeys(REQUEST_CLASSES, 0)
+        if self.db_path:
+            for request_class, count in self._connection().execute(
+                'SELECT request_class, COUNT(*) FROM admission_slots GROUP BY request_class'
+            ):
+                in_flight[request_class] = count
+        else:
+            with self._lock:
+                for _, request_class, _, _ in self._slots.values():
+                    in_flight[request_class] += 1
+        stats['in_flight'] = in_flight
+        return stats
+
+
+def retry_after_seconds(retry_after):
+    """Retry-After 標頭的秒數（無條件進位，至少 1 秒）"""
+    return max(1, math.ceil(retry_after))
+
+# 創建全域實例
+admission = AdmissionController(
+    limits={
+        'upload': AdmissionLimits(
+            Config.UPLOAD_REQUESTS_PER_MINUTE, Config.UPLOAD_REQUEST_BURST,
+            Config.UPLOAD_BYTES_PER_MINUTE, Config.UPLOAD_MAX_CONCURRENT
+        ),
+        'write': AdmissionLimits(
+            Config.WRITE_REQUESTS_PER_MINUTE, Config.WRITE_REQUEST_BURST,
+            Config.WRITE_BYTES_PER_MINUTE, Config.WRITE_MAX_CONCURRENT
+        ),
+        'read': AdmissionLimits(
+            Config.READ_REQUESTS_PER_MINUTE, Config.READ_REQUEST_BURST,
+            Config.READ_BYTES_PER_MINUTE, Config.READ_MAX_CONCURRENT
+        )
+    },
+    db_path=Config.ADMISSION_DB or None,
+    slot_timeout=Config.ADMISSION_SLOT_TIMEOUT,
+    enabled=Config.ADMISSION_CONTROL
+)
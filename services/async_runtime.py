@@ -0,0 +1,47 @@
+﻿import os
+import asyncio
+import threading
+from functools import wraps
+
+
+class EventLoopRunner:
+    """在同步程式碼（Flask 視圖、gunicorn worker 執行緒）中執行協程
+    
+    每個執行緒保有一個常駐事件迴圈，重複用於該執行緒的所有請求。Firestore
+    AsyncClient 的 gRPC 通道綁定於首次使用時的事件迴圈，不能跨迴圈共用，因此
+    非同步用戶端也以執行緒為單位建立（見 FirebaseService.async_db）。協程在
+    呼叫端執行緒中執行，執行緒區域的讀取計數照常累計；fork 後重新建立迴圈。
+    Flask 的 async def 視圖也經由 to_sync 在此迴圈上執行。
+    """
+    
+    def __init__(self):
+        self._local = threading.local()
+    
+    def loop(self):
+        """目前執行緒的事件迴圈"""
+        loop = getattr(self._local, 'loop', None)
+        if loop is None or loop.is_closed() or self._local.pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            self._local.loop = loop
+            self._local.pid = os.getpid()
+        return loop
+    
+    def run(self, coroutine):
+        """執行協程直到完成並回傳結果（不可在執行中的事件迴圈內呼叫）"""
+        return self.loop().run_until_complete(coroutine)
+    
+    def gather(self, *coroutines):
+        """並行執行多個協程，回傳與輸入順序相同的結果列表（任一拋出例外時拋出）"""
+        async def gather_all():
+            return await asyncio.gather(*coroutines)
+        return self.run(gather_all())
+    
+    def to_sync(self, func):
+        """將協程函式包裝為在目前執行緒事件迴圈上執行的同步函式（取代 Flask 的 async_to_sync）"""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.run(func(*args, **kwargs))
+        return wrapper
+
+# 創建全域實例
+event_loop_runner = EventLoopRunner()
@@ -0,0 +1,135 @@
+﻿import os
+import tempfile
+import threading
+from collections import OrderedDict
+from config import Config
+
+class ExtractionCache:
+    """以內容雜湊為鍵的文字提取快取
+    
+    記憶體層為依位元組數上限淘汰的 LRU；磁碟層將提取結果存為文字檔，
+    總大小超過上限時依最後存取時間淘汰。多個程序可共用同一磁碟目錄。
+    """
+    
+    def __init__(self, memory_max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+    
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.txt")
+    
+    def get(self, key):
+        """讀取快取，記憶體層未命中時查詢磁碟層"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry[0]
+        
+        if not self.disk_dir:
+            return None
+        
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as cache_file:
+                text = cache_file.read()
+            os.utime(path)
+        except OSError:
+            return None
+        
+        self._put_memory(key, text)
+        return text
+    
+    def put(self, key, text):
+        """寫入快取"""
+        self._put_memory(key, text)
+        if self.disk_dir:
+            self._put_disk(key, text)
+    
+    def _put_memory(self, key, text):
+        size = len(text.encode('utf-8'))
+        if size > self.memory_max_bytes:
+            return
+        
+        with self._lock:
+            old_entry = self._memory.pop(key, None)
+            if old_entry is not None:
+                self._memory_bytes -= old_entry[1]
+            
+            self._memory[key] = (text, size)
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_max_bytes:
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_size
+    
+    def _put_disk(self, key, text):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先寫入暫存檔再原子替換，避免其他程序讀到不完整內容
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as cache_file:
+                cache_file.write(text)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"寫入提取快取錯誤: {e}")
+            return
+        
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_size()
+            else:
+                self._disk_bytes += size
+            over_limit = self.disk_max_bytes and self._disk_bytes > self.disk_max_bytes
+        
+        if over_limit:
+            self._evict_disk()
+    
+    def _scan_disk(self):
+        """列出磁碟層所有快取檔 (最後存取時間, 大小, 路徑)"""
+        entries = []
+        for root, _, filenames in os.walk(self.disk_dir):
+            for filename in filenames:
+                if not filename.endswith('.txt'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+    
+    def _scan_disk_size(self):
+        return sum(size for _, size, _ in self._scan_disk())
+    
+    def _evict_disk(self):
+        """淘汰最久未使用的快取檔，直到總大小降至上限的 90%"""
+        entries = sorted(self._scan_disk())
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_max_bytes * 0.9
+        
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        
+        with self._lock:
+            self._disk_bytes = total
+
+# 創建全域實例
+extraction_cache = ExtractionCache(
+    memory_max_bytes=Config.EXTRACTION_CACHE_MEMORY_BYTES,
+    disk_dir=Config.EXTRACTION_CACHE_DIR,
+    disk_max_bytes=Config.EXTRACTION_CACHE_DISK_BYTES
+)
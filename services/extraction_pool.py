@@ -0,0 +1,161 @@
+﻿import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from config import Config
+
+def _extract_in_worker(extension, file_content):
+    """在子程序中執行文字提取（回傳含提取耗時）"""
+    from services.file_processor import file_processor
+    return file_processor.extract_text_timed(extension, file_content)
+
+def _extract_pdf_pages_in_worker(source, start, end, backend, deadline):
+    """在子程序中提取 PDF 頁面區間"""
+    from services.file_processor import file_processor
+    return file_processor.extract_pdf_pages_timed(source, start, end, backend, deadline)
+
+def _inspect_pdf_in_worker(source):
+    """在子程序中計算 PDF 頁數並選擇提取後端"""
+    from services.file_processor import file_processor
+    return file_processor.inspect_pdf_timed(source)
+
+def _decode_txt_in_worker(file_content):
+    """在子程序中偵測文字文件編碼並解碼"""
+    from services.file_processor import file_processor
+    return file_processor.decode_txt_timed(file_content)
+
+class ExtractionPool:
+    """文件文字提取程序池
+    
+    將 CPU 密集的 PDF/Word 解析移出請求執行緒，並支援單一任務逾時與
+    子程序定期回收。任務逾時時會終止所有子程序並重建程序池，避免異常
+    文件長期佔用 CPU。
+    """
+    
+    def __init__(self, max_workers, task_timeout, max_tasks_per_child, start_method):
+        self.max_workers = max_workers
+        self.task_timeout = task_timeout
+        self.max_tasks_per_child = max_tasks_per_child
+        self.start_method = start_method
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self):
+        return self.max_workers > 0
+    
+    def _get_executor(self):
+        """取得目前程序的執行器（fork 後在子程序中重新建立）"""
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                    max_tasks_per_child=self.max_tasks_per_child or None
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+    
+    def _reset(self, executor):
+        """終止執行器的所有子程序並丟棄執行器"""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            if process.is_alive():
+                process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def run_many(self, tasks):
+        """平行執行多個提取任務，回傳與 tasks 順序相同的 (success, content, 耗時秒數) 列表
+        
+        tasks 為 (extension, file_content) 列表；逾時或程序中斷時耗時為 None。
+        """
+        return self.run_calls([(_extract_in_worker, task) for task in tasks])
+    
+    def pdf_pages_call(self, source, start, end, backend, deadline=None):
+        """建立提取 PDF 頁面區間的任務（供 run_calls 使用）"""
+        return _extract_pdf_pages_in_worker, (source, start, end, backend, deadline)
+    
+    def pdf_inspect_call(self, source):
+        """建立計算 PDF 頁數與選擇後端的任務（結果內容為 (頁數, 後端)，供 run_calls 使用）"""
+        return _inspect_pdf_in_worker, (source,)
+    
+    def text_call(self, extension, file_content):
+        """建立提取整份文件的任務（供 run_calls 使用）"""
+        return _extract_in_worker, (extension, file_content)
+    
+    def txt_call(self, file_content):
+        """建立解碼文字文件的任務（結果內容為 (文字, 編碼)，供 run_calls 使用）"""
+        return _decode_txt_in_worker, (file_content,)
+    
+    def run_calls(self, calls):
+        """平行執行 (函式, 參數) 任務，回傳與 calls 順序相同的 (success, content, 耗時秒數) 列表
+        
+        程序池停用時於目前執行緒依序執行。任一任務逾時時程序池會被重建，
+        受影響而未完成的其他任務會在新程序池中重新提交一次。
+        """
+        if not self.enabled:
+            return [func(*args) for func, args in calls]
+        
+        results = [None] * len(calls)
+        attempts = [0] * len(calls)
+        pending = list(range(len(calls)))
+        
+        while pending:
+            executor = self._get_executor()
+            broken = False
+            futures = {}
+            try:
+                for index in pending:
+                    attempts[index] += 1
+                    func, args = calls[index]
+                    futures[index] = executor.submit(func, *args)
+            except (BrokenProcessPool, RuntimeError, OSError):
+                self._reset(executor)
+                broken = True
+            
+            retry = []
+            for index in pending:
+                future = futures.get(index)
+                if broken and (future is None or future.cancelled() or not future.done() or future.exception() is not None):
+                    retry.append(index)
+                    continue
+                
+                try:
+                    results[index] = future.result(timeout=self.task_timeout)
+                except FutureTimeoutError:
+                    results[index] = (False, f"文字提取逾時（超過 {self.task_timeout} 秒）", None)
+                    self._reset(executor)
+                    broken = True
+                except BrokenProcessPool:
+                    self._reset(executor)
+                    broken = True
+                    retry.append(index)
+                except Exception as e:
+                    results[index] = (False, f"文字提取失敗: {str(e)}", None)
+            
+            pending = []
+            for index in retry:
+                if attempts[index] < 2:
+                    pending.append(index)
+                else:
+                    results[index] = (False, "文字提取程序中斷，請重新上傳", None)
+        
+        return results
+    
+    def run(self, extension, file_content):
+        """執行單一提取任務"""
+        return self.run_many([(extension, file_content)])[0]
+
+# 創建全域實例
+extraction_pool = ExtractionPool(
+    max_workers=Config.EXTRACTION_POOL_SIZE,
+    task_timeout=Config.EXTRACTION_TASK_TIMEOUT,
+    max_tasks_per_child=Config.EXTRACTION_MAX_TASKS_PER_CHILD,
+    start_method=Config.EXTRACTION_START_METHOD
+)
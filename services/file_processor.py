@@ -1,12 +1,45 @@
 ﻿import os
-import PyPDF2
-from docx import Document
+import io
+import mmap
+import time
+import hashlib
+from contextlib import contextmanager
 from config import Config
+from services.extraction_pool import extraction_pool
+from services.extraction_cache import extraction_cache
+from services.metrics import metrics
+from services import pdf_extractor
+from utils.lazy_import import lazy_import
+from utils.encoding_detector import decode_text
+
+# 提取函式庫延至第一次處理該類型文件時才載入
+PyPDF2 = lazy_import('PyPDF2')
+pdfplumber = lazy_import('pdfplumber')
+docx = lazy_import('docx')
+
+# 提取邏輯變更時遞增，使舊的快取結果失效
+EXTRACTOR_VERSION = '3'
+
+# 純文字文件（提取時偵測編碼）
+TEXT_EXTENSIONS = ('txt', 'md')
+
+
+def _parse_offsets(value):
+    """解析快取中以逗號分隔的頁面起始位置"""
+    return [int(offset) for offset in value.split(',')] if value else []
 
 class FileProcessor:
     def __init__(self):
         self.max_file_size = Config.MAX_FILE_SIZE
         self.allowed_extensions = Config.ALLOWED_EXTENSIONS
+        self.pdf_backend = Config.PDF_EXTRACTION_BACKEND
+        self.extraction_pool = extraction_pool
+        self.extraction_cache = extraction_cache
+        self.metrics = metrics
+    
+    def warm_up(self):
+        """預先載入 PDF 與 Word 提取函式庫"""
+        return PyPDF2.PdfReader, pdfplumber.open, docx.Document
     
     def validate_file_format(self, filename):
         """驗證文件格式"""
@@ -22,35 +55,105 @@ class FileProcessor:
         
         return True, "格式驗證通過"
     
+    def get_file_size(self, file_content):
+        """取得文件大小（支援位元組內容、暫存檔或文件路徑）"""
+        if isinstance(file_content, (bytes, bytearray, memoryview)):
+            return len(file_content)
+        if hasattr(file_content, 'size'):
+            return file_content.size
+        return os.path.getsize(file_content)
+    
+    def _get_source(self, file_content):
+        """取得可傳遞給提取程序的來源（位元組內容或文件路徑）"""
+        if isinstance(file_content, (bytes, bytearray, memoryview)):
+            return file_content
+        return os.fspath(getattr(file_content, 'path', file_content))
+    
+    @contextmanager
+    def _open_source(self, file_content):
+        """以檔案物件開啟來源，避免將整個文件複製到記憶體"""
+        if isinstance(file_content, (bytes, bytearray, memoryview)):
+            yield io.BytesIO(file_content)
+        else:
+            with open(file_content, 'rb') as source_file:
+                yield source_file
+    
+    @contextmanager
+    def _map_source(self, file_content):
+        """以唯讀記憶體映射取得來源內容"""
+        if isinstance(file_content, (bytes, bytearray, memoryview)):
+            yield memoryview(file_content)
+            return
+        
+        with open(file_content, 'rb') as source_file:
+            if os.fstat(source_file.fileno()).st_size == 0:
+                yield b''
+                return
+            with mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+    
+    def compute_content_hash(self, file_content):
+        """計算文件內容的 SHA-256（暫存檔以區塊讀取，結果記錄於暫存檔上）"""
+        cached_hash = getattr(file_content, 'content_hash', None)
+        if cached_hash:
+            return cached_hash
+        
+        digest = hashlib.sha256()
+        if isinstance(file_content, (bytes, bytearray, memoryview)):
+            digest.update(file_content)
+        else:
+            with open(self._get_source(file_content), 'rb') as source_file:
+                for chunk in iter(lambda: source_file.read(Config.UPLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        
+        content_hash = digest.hexdigest()
+        if hasattr(file_content, 'path'):
+            file_content.content_hash = content_hash
+        return content_hash
+    
     def check_file_size(self, file_content):
         """檢查文件大小"""
-        if len(file_content) > self.max_file_size:
+        if self.get_file_size(file_content) > self.max_file_size:
             max_size_mb = self.max_file_size / 1024 / 1024
             return False, f"文件大小超過限制 ({max_size_mb}MB)"
         
         return True, "大小檢查通過"
     
     def extract_text_from_pdf(self, file_content):
-        """從 PDF 提取文字"""
+        """從 PDF 提取文字（於目前程序依序提取所有頁面，經程序池呼叫時在子程序中執行）"""
         try:
-            from io import BytesIO
-            pdf_file = BytesIO(file_content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            
-            return True, text.strip()
+            source = self._get_source(file_content)
+            page_count = pdf_extractor.count_pages(source)
+            backend = pdf_extractor.select_backend(source, self.pdf_backend, page_count)
+            texts, _ = pdf_extractor.extract_pages(source, 0, page_count, backend)
+            return True, pdf_extractor.join_pages(texts)
         except Exception as e:
             return False, f"PDF 文字提取失敗: {str(e)}"
     
+    def inspect_pdf_timed(self, source):
+        """計算 PDF 頁數並選擇提取後端，回傳 (success, (頁數, 後端), 耗時秒數)"""
+        start_time = time.perf_counter()
+        try:
+            page_count = pdf_extractor.count_pages(source)
+            backend = pdf_extractor.select_backend(source, self.pdf_backend, page_count)
+            return True, (page_count, backend), time.perf_counter() - start_time
+        except Exception as e:
+            return False, f"PDF 文字提取失敗: {str(e)}", time.perf_counter() - start_time
+    
+    def extract_pdf_pages_timed(self, source, start, end, backend, deadline=None):
+        """提取 PDF 頁面區間，回傳 (success, (各頁文字, 下一個未提取的頁碼), 耗時秒數)"""
+        start_time = time.perf_counter()
+        try:
+            result = pdf_extractor.extract_pages(source, start, end, backend, deadline)
+            return True, result, time.perf_counter() - start_time
+        except Exception as e:
+            return False, f"PDF 文字提取失敗: {str(e)}", time.perf_counter() - start_time
+    
     def extract_text_from_word(self, file_content):
         """從 Word 文檔提取文字"""
         try:
-            from io import BytesIO
-            doc_file = BytesIO(file_content)
-            doc = Document(doc_file)
+            with self._open_source(file_content) as doc_file:
+                doc = docx.Document(doc_file)
             
             text = ""
             for paragraph in doc.paragraphs:
@@ -62,23 +165,54 @@ class FileProcessor:
     
     def extract_text_from_txt(self, file_content):
         """從 TXT 文件提取文字"""
+        success, result = self.decode_txt(file_content)
+        return (True, result[0]) if success else (False, result)
+    
+    def decode_txt(self, file_content):
+        """偵測文字文件編碼並解碼，回傳 (success, (文字, 編碼) 或錯誤訊息)"""
         try:
-            # 嘗試不同編碼
-            encodings = ['utf-8', 'big5', 'gbk', 'cp1252']
-            
-            for encoding in encodings:
-                try:
-                    text = file_content.decode(encoding)
-                    return True, text.strip()
-                except UnicodeDecodeError:
-                    continue
+            with self._map_source(file_content) as buffer:
+                text, encoding = decode_text(buffer, Config.UPLOAD_CHUNK_SIZE)
             
-            return False, "無法解碼文字文件，請檢查文件編碼"
+            if text is None:
+                return False, "無法解碼文字文件，請檢查文件編碼"
+            return True, (text.strip(), encoding)
         except Exception as e:
             return False, f"TXT 文字提取失敗: {str(e)}"
     
-    def process_file(self, file_content, filename):
-        """處理文件並提取文字"""
+    def decode_txt_timed(self, file_content):
+        """解碼文字文件並回傳 (success, (文字, 編碼) 或錯誤訊息, 耗時秒數)"""
+        start = time.perf_counter()
+        success, result = self.decode_txt(file_content)
+        return success, result, time.perf_counter() - start
+    
+    def extract_text(self, extension, file_content):
+        """根據文件類型提取文字"""
+        if extension == 'pdf':
+            return self.extract_text_from_pdf(file_content)
+        elif extension in ['doc', 'docx']:
+            return self.extract_text_from_word(file_content)
+        elif extension in ['txt', 'md']:
+            return self.extract_text_from_txt(file_content)
+        else:
+            return False, f"不支援的文件格式: {extension}"
+    
+    def extract_text_timed(self, extension, file_content):
+        """提取文字並回傳 (success, content, 耗時秒數)"""
+        start = time.perf_counter()
+        success, content = self.extract_text(extension, file_content)
+        return success, content, time.perf_counter() - start
+    
+    def _record_extraction(self, extension, success, elapsed):
+        """記錄各文件類型的提取時間與失敗數"""
+        labels = {'file_type': extension}
+        if elapsed is not None:
+            self.metrics.observe('extraction_duration_seconds', elapsed, labels)
+        if not success:
+            self.metrics.inc('extraction_failures_total', labels)
+    
+    def _validate(self, file_content, filename):
+        """驗證文件格式與大小，回傳 (是否通過, 訊息, 副檔名)"""
         # 驗證文件格式
         is_valid, message = self.validate_file_format(filename)
         if not is_valid:
@@ -90,27 +224,220 @@ class FileProcessor:
             return False, size_message, None
         
         # 獲取文件擴展名
-        extension = filename.rsplit('.', 1)[1].lower()
-        
-        # 根據文件類型提取文字
-        if extension == 'pdf':
-            success, content = self.extract_text_from_pdf(file_content)
-        elif extension in ['doc', 'docx']:
-            success, content = self.extract_text_from_word(file_content)
-        elif extension in ['txt', 'md']:
-            success, content = self.extract_text_from_txt(file_content)
-        else:
-            return False, f"不支援的文件格式: {extension}", None
-        
+        return True, message, filename.rsplit('.', 1)[1].lower()
+    
+    def _build_result(self, file_content, filename, extension, success, content, content_hash, extra_info=None, deferred_pages=None):
+        """組合處理結果"""
         if success:
             file_info = {
                 'original_name': filename,
                 'file_type': extension,
-                'file_size': len(file_content)
+                'file_size': self.get_file_size(file_content),
+                'content_hash': content_hash
             }
-            return True, "文件處理成功", {'content': content, 'file_info': file_info}
+            file_info.update(extra_info or {})
+            processed_data = {'content': content, 'file_info': file_info}
+            if deferred_pages:
+                processed_data['deferred_pages'] = deferred_pages
+            return True, "文件處理成功", processed_data
         else:
             return False, content, None  # content 在這裡是錯誤訊息
+    
+    def process_file(self, file_content, filename, deferrable=False):
+        """處理文件並提取文字"""
+        return self.process_files([(file_content, filename)], deferrable)[0]
+    
+    def process_files(self, files, deferrable=False):
+        """批量處理文件，提取工作平行分派至程序池
+        
+        files 為 (file_content, filename) 列表，file_content 可為位元組內容、
+        上傳暫存檔或文件路徑；回傳與輸入順序相同的
+        (success, message, processed_data) 列表。內容相同的文件直接使用
+        提取快取，不再重新解析。PDF 依頁碼區間拆成多個任務平行提取；
+        deferrable 為 True 時只在頁數與時間預算內提取，其餘頁面記錄於
+        processed_data['deferred_pages']，由呼叫端排入背景任務。
+        """
+        results = [None] * len(files)
+        calls = []
+        task_entries = []
+        pdf_entries = []
+        
+        for index, (file_content, filename) in enumerate(files):
+            is_valid, message, extension = self._validate(file_content, filename)
+            if not is_valid:
+                results[index] = (False, message, None)
+                continue
+            
+            content_hash = self.compute_content_hash(file_content)
+            cache_key = f"{content_hash}-{extension}-v{EXTRACTOR_VERSION}"
+            cached_content = self.extraction_cache.get(cache_key)
+            if cached_content is not None:
+                extra_info = None
+                if extension in TEXT_EXTENSIONS:
+                    # 文字文件另外快取偵測到的編碼，編碼已被淘汰時重新提取
+                    cached_encoding = self.extraction_cache.get(f"{cache_key}-encoding")
+                    extra_info = {'encoding': cached_encoding} if cached_encoding else None
+                elif extension == 'pdf':
+                    # PDF 另外快取各頁起始位置，同樣在已被淘汰時重新提取
+                    cached_offsets = self.extraction_cache.get(f"{cache_key}-pages")
+                    extra_info = {'page_offsets': _parse_offsets(cached_offsets)} if cached_offsets is not None else None
+                else:
+                    extra_info = {}
+                if extra_info is not None:
+                    results[index] = self._build_result(
+                        file_content, filename, extension, True, cached_content, content_hash, extra_info
+                    )
+                    continue
+            
+            source = self._get_source(file_content)
+            if extension == 'pdf':
+                # 頁數計算與後端選擇（auto 時需抽樣解析頁面）同樣在程序池中執行，之後再切分頁碼區間
+                pdf_entries.append((index, content_hash, cache_key, source))
+                continue
+            elif extension in TEXT_EXTENSIONS:
+                plan = None
+                task_calls = [self.extraction_pool.txt_call(source)]
+            else:
+                plan = None
+                task_calls = [self.extraction_pool.text_call(extension, source)]
+            
+            task_entries.append((index, extension, content_hash, cache_key, plan, len(calls), len(task_calls)))
+            calls.extend(task_calls)
+        
+        inspections = self.extraction_pool.run_calls(
+            [self.extraction_pool.pdf_inspect_call(source) for _, _, _, source in pdf_entries]
+        ) if pdf_entries else []
+        for (index, content_hash, cache_key, source), inspection in zip(pdf_entries, inspections):
+            success, payload, elapsed = inspection
+            if not success:
+                self._record_extraction('pdf', False, elapsed)
+                results[index] = (False, payload, None)
+                continue
+            plan = self._plan_pdf(payload, elapsed, 0, deferrable)
+            task_calls = [
+                self.extraction_pool.pdf_pages_call(source, start, end, plan['backend'], plan['deadline'])
+                for start, end in plan['ranges']
+            ]
+            task_entries.append((index, 'pdf', content_hash, cache_key, plan, len(calls), len(task_calls)))
+            calls.extend(task_calls)
+        
+        extracted = self.extraction_pool.run_calls(calls)
+        
+        for index, extension, content_hash, cache_key, plan, offset, count in task_entries:
+            file_content, filename = files[index]
+            task_results = extracted[offset:offset + count]
+            
+            if plan is None:
+                success, content, elapsed = task_results[0]
+                extra_info = None
+                deferred_pages = None
+                if success and extension in TEXT_EXTENSIONS:
+                    content, encoding = content
+                    extra_info = {'encoding': encoding}
+                    self.extraction_cache.put(f"{cache_key}-encoding", encoding)
+            else:
+                success, content, elapsed, next_page, page_offsets = self._join_pdf_results(plan, task_results)
+                extra_info = {'page_offsets': page_offsets}
+                deferred_pages = None
+                if success and next_page < plan['page_count']:
+                    deferred_pages = (next_page, plan['page_count'])
+                    extra_info['extraction'] = {
+                        'status': 'partial',
+                        'backend': plan['backend'],
+                        'pages_extracted': next_page,
+                        'page_count': plan['page_count']
+                    }
+                elif success:
+                    self.extraction_cache.put(f"{cache_key}-pages", ','.join(map(str, page_offsets)))
+            
+            self._record_extraction(extension, success, elapsed)
+            # 只快取完整的提取結果
+            if success and deferred_pages is None:
+                self.extraction_cache.put(cache_key, content)
+            
+            results[index] = self._build_result(
+                file_content, filename, extension, success, content, content_hash, extra_info, deferred_pages
+            )
+        
+        return results
+    
+    def _plan_pdf(self, inspection, inspect_elapsed, start_page, deferrable):
+        """規劃 PDF 提取：依程序池回傳的 (頁數, 後端) 決定同步提取的頁數與期限，並切分平行任務的頁碼區間"""
+        page_count, backend = inspection
+        
+        sync_end = page_count
+        deadline = None
+        if deferrable:
+            if Config.PDF_SYNC_PAGE_LIMIT > 0:
+                sync_end = min(page_count, start_page + Config.PDF_SYNC_PAGE_LIMIT)
+            if Config.PDF_SYNC_TIME_BUDGET > 0:
+                deadline = time.time() + Config.PDF_SYNC_TIME_BUDGET
+        
+        parts = self.extraction_pool.max_workers if self.extraction_pool.enabled else 1
+        return {
+            'page_count': page_count,
+            'backend': backend,
+            'deadline': deadline,
+            'ranges': pdf_extractor.plan_ranges(start_page, sync_end, parts, Config.PDF_PAGES_PER_TASK),
+            'start_page': start_page,
+            'inspect_elapsed': inspect_elapsed
+        }
+    
+    def _join_pdf_results(self, plan, task_results):
+        """依頁碼順序合併各區間的提取結果（一次合併），回傳 (success, content, 耗時, 下一個未提取的頁碼, 各頁起始位置)
+        
+        任一區間因期限提前停止時，之後的頁面都視為未提取，使已提取的內容保持連續。
+        各頁起始位置為每個已提取頁面在 content 中的字元位置，供依頁碼讀取內容使用。
+        """
+        texts = []
+        next_page = plan['start_page']
+        elapsed = plan['inspect_elapsed'] or 0.0
+        for (start, end), (success, payload, task_elapsed) in zip(plan['ranges'], task_results):
+            if task_elapsed is not None:
+                elapsed += task_elapsed
+            if not success:
+                return False, payload, elapsed or None, next_page, None
+            
+            page_texts, range_next_page = payload
+            if next_page == start:
+                texts.extend(page_texts)
+                next_page = range_next_page
+        
+        page_offsets = []
+        position = 0
+        for text in texts:
+            page_offsets.append(position)
+            position += len(text) + 1
+        
+        # 只去除整份文件首尾的空白，使分段提取的內容接續後與一次提取相同
+        content = '\n'.join(texts)
+        if plan['start_page'] == 0:
+            stripped = len(content) - len(content.lstrip())
+            content = content[stripped:]
+            page_offsets = [max(0, offset - stripped) for offset in page_offsets]
+        if next_page == plan['page_count']:
+            content = content.rstrip()
+            page_offsets = [min(offset, len(content)) for offset in page_offsets]
+        return True, content, elapsed, next_page, page_offsets
+    
+    def extract_pdf_pages(self, file_content, start_page=0):
+        """提取 PDF 從 start_page 起的所有頁面（不受同步預算限制），回傳 (success, content, 各頁起始位置)
+        
+        用於延後提取的剩餘頁面；頁碼區間同樣分派至程序池平行處理，結果不寫入快取。
+        """
+        source = self._get_source(file_content)
+        success, payload, elapsed = self.extraction_pool.run_calls([self.extraction_pool.pdf_inspect_call(source)])[0]
+        if not success:
+            return False, payload, None
+        plan = self._plan_pdf(payload, elapsed, start_page, False)
+        
+        calls = [
+            self.extraction_pool.pdf_pages_call(source, start, end, plan['backend'])
+            for start, end in plan['ranges']
+        ]
+        success, content, elapsed, _, page_offsets = self._join_pdf_results(plan, self.extraction_pool.run_calls(calls))
+        self._record_extraction('pdf', success, elapsed)
+        return success, content, page_offsets
 
 # 創建全域實例
 file_processor = FileProcessor()
\ No newline at end of file
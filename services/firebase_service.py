@@ -1,24 +1,110 @@
 ﻿import os
 import json
-import firebase_admin
-from firebase_admin import credentials, firestore
-from datetime import datetime
+import time
+import uuid
+import random
+import threading
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from config import Config
+from services.storage_backend import StorageBackend
+from utils.lazy_import import lazy_import
+from utils.time_utils import to_utc_naive
+from utils.content_codec import ENCODING_FIELD, encode_content, decode_content, resolve_codec, stored_size
 
-class FirebaseService:
+# firebase-admin 與 gRPC 載入耗時，延至第一次存取 Firestore 時才匯入
+firebase_admin = lazy_import('firebase_admin')
+credentials = lazy_import('firebase_admin.credentials')
+firestore = lazy_import('firebase_admin.firestore')
+google_exceptions = lazy_import('google.api_core.exceptions')
+
+def _retryable_errors():
+    """可重試的暫時性錯誤"""
+    return (
+        google_exceptions.Aborted,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable
+    )
+
+# 重建統計計數器時讀取的欄位
+STATISTICS_FIELDS = ('category', 'upload_date', 'file_info.file_type', 'file_info.file_size')
+# 重建統計時每次批次讀取內容的條目數
+STATISTICS_CONTENT_READ_SIZE = 100
+# 批次寫入時保留給統計計數器與每日彙總（跨日時最多 2 天）的寫入數
+STATISTICS_RESERVED_WRITES = 3
+# 批量更新與刪除的條目可能分屬不同上傳日期，每筆條目最多另需一筆每日彙總寫入
+BULK_WRITES_PER_ENTRY = 2
+# 大型內容的區塊子集合，與條目中記錄區塊版本、數量與起始位置的欄位
+CHUNKS_COLLECTION = 'content_chunks'
+# 統計重建租約的有效秒數（與 read_time 可讀取的保留期限相同，逾時的重建無法完成讀取）
+STATISTICS_REBUILD_LEASE_SECONDS = 3600
+MANIFEST_FIELD = 'content_manifest'
+
+class FirebaseService(StorageBackend):
+    """Firestore 儲存後端"""
+    
+    backend_name = 'firestore'
+    supports_content_compression = True
+    supports_async_reads = True
+    
     def __init__(self):
-        self._init_firebase()
-        self.db = firestore.client()
+        super().__init__()
+        self.statistics_shards = max(1, Config.STATISTICS_COUNTER_SHARDS)
+        self._db = None
+        self._db_pid = None
+        self._db_lock = threading.Lock()
+        self._async_local = threading.local()
+    
+    @property
+    def db(self):
+        """目前程序的 Firestore 用戶端
+        
+        首次使用時才連線；gRPC 通道不能跨 fork 共用，因此每個程序
+        （如 gunicorn --preload 的各 worker）各自建立用戶端。
+        """
+        if self._db is None or self._db_pid != os.getpid():
+            with self._db_lock:
+                if self._db is None or self._db_pid != os.getpid():
+                    app = self._init_firebase()
+                    self._db = firestore.Client(credentials=app.credential.get_credential(), project=app.project_id)
+                    self._db_pid = os.getpid()
+        return self._db
+    
+    @property
+    def async_db(self):
+        """目前執行緒的 Firestore 非同步用戶端
+        
+        gRPC 非同步通道綁定於首次使用時的事件迴圈，而 event_loop_runner 每個
+        執行緒使用各自的事件迴圈，因此用戶端以執行緒為單位建立（fork 後重新建立）。
+        """
+        client = getattr(self._async_local, 'client', None)
+        if client is None or self._async_local.pid != os.getpid():
+            with self._db_lock:
+                app = self._init_firebase()
+            client = firestore.AsyncClient(credentials=app.credential.get_credential(), project=app.project_id)
+            self._async_local.client = client
+            self._async_local.pid = os.getpid()
+        return client
     
     def _init_firebase(self):
-        """初始化 Firebase"""
+        """初始化 Firebase，回傳 Firebase App"""
+        if firebase_admin._apps:
+            return firebase_admin.get_app()
+        
         firebase_key_json = os.environ.get("FIREBASE_CREDENTIALS")
         if not firebase_key_json:
             raise ValueError("❌ 環境變數 'FIREBASE_CREDENTIALS' 沒有設定")
         
-        cred_dict = json.loads(firebase_key_json)
-        if not firebase_admin._apps:
-            cred = credentials.Certificate(cred_dict)
-            firebase_admin.initialize_app(cred)
+        cred = credentials.Certificate(json.loads(firebase_key_json))
+        return firebase_admin.initialize_app(cred)
+    
+    def warm_up(self):
+        """預先建立 Firestore 用戶端"""
+        return self.db
     
     def get_user_profile(self, user_id):
         """獲取用戶資料"""
@@ -26,6 +112,7 @@ class FirebaseService:
             user_ref = self.db.collection('line_users').document(user_id)
             profile_ref = user_ref.collection('profile').document('info')
             profile_doc = profile_ref.get()
+            self._record_reads(1)
             
             if profile_doc.exists:
                 return profile_doc.to_dict()
@@ -46,62 +133,424 @@ class FirebaseService:
             })
             
             profile_ref.set(profile_data)
+            self._record_writes(1)
             return True
         except Exception as e:
             print(f"創建用戶資料錯誤: {e}")
             return False
     
-    def create_knowledge_entry(self, user_id, knowledge_data):
-        """創建知識條目"""
+    def list_user_ids(self):
+        """列出所有用戶ID"""
+        return [user_ref.id for user_ref in self.db.collection('line_users').list_documents()]
+    
+    def create_knowledge_entry(self, user_id, knowledge_data, knowledge_id=None):
+        """創建知識條目（內容超過 CONTENT_CHUNK_CHARS 時先平行寫入區塊）
+        
+        條目以 create 寫入；指定的條目 ID 已存在時不重複寫入，也不重複累加統計計數器。
+        """
+        manifest = None
         try:
             user_ref = self.db.collection('line_users').document(user_id)
-            knowledge_ref = user_ref.collection('knowledge_base').document()
-            
-            knowledge_data.update({
-                'upload_date': datetime.now(),
-                'last_modified': datetime.now(),
-                'status': 'completed'
-            })
+            knowledge_collection = user_ref.collection('knowledge_base')
+            knowledge_ref = knowledge_collection.document(knowledge_id) if knowledge_id else knowledge_collection.document()
+            self._prepare_knowledge_data(knowledge_data)
+            if self._needs_chunking(knowledge_data.get('content')):
+                manifest = self._write_content_chunks(knowledge_ref, knowledge_data['content'])
             
-            knowledge_ref.set(knowledge_data)
+            # 知識條目與統計計數器在同一批次中原子寫入
+            batch = self.db.batch()
+            batch.create(knowledge_ref, self._encode_content_fields(knowledge_data, manifest=manifest))
+            writes = 1 + self._apply_statistics_delta(batch, user_id, None, knowledge_data)
+            try:
+                batch.commit()
+            except google_exceptions.AlreadyExists:
+                # 條目先前已建立（例如上傳任務在建立後、完成前中斷而重新排入）
+                if manifest is not None:
+                    self._delete_content_chunks(knowledge_ref, manifest)
+                return knowledge_ref.id
+            self._record_writes(writes)
+            self.read_cache.invalidate(user_id)
             return knowledge_ref.id
         except Exception as e:
             print(f"創建知識條目錯誤: {e}")
+            if manifest is not None:
+                self._delete_content_chunks(knowledge_ref, manifest)
+            return None
+    
+    def create_knowledge_entries(self, user_id, knowledge_items):
+        """批量創建知識條目，回傳與輸入順序相同的條目 ID 列表（失敗為 None）
+        
+        條目依 Firestore 批次寫入上限自動分批，每批連同統計計數器增量一次
+        提交；提交失敗時重試，仍失敗則將該批拆半重新提交，以找出個別失敗的條目。
+        條目以 create 寫入，結果不明的提交若其實已套用，重試時整批因條目已存在而
+        不會重複套用計數器增量。需要分塊的內容先寫入區塊，條目本身只保存區塊清單。
+        """
+        user_ref = self.db.collection('line_users').document(user_id)
+        knowledge_collection = user_ref.collection('knowledge_base')
+        
+        # 預先產生文件 ID，使重試不會產生重複條目（也作為批次是否已套用的判斷依據）
+        entries = []
+        manifests = {}
+        for knowledge_data in knowledge_items:
+            self._prepare_knowledge_data(knowledge_data)
+            knowledge_ref = knowledge_collection.document()
+            if self._needs_chunking(knowledge_data.get('content')):
+                try:
+                    manifests[knowledge_ref.id] = self._write_content_chunks(knowledge_ref, knowledge_data['content'])
+                except Exception as e:
+                    print(f"寫入內容區塊錯誤: {e}")
+                    entries.append((None, knowledge_data))
+                    continue
+            entries.append((knowledge_ref, knowledge_data))
+        
+        def build_batch(batch, chunk):
+            for knowledge_ref, knowledge_data in chunk:
+                batch.create(knowledge_ref, self._encode_content_fields(knowledge_data, manifest=manifests.get(knowledge_ref.id)))
+            return len(chunk) + self._apply_statistics_changes(
+                batch, user_id, [(None, knowledge_data) for _, knowledge_data in chunk]
+            )
+        
+        def size_of(entry):
+            return 0 if entry[0].id in manifests else self._estimate_size(entry[1])
+        
+        pending = [entry for entry in entries if entry[0] is not None]
+        committed = {
+            knowledge_ref.id
+            for (knowledge_ref, _), success in zip(pending, self._commit_in_batches(pending, build_batch, size_of))
+            if success
+        }
+        if committed:
+            self.read_cache.invalidate(user_id)
+        
+        # 條目寫入失敗時刪除已寫入的區塊
+        for knowledge_ref, _ in pending:
+            if knowledge_ref.id in manifests and knowledge_ref.id not in committed:
+                self._delete_content_chunks(knowledge_ref, manifests[knowledge_ref.id])
+        
+        return [
+            knowledge_ref.id if knowledge_ref is not None and knowledge_ref.id in committed else None
+            for knowledge_ref, _ in entries
+        ]
+    
+    def _estimate_size(self, data):
+        """粗估文件寫入大小（位元組）"""
+        content = data.get('content') or ''
+        return len(content.encode('utf-8')) if isinstance(content, str) else len(content)
+    
+    def _split_chunks(self, items, size_of, writes_per_item=1):
+        """依每批寫入筆數與位元組上限切分（保留寫入數給統計計數器與每日彙總）"""
+        max_items = max(1, (Config.FIRESTORE_BATCH_MAX_WRITES - STATISTICS_RESERVED_WRITES) // writes_per_item)
+        chunks = []
+        chunk = []
+        chunk_bytes = 0
+        for item in items:
+            item_bytes = size_of(item) + 1024
+            if chunk and (len(chunk) >= max_items or chunk_bytes + item_bytes > Config.FIRESTORE_BATCH_MAX_BYTES):
+                chunks.append(chunk)
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(item)
+            chunk_bytes += item_bytes
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+    
+    def _commit_in_batches(self, items, build_batch, size_of):
+        """分批提交寫入，回傳與 items 順序相同的成功與否列表
+        
+        逾時、內部錯誤或服務無法使用時，提交可能其實已套用，而重試與拆半重新提交
+        會再次套用批次中的計數器增量。build_batch 須以 create 寫入預先產生 ID 的文件：
+        已套用的批次重試時因文件已存在（AlreadyExists）整批失敗，視為已提交。
+        """
+        results = [False] * len(items)
+        pending = self._split_chunks(list(range(len(items))), lambda index: size_of(items[index]))
+        
+        while pending:
+            chunk = pending.pop(0)
+            try:
+                self._record_writes(self._commit_batch(lambda batch: build_batch(batch, [items[index] for index in chunk])))
+                committed = True
+            except google_exceptions.AlreadyExists:
+                # 預先產生的文件 ID 不會與其他條目衝突，已存在表示先前結果不明的提交已套用
+                committed = True
+            except Exception as e:
+                print(f"批次寫入錯誤: {e}")
+                committed = False
+            
+            if committed:
+                for index in chunk:
+                    results[index] = True
+            elif len(chunk) > 1:
+                # 拆半重新提交，隔離造成失敗的條目
+                middle = len(chunk) // 2
+                pending[:0] = [chunk[:middle], chunk[middle:]]
+        
+        return results
+    
+    def _commit_batch(self, build_batch):
+        """建立並提交批次寫入，暫時性錯誤以指數退避重試，回傳寫入數（仍失敗時拋出例外）
+        
+        逾時等錯誤時提交可能已套用，批次內容須可重複套用（set、delete，或見 _commit_in_batches）。
+        不記錄寫入用量（用量以執行緒區分），可在其他執行緒中呼叫。
+        """
+        for attempt in range(Config.FIRESTORE_WRITE_RETRIES + 1):
+            try:
+                batch = self.db.batch()
+                writes = build_batch(batch)
+                batch.commit()
+                return writes
+            except _retryable_errors() as e:
+                print(f"批次寫入錯誤 (第 {attempt + 1} 次): {e}")
+                if attempt >= Config.FIRESTORE_WRITE_RETRIES:
+                    raise
+                time.sleep(min(0.2 * (2 ** attempt), 2.0))
+    
+    # 大型內容分塊
+    
+    def _needs_chunking(self, content):
+        """內容是否超過單一文件保存的字元數上限"""
+        return isinstance(content, str) and len(content) > Config.CONTENT_CHUNK_CHARS
+    
+    def _chunk_ref(self, knowledge_ref, version, index):
+        """區塊文件（ID 以版本為前綴，改寫內容時新舊區塊互不覆蓋）"""
+        return knowledge_ref.collection(CHUNKS_COLLECTION).document(f"{version}-{index:05d}")
+    
+    def _write_content_chunks(self, knowledge_ref, content):
+        """將內容切分為有序的區塊文件並平行寫入，回傳區塊清單（失敗時刪除已寫入的區塊並拋出例外）
+        
+        區塊清單記錄版本、區塊數、內容字元數與位元組數，以及各區塊的起始位置，
+        使依範圍讀取時只需讀取涵蓋的區塊。各區塊依設定個別壓縮。
+        """
+        size = Config.CONTENT_CHUNK_CHARS
+        offsets = list(range(0, len(content), size))
+        manifest = {
+            'version': uuid.uuid4().hex[:12],
+            'chunks': len(offsets),
+            'length': len(content),
+            'bytes': len(content.encode('utf-8')),
+            'offsets': offsets
+        }
+        
+        writes = []
+        for index, start in enumerate(offsets):
+            value, encoding = encode_content(content[start:start + size])
+            chunk_data = {'index': index, 'start': start, 'content': value}
+            if encoding:
+                chunk_data[ENCODING_FIELD] = encoding
+            writes.append((self._chunk_ref(knowledge_ref, manifest['version'], index), chunk_data))
+        
+        def build_batch(batch, chunk):
+            for chunk_ref, chunk_data in chunk:
+                batch.set(chunk_ref, chunk_data)
+            return len(chunk)
+        
+        # 區塊平均分給各執行緒，每份再依批次寫入上限分批
+        workers = max(1, min(len(writes), Config.CONTENT_CHUNK_WRITE_WORKERS))
+        per_worker = -(-len(writes) // workers)
+        batches = []
+        for start in range(0, len(writes), per_worker):
+            batches.extend(self._split_chunks(writes[start:start + per_worker], lambda write: stored_size(write[1]['content'])))
+        
+        error = None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._commit_batch, lambda batch, chunk=chunk: build_batch(batch, chunk)) for chunk in batches]
+            # 寫入用量於呼叫端的執行緒記錄
+            for future in futures:
+                try:
+                    self._record_writes(future.result())
+                except Exception as e:
+                    error = e
+        
+        if error is not None:
+            self._delete_content_chunks(knowledge_ref, manifest)
+            raise error
+        return manifest
+    
+    def _load_chunked_content(self, knowledge_ref, manifest, first=0, last=None):
+        """一次讀取第 first 至 last（不含）個區塊並依序組合內容"""
+        last = manifest['chunks'] if last is None else last
+        refs = [self._chunk_ref(knowledge_ref, manifest['version'], index) for index in range(first, last)]
+        if not refs:
+            return ''
+        
+        chunks = {doc.id: doc.to_dict() for doc in self.db.get_all(refs) if doc.exists}
+        self._record_reads(len(refs))
+        
+        parts = []
+        for chunk_ref in refs:
+            chunk_data = chunks.get(chunk_ref.id)
+            if chunk_data is None:
+                raise RuntimeError(f"內容區塊遺失: {chunk_ref.id}")
+            parts.append(decode_content(chunk_data['content'], chunk_data.get(ENCODING_FIELD)))
+        return ''.join(parts)
+    
+    def _delete_content_chunks(self, knowledge_ref, manifest):
+        """刪除一個版本的所有區塊（Firestore 刪除文件不會刪除子集合）
+        
+        在條目寫入後執行，失敗時只留下不再被引用的區塊，因此只記錄錯誤。
+        """
+        try:
+            refs = [self._chunk_ref(knowledge_ref, manifest['version'], index) for index in range(manifest['chunks'])]
+            batch_size = max(1, Config.FIRESTORE_BATCH_MAX_WRITES)
+            for start in range(0, len(refs), batch_size):
+                chunk = refs[start:start + batch_size]
+                
+                def build_batch(batch, chunk=chunk):
+                    for chunk_ref in chunk:
+                        batch.delete(chunk_ref)
+                    return len(chunk)
+                
+                self._record_writes(self._commit_batch(build_batch))
+        except Exception as e:
+            print(f"刪除內容區塊錯誤: {e}")
+    
+    def _load_knowledge_page(self, user_id, category, limit, cursor, fields):
+        """從 Firestore 讀取一頁知識列表（錯誤時拋出例外，不寫入快取）"""
+        user_ref = self.db.collection('line_users').document(user_id)
+        query = user_ref.collection('knowledge_base').order_by('upload_date', direction=firestore.Query.DESCENDING)
+        query = query.order_by('__name__', direction=firestore.Query.DESCENDING)
+        
+        if category:
+            query = query.where('category', '==', category)
+        
+        # 伺服器端欄位投影，避免下載完整的文件內容（保留排序鍵以產生下一頁位置）
+        if fields is not None:
+            query = query.select(self._projection(list(fields) + ['upload_date']))
+        
+        if cursor:
+            query = query.start_after({'upload_date': cursor['upload_date'], '__name__': cursor['id']})
+        
+        # 多讀取一筆以判斷是否還有下一頁
+        docs = list(query.limit(limit + 1).stream())
+        self._record_reads(len(docs))
+        
+        knowledge_list = []
+        for doc in docs[:limit]:
+            data = self._decode_content_fields(doc.to_dict(), doc.reference)
+            data['id'] = doc.id
+            knowledge_list.append(data)
+        
+        next_position = None
+        if len(docs) > limit and knowledge_list:
+            last = knowledge_list[-1]
+            next_position = {'upload_date': last.get('upload_date'), 'id': last['id']}
+        
+        return knowledge_list, next_position
+    
+    def get_knowledge_entry(self, user_id, knowledge_id):
+        """獲取單一知識條目"""
+        try:
+            user_ref = self.db.collection('line_users').document(user_id)
+            knowledge_doc = user_ref.collection('knowledge_base').document(knowledge_id).get()
+            self._record_reads(1)
+            
+            if not knowledge_doc.exists:
+                return None
+            
+            data = self._decode_content_fields(knowledge_doc.to_dict(), knowledge_doc.reference)
+            data['id'] = knowledge_doc.id
+            return data
+        except Exception as e:
+            print(f"獲取知識條目錯誤: {e}")
             return None
     
-    def get_knowledge_list(self, user_id, category=None, limit=50):
-        """獲取知識列表"""
+    def get_knowledge_entries(self, user_id, knowledge_ids, fields=None):
+        """一次讀取多筆知識條目，回傳 {條目 ID: 資料}（不存在的條目不包含在內）"""
+        try:
+            knowledge_ref = self.db.collection('line_users').document(user_id).collection('knowledge_base')
+            refs = [knowledge_ref.document(knowledge_id) for knowledge_id in knowledge_ids]
+            if not refs:
+                return {}
+            
+            entries = {}
+            for doc in self.db.get_all(refs, field_paths=self._projection(fields) if fields is not None else None):
+                if doc.exists:
+                    data = self._decode_content_fields(doc.to_dict(), doc.reference)
+                    data['id'] = doc.id
+                    entries[doc.id] = data
+            
+            self._record_reads(len(refs))
+            return entries
+        except Exception as e:
+            print(f"獲取知識條目錯誤: {e}")
+            return {}
+    
+    def find_knowledge_by_hash(self, user_id, content_hash):
+        """依文件內容雜湊尋找既有知識條目，回傳條目 ID"""
+        try:
+            user_ref = self.db.collection('line_users').document(user_id)
+            query = user_ref.collection('knowledge_base').where('file_info.content_hash', '==', content_hash)
+            docs = list(query.select([]).limit(1).stream())
+            self._record_reads(len(docs))
+            
+            if docs:
+                return docs[0].id
+            return None
+        except Exception as e:
+            print(f"查詢重複文件錯誤: {e}")
+            return None
+    
+    def stream_knowledge_entries(self, user_id, since=None, fields=None, category=None):
+        """逐筆讀取用戶所有知識條目（不受筆數限制，可指定上傳日期下限、讀取欄位與分類；錯誤時拋出例外）"""
+        count = 0
         try:
             user_ref = self.db.collection('line_users').document(user_id)
-            query = user_ref.collection('knowledge_base').order_by('upload_date', direction=firestore.Query.DESCENDING)
+            query = user_ref.collection('knowledge_base')
+            
+            if since is not None:
+                query = query.where('upload_date', '>=', since)
             
             if category:
                 query = query.where('category', '==', category)
             
-            docs = query.limit(limit).stream()
+            if fields is not None:
+                query = query.select(self._projection(fields))
             
-            knowledge_list = []
-            for doc in docs:
-                data = doc.to_dict()
+            for doc in query.stream():
+                count += 1
+                data = self._decode_content_fields(doc.to_dict(), doc.reference)
                 data['id'] = doc.id
-                knowledge_list.append(data)
-            
-            return knowledge_list
-        except Exception as e:
-            print(f"獲取知識列表錯誤: {e}")
-            return []
+                yield data
+        finally:
+            self._record_reads(count)
     
-    def update_knowledge_entry(self, user_id, knowledge_id, updates):
-        """更新知識條目"""
+    def update_knowledge_entry(self, user_id, knowledge_id, updates, expected_last_modified=None):
+        """更新知識條目（新內容需要分塊時先寫入新版本的區塊，交易提交後再刪除舊區塊）"""
+        manifest = None
         try:
             user_ref = self.db.collection('line_users').document(user_id)
             knowledge_ref = user_ref.collection('knowledge_base').document(knowledge_id)
             
             updates['last_modified'] = datetime.now()
-            knowledge_ref.update(updates)
+            if self._needs_chunking(updates.get('content')):
+                manifest = self._write_content_chunks(knowledge_ref, updates['content'])
+            
+            @firestore.transactional
+            def update_in_transaction(transaction):
+                snapshot = knowledge_ref.get(transaction=transaction)
+                self._record_reads(1)
+                if not snapshot.exists:
+                    raise ValueError(f"知識條目不存在: {knowledge_id}")
+                
+                old_data = self._decode_content_fields(snapshot.to_dict())
+                if expected_last_modified is not None and old_data.get('last_modified') != expected_last_modified:
+                    raise ValueError(f"知識條目已被修改: {knowledge_id}")
+                new_data = {**old_data, **updates}
+                if 'content' in updates:
+                    new_data.pop(MANIFEST_FIELD, None)
+                transaction.update(knowledge_ref, self._encode_content_fields(updates, clear_marker=True, manifest=manifest))
+                return 1 + self._apply_statistics_delta(transaction, user_id, old_data, new_data), old_data.get(MANIFEST_FIELD)
+            
+            writes, old_manifest = update_in_transaction(self.db.transaction())
+            self._record_writes(writes)
+            self.read_cache.invalidate(user_id)
+            if old_manifest and 'content' in updates:
+                self._delete_content_chunks(knowledge_ref, old_manifest)
             return True
         except Exception as e:
             print(f"更新知識條目錯誤: {e}")
+            if manifest is not None:
+                self._delete_content_chunks(knowledge_ref, manifest)
             return False
     
     def delete_knowledge_entry(self, user_id, knowledge_id):
@@ -109,39 +558,699 @@ class FirebaseService:
         try:
             user_ref = self.db.collection('line_users').document(user_id)
             knowledge_ref = user_ref.collection('knowledge_base').document(knowledge_id)
-            knowledge_ref.delete()
+            
+            @firestore.transactional
+            def delete_in_transaction(transaction):
+                snapshot = knowledge_ref.get(transaction=transaction)
+                self._record_reads(1)
+                if not snapshot.exists:
+                    return 0, None
+                
+                transaction.delete(knowledge_ref)
+                old_data = self._decode_content_fields(snapshot.to_dict())
+                return 1 + self._apply_statistics_delta(transaction, user_id, old_data, None), old_data.get(MANIFEST_FIELD)
+            
+            writes, old_manifest = delete_in_transaction(self.db.transaction())
+            self._record_writes(writes)
+            self.read_cache.invalidate(user_id)
+            if old_manifest:
+                self._delete_content_chunks(knowledge_ref, old_manifest)
             return True
         except Exception as e:
             print(f"刪除知識條目錯誤: {e}")
             return False
     
-    def get_user_statistics(self, user_id):
-        """獲取用戶統計資料"""
+    def update_knowledge_entries(self, user_id, knowledge_ids, updates):
+        """批量更新知識條目
+        
+        條目依交易寫入上限分段，每段在一個交易中讀取舊資料、寫入更新並合併
+        統計計數器與每日彙總的增量；某段失敗時只有該段的條目更新失敗。
+        新內容需要分塊時每筆條目須各自寫入區塊，改為逐筆更新。
+        """
+        if self._needs_chunking(updates.get('content')):
+            return self._update_entries_individually(user_id, knowledge_ids, updates)
+        
+        knowledge_collection = self.db.collection('line_users').document(user_id).collection('knowledge_base')
+        updates = {**updates, 'last_modified': datetime.now()}
+        encoded_updates = self._encode_content_fields(updates, clear_marker=True)
+        update_bytes = stored_size(encoded_updates.get('content'))
+        updated = {}
+        missing = []
+        replaced_manifests = {}
+        
+        for chunk in self._split_chunks(knowledge_ids, lambda _: update_bytes, BULK_WRITES_PER_ENTRY):
+            @firestore.transactional
+            def update_in_transaction(transaction, chunk=chunk):
+                refs = [knowledge_collection.document(knowledge_id) for knowledge_id in chunk]
+                snapshots = list(self.db.get_all(refs, transaction=transaction))
+                self._record_reads(len(refs))
+                
+                chunk_updated = {}
+                changes = []
+                for snapshot in snapshots:
+                    if not snapshot.exists:
+                        continue
+                    old_data = self._decode_content_fields(snapshot.to_dict())
+                    new_data = self._merge_updates(old_data, updates)
+                    if 'content' in updates:
+                        new_data.pop(MANIFEST_FIELD, None)
+                        replaced_manifests[snapshot.id] = old_data.get(MANIFEST_FIELD)
+                    transaction.update(snapshot.reference, encoded_updates)
+                    chunk_updated[snapshot.id] = new_data
+                    changes.append((old_data, new_data))
+                
+                writes = len(changes)
+                if changes:
+                    writes += self._apply_statistics_changes(transaction, user_id, changes)
+                return writes, chunk_updated
+            
+            try:
+                writes, chunk_updated = update_in_transaction(self.db.transaction())
+                self._record_writes(writes)
+                updated.update(chunk_updated)
+                missing.extend(knowledge_id for knowledge_id in chunk if knowledge_id not in chunk_updated)
+            except Exception as e:
+                print(f"批量更新知識條目錯誤: {e}")
+        
+        if updated:
+            self.read_cache.invalidate(user_id)
+        
+        for knowledge_id, new_data in updated.items():
+            manifest = new_data.pop(MANIFEST_FIELD, None)
+            if manifest:
+                # 內容未更新的分塊條目讀取區塊，使回傳資料包含完整內容
+                try:
+                    new_data['content'] = self._load_chunked_content(knowledge_collection.document(knowledge_id), manifest)
+                except Exception as e:
+                    # 無法提供完整內容時再使快取失效一次，使搜尋索引重新建立而非套用不完整的資料
+                    print(f"讀取內容區塊錯誤: {e}")
+                    self.read_cache.invalidate(user_id)
+            elif replaced_manifests.get(knowledge_id):
+                self._delete_content_chunks(knowledge_collection.document(knowledge_id), replaced_manifests[knowledge_id])
+        return updated, missing
+    
+    def _update_entries_individually(self, user_id, knowledge_ids, updates):
+        """逐筆更新並讀回更新後的條目（回傳格式與 update_knowledge_entries 相同）"""
+        updated = {}
+        missing = []
+        for knowledge_id in knowledge_ids:
+            if self.update_knowledge_entry(user_id, knowledge_id, dict(updates)):
+                knowledge = self.get_knowledge_entry(user_id, knowledge_id)
+                if knowledge is not None:
+                    knowledge.pop('id', None)
+                    updated[knowledge_id] = knowledge
+            elif self.get_knowledge_entry(user_id, knowledge_id) is None:
+                missing.append(knowledge_id)
+        return updated, missing
+    
+    def delete_knowledge_entries(self, user_id, knowledge_ids):
+        """批量刪除知識條目（分段方式與批量更新相同）"""
+        knowledge_collection = self.db.collection('line_users').document(user_id).collection('knowledge_base')
+        deleted = set()
+        missing = []
+        deleted_manifests = {}
+        
+        for chunk in self._split_chunks(knowledge_ids, lambda _: 0, BULK_WRITES_PER_ENTRY):
+            @firestore.transactional
+            def delete_in_transaction(transaction, chunk=chunk):
+                refs = [knowledge_collection.document(knowledge_id) for knowledge_id in chunk]
+                snapshots = list(self.db.get_all(refs, transaction=transaction))
+                self._record_reads(len(refs))
+                
+                changes = []
+                manifests = {}
+                for snapshot in snapshots:
+                    if snapshot.exists:
+                        transaction.delete(snapshot.reference)
+                        old_data = self._decode_content_fields(snapshot.to_dict())
+                        changes.append((old_data, None))
+                        manifests[snapshot.id] = old_data.get(MANIFEST_FIELD)
+                
+                writes = len(changes)
+                if changes:
+                    writes += self._apply_statistics_changes(transaction, user_id, changes)
+                return writes, manifests
+            
+            try:
+                writes, chunk_deleted = delete_in_transaction(self.db.transaction())
+                self._record_writes(writes)
+                deleted.update(chunk_deleted)
+                deleted_manifests.update(chunk_deleted)
+                missing.extend(knowledge_id for knowledge_id in chunk if knowledge_id not in deleted)
+            except Exception as e:
+                print(f"批量刪除知識條目錯誤: {e}")
+        
+        if deleted:
+            self.read_cache.invalidate(user_id)
+        
+        for knowledge_id, manifest in deleted_manifests.items():
+            if manifest:
+                self._delete_content_chunks(knowledge_collection.document(knowledge_id), manifest)
+        return [knowledge_id for knowledge_id in knowledge_ids if knowledge_id in deleted], missing
+    
+    def _encode_content_fields(self, data, clear_marker=False, manifest=None):
+        """回傳寫入用的副本：內容超過門檻時壓縮並記錄壓縮格式
+        
+        clear_marker 用於更新，內容改存為未壓縮文字時刪除原有的壓縮格式欄位，
+        並刪除原有的區塊清單。指定 manifest 時內容已寫入區塊，條目只保存區塊清單。
+        """
+        if 'content' not in data:
+            return data
+        
+        if manifest is not None:
+            encoded = {key: value for key, value in data.items() if key != 'content'}
+            encoded[MANIFEST_FIELD] = manifest
+            if clear_marker:
+                encoded['content'] = firestore.DELETE_FIELD
+                encoded[ENCODING_FIELD] = firestore.DELETE_FIELD
+            return encoded
+        
+        value, encoding = encode_content(data['content'])
+        encoded = {**data, 'content': value}
+        if encoding:
+            encoded[ENCODING_FIELD] = encoding
+        elif clear_marker:
+            encoded[ENCODING_FIELD] = firestore.DELETE_FIELD
+        if clear_marker:
+            encoded[MANIFEST_FIELD] = firestore.DELETE_FIELD
+        return encoded
+    
+    def _decode_content_fields(self, data, knowledge_ref=None):
+        """還原讀取結果中壓縮的內容（投影不含內容的讀取不需解壓縮）
+        
+        指定 knowledge_ref 時讀取分塊保存的內容並移除區塊清單；交易中的讀取不指定，
+        保留區塊清單供計算統計與清除舊區塊。
+        """
+        encoding = data.pop(ENCODING_FIELD, None)
+        if encoding and 'content' in data:
+            data['content'] = decode_content(data['content'], encoding)
+        if knowledge_ref is not None and MANIFEST_FIELD in data:
+            data['content'] = self._load_chunked_content(knowledge_ref, data.pop(MANIFEST_FIELD))
+        return data
+    
+    def _projection(self, fields):
+        """讀取欄位包含內容時一併讀取壓縮格式與區塊清單欄位"""
+        fields = list(dict.fromkeys(fields))
+        if 'content' in fields:
+            fields.extend(field for field in (ENCODING_FIELD, MANIFEST_FIELD) if field not in fields)
+        return fields
+    
+    def _knowledge_size(self, knowledge_data):
+        """分塊保存且未讀取內容的條目以區塊清單記錄的位元組數計算"""
+        manifest = knowledge_data.get(MANIFEST_FIELD)
+        if manifest and 'content' not in knowledge_data and 'file_size' not in (knowledge_data.get('file_info') or {}):
+            return manifest.get('bytes', 0)
+        return super()._knowledge_size(knowledge_data)
+    
+    def read_knowledge_content(self, user_id, knowledge_id, start=None, end=None, page=None, end_page=None, max_chars=None):
+        """讀取知識條目內容的一段；分塊保存的條目只讀取涵蓋範圍的區塊"""
+        knowledge_ref = self.db.collection('line_users').document(user_id).collection('knowledge_base').document(knowledge_id)
+        doc = knowledge_ref.get(field_paths=['content', ENCODING_FIELD, MANIFEST_FIELD, 'file_info.page_offsets'])
+        self._record_reads(1)
+        if not doc.exists:
+            return None
+        
+        data = doc.to_dict()
+        page_offsets = (data.get('file_info') or {}).get('page_offsets')
+        manifest = data.get(MANIFEST_FIELD)
+        if manifest is None:
+            content = decode_content(data.get('content'), data.get(ENCODING_FIELD)) or ''
+            range_start, range_end = self._resolve_content_range(
+                len(content), page_offsets, start, end, page, end_page, max_chars
+            )
+            return self._content_range_result(content[range_start:range_end], range_start, range_end, len(content), page_offsets)
+        
+        range_start, range_end = self._resolve_content_range(
+            manifest['length'], page_offsets, start, end, page, end_page, max_chars
+        )
+        content = ''
+        if range_end > range_start:
+            offsets = manifest['offsets']
+            first = bisect_right(offsets, range_start) - 1
+            last = bisect_left(offsets, range_end)
+            content = self._load_chunked_content(knowledge_ref, manifest, first, last)
+            content = content[range_start - offsets[first]:range_end - offsets[first]]
+        return self._content_range_result(content, range_start, range_end, manifest['length'], page_offsets)
+    
+    def read_knowledge_passages(self, user_id, passages):
+        """一次讀取多個段落：以一次 get_all 讀取所有涉及的條目（不展開分塊內容），
+        分塊保存的條目再以一次 get_all 只讀取各段落涵蓋的區塊"""
+        knowledge_collection = self.db.collection('line_users').document(user_id).collection('knowledge_base')
+        knowledge_ids = list(dict.fromkeys(knowledge_id for knowledge_id, _, _ in passages))
+        if not knowledge_ids:
+            return []
+        
+        contents = {}
+        manifests = {}
+        refs = [knowledge_collection.document(knowledge_id) for knowledge_id in knowledge_ids]
+        for doc in self.db.get_all(refs, field_paths=['content', ENCODING_FIELD, MANIFEST_FIELD]):
+            if not doc.exists:
+                continue
+            data = doc.to_dict()
+            if data.get(MANIFEST_FIELD) is not None:
+                manifests[doc.id] = data[MANIFEST_FIELD]
+            else:
+                contents[doc.id] = decode_content(data.get('content'), data.get(ENCODING_FIELD)) or ''
+        self._record_reads(len(refs))
+        
+        # 各段落涵蓋的區塊（第一個區塊的位置與區塊 ID 列表）
+        spans = {}
+        chunk_refs = {}
+        for knowledge_id, start, end in passages:
+            manifest = manifests.get(knowledge_id)
+            if manifest is None or (knowledge_id, start, end) in spans:
+                continue
+            offsets = manifest['offsets']
+            first = max(0, bisect_right(offsets, start) - 1)
+            last = max(first, bisect_left(offsets, end))
+            knowledge_ref = knowledge_collection.document(knowledge_id)
+            span_refs = [self._chunk_ref(knowledge_ref, manifest['version'], index) for index in range(first, last)]
+            spans[(knowledge_id, start, end)] = (offsets[first] if offsets else 0, [chunk_ref.id for chunk_ref in span_refs])
+            chunk_refs.update((chunk_ref.id, chunk_ref) for chunk_ref in span_refs)
+        
+        chunks = {}
+        if chunk_refs:
+            for doc in self.db.get_all(list(chunk_refs.values())):
+                if doc.exists:
+                    chunk_data = doc.to_dict()
+                    chunks[doc.id] = decode_content(chunk_data['content'], chunk_data.get(ENCODING_FIELD))
+            self._record_reads(len(chunk_refs))
+        
+        texts = []
+        for knowledge_id, start, end in passages:
+            if knowledge_id in contents:
+                texts.append(contents[knowledge_id][start:end])
+                continue
+            manifest = manifests.get(knowledge_id)
+            if manifest is None:
+                texts.append(None)
+                continue
+            
+            base, chunk_ids = spans[(knowledge_id, start, end)]
+            parts = []
+            for chunk_id in chunk_ids:
+                if chunk_id not in chunks:
+                    raise RuntimeError(f"內容區塊遺失: {chunk_id}")
+                parts.append(chunks[chunk_id])
+            texts.append(''.join(parts)[start - base:end - base])
+        return texts
+    
+    def migrate_content_encoding(self, user_id, dry_run=False):
+        """將用戶既有條目的內容改寫為目前設定的壓縮格式（CONTENT_COMPRESSION 為 none 時還原為文字）
+        
+        先掃描所有條目的內容找出需要改寫者，再分段在交易中重新讀取並改寫，
+        避免覆蓋掃描後才寫入的內容。分塊保存的條目改寫其目前版本的各區塊文件。
+        只改寫儲存格式，不變更條目資料與修改時間，因此不影響統計與快取。
+        回傳 {'scanned', 'rewritten', 'chunked', 'bytes_before', 'bytes_after'}
+        （rewritten 為有內容需改寫的條目數，chunked 為其中分塊保存的條目數；bytes 為
+        內容欄位與區塊的儲存大小；dry_run 時為預估值且不寫入）。
+        """
+        knowledge_collection = self.db.collection('line_users').document(user_id).collection('knowledge_base')
+        target_codec = resolve_codec() or 'none'
+        report = {'scanned': 0, 'rewritten': 0, 'chunked': 0, 'bytes_before': 0, 'bytes_after': 0}
+        
+        def recode(data):
+            """回傳 (新的儲存值, 新的壓縮格式, 是否需要改寫)"""
+            encoding = data.get(ENCODING_FIELD)
+            value, new_encoding = encode_content(decode_content(data.get('content'), encoding), target_codec)
+            return value, new_encoding, new_encoding != encoding
+        
+        def scan(snapshots):
+            """累計儲存大小，回傳需要改寫的 [(文件參照, 改寫後大小)]"""
+            changes = []
+            for snapshot in snapshots:
+                data = snapshot.to_dict()
+                value, _, changed = recode(data)
+                report['bytes_before'] += stored_size(data.get('content'))
+                report['bytes_after'] += stored_size(value if changed else data.get('content'))
+                if changed:
+                    changes.append((snapshot.reference, stored_size(value)))
+            return changes
+        
+        # 條目與區塊文件都以 content 與壓縮格式欄位保存內容，以相同方式改寫
+        candidates = []
+        for doc in knowledge_collection.select(['content', ENCODING_FIELD, MANIFEST_FIELD]).stream():
+            self._record_reads(1)
+            report['scanned'] += 1
+            manifest = doc.to_dict().get(MANIFEST_FIELD)
+            if manifest:
+                refs = [self._chunk_ref(doc.reference, manifest['version'], index) for index in range(manifest['chunks'])]
+                changes = scan(chunk_doc for chunk_doc in self.db.get_all(refs) if chunk_doc.exists)
+                self._record_reads(len(refs))
+            else:
+                changes = scan([doc])
+            
+            if changes:
+                report['rewritten'] += 1
+                report['chunked'] += 1 if manifest else 0
+                candidates.extend(changes)
+        
+        if dry_run or not candidates:
+            return report
+        
+        for chunk in self._split_chunks(candidates, lambda candidate: candidate[1]):
+            @firestore.transactional
+            def rewrite_in_transaction(transaction, chunk=chunk):
+                refs = [ref for ref, _ in chunk]
+                snapshots = list(self.db.get_all(refs, field_paths=['content', ENCODING_FIELD, MANIFEST_FIELD], transaction=transaction))
+                self._record_reads(len(refs))
+                
+                writes = 0
+                for snapshot in snapshots:
+                    # 已刪除的條目與區塊（內容改寫後舊版本的區塊會被刪除），以及掃描後改為分塊保存的條目
+                    data = snapshot.to_dict() if snapshot.exists else None
+                    if data is None or data.get(MANIFEST_FIELD):
+                        continue
+                    value, new_encoding, changed = recode(data)
+                    if changed:
+                        transaction.update(snapshot.reference, {
+                            'content': value,
+                            ENCODING_FIELD: new_encoding or firestore.DELETE_FIELD
+                        })
+                        writes += 1
+                return writes
+            
+            self._record_writes(rewrite_in_transaction(self.db.transaction()))
+        return report
+    
+    def _statistics_shards_ref(self, user_id, client=None):
+        """統計計數器分片集合（client 為 async_db 時回傳非同步參照）"""
+        user_ref = (client or self.db).collection('line_users').document(user_id)
+        return user_ref.collection('statistics_shards')
+    
+    def _upload_rollups_ref(self, user_id, client=None):
+        """每日上傳彙總（文件 ID 為 UTC 日期 YYYY-MM-DD）"""
+        return (client or self.db).collection('line_users').document(user_id).collection('upload_rollups')
+    
+    def _increment_fields(self, delta):
+        """將 {路徑: 增量} 轉為巢狀的 Increment 欄位（略過增量為 0 的欄位）"""
+        fields = {}
+        for path, value in delta.items():
+            if value == 0:
+                continue
+            target = fields
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = firestore.Increment(value)
+        return fields
+    
+    def _apply_statistics_delta(self, writer, user_id, old_data, new_data):
+        """在批次或交易中寫入統計計數器的增量，回傳寫入數"""
+        return self._apply_statistics_changes(writer, user_id, [(old_data, new_data)])
+    
+    def _apply_statistics_changes(self, writer, user_id, changes):
+        """合併多筆 (舊資料, 新資料) 變更為計數器與每日彙總的增量寫入
+        
+        計數器寫入隨機分片以分散熱點用戶寫入；每日彙總每個受影響的日期寫入一次。
+        分片同時記錄用戶資料最後寫入時間（計數器沒有變化的更新也會寫入）。
+        回傳寫入數。
+        """
+        delta = {}
+        rollup_deltas = defaultdict(dict)
+        for old_data, new_data in changes:
+            for sign, data in ((1, new_data), (-1, old_data)):
+                for path, value in self._statistics_contribution(data).items():
+                    delta[path] = delta.get(path, 0) + sign * value
+                
+                day, contribution = self._rollup_contribution(data)
+                day_delta = rollup_deltas[day] if day else {}
+                for path, value in contribution.items():
+                    day_delta[path] = day_delta.get(path, 0) + sign * value
+        
+        writes = 1
+        shard_data = self._increment_fields(delta)
+        shard_data['last_modified'] = datetime.now(timezone.utc)
+        shard_id = str(random.randrange(self.statistics_shards))
+        writer.set(self._statistics_shards_ref(user_id).document(shard_id), shard_data, merge=True)
+        
+        for day, day_delta in rollup_deltas.items():
+            rollup_data = self._increment_fields(day_delta)
+            if rollup_data:
+                rollup_data['date'] = day
+                writer.set(self._upload_rollups_ref(user_id).document(day), rollup_data, merge=True)
+                writes += 1
+        return writes
+    
+    def rebuild_user_statistics(self, user_id):
+        """以完整掃描重建用戶統計計數器與每日上傳彙總（用於回填既有用戶）
+        
+        條目、計數器分片與每日彙總都讀取同一時間點（read_time）的資料，再以 Increment
+        寫入「重建值 − 該時間點的值」。該時間點之後的寫入各自以增量更新計數器，
+        不會被重建覆蓋或重複計算，因此重建期間不需停止寫入。兩次重建同時計算出相同
+        增量時會重複套用，因此以租約文件確保同一用戶同時只有一個重建；其他程序
+        正在重建時回傳 None。
+        """
+        token = None
         try:
+            token = self._acquire_statistics_rebuild(user_id)
+            if token is None:
+                print(f"統計資料正在由其他程序重建: {user_id}")
+                return None
+            
             user_ref = self.db.collection('line_users').document(user_id)
+            knowledge_collection = user_ref.collection('knowledge_base')
+            # 以伺服器回傳的讀取時間為時間點（本機時鐘可能超前）；掃描須在保留期限（1 小時）內完成
+            read_time = user_ref.get(field_paths=[]).read_time
+            self._record_reads(1)
             
-            # 獲取知識總數
-            knowledge_docs = user_ref.collection('knowledge_base').stream()
-            total_knowledge = len(list(knowledge_docs))
-            
-            # 獲取分類統計
-            categories = set()
-            knowledge_docs = user_ref.collection('knowledge_base').stream()
-            for doc in knowledge_docs:
-                data = doc.to_dict()
-                if 'category' in data:
-                    categories.add(data['category'])
-            
-            return {
-                'total_knowledge': total_knowledge,
-                'categories_count': len(categories),
-                'today_uploads': 0,  # 簡化版本
-                'weekly_uploads': 0,  # 簡化版本
-                'knowledge_completion': 100  # 簡化版本
+            totals = {
+                'total_knowledge': 0,
+                'bytes_stored': 0,
+                'categories': {},
+                'file_types': {}
             }
+            # 單次走訪中將每筆條目分桶至其上傳日期
+            rollups = defaultdict(Counter)
+            
+            def add_contribution(knowledge):
+                for path, value in self._statistics_contribution(knowledge).items():
+                    if len(path) == 1:
+                        totals[path[0]] += value
+                    else:
+                        group = totals[path[0]]
+                        group[path[1]] = group.get(path[1], 0) + value
+                
+                day, contribution = self._rollup_contribution(knowledge)
+                if day:
+                    rollups[day].update(contribution)
+            
+            # 只讀取計數所需欄位；沒有文件大小的條目（手動新增）再另外讀取內容計算位元組數
+            # （分塊保存的條目以區塊清單記錄的位元組數計算，不讀取區塊）
+            without_size = []
+            for doc in knowledge_collection.select(list(STATISTICS_FIELDS)).stream(read_time=read_time):
+                self._record_reads(1)
+                knowledge = doc.to_dict()
+                if 'file_size' not in (knowledge.get('file_info') or {}):
+                    without_size.append(doc.id)
+                else:
+                    add_contribution(knowledge)
+            
+            content_fields = self._projection(STATISTICS_FIELDS + ('content',))
+            for start in range(0, len(without_size), STATISTICS_CONTENT_READ_SIZE):
+                refs = [knowledge_collection.document(knowledge_id) for knowledge_id in without_size[start:start + STATISTICS_CONTENT_READ_SIZE]]
+                for doc in self.db.get_all(refs, field_paths=content_fields, read_time=read_time):
+                    if doc.exists:
+                        add_contribution(self._decode_content_fields(doc.to_dict()))
+                self._record_reads(len(refs))
+            
+            # 同一時間點的計數器與每日彙總
+            shards_ref = self._statistics_shards_ref(user_id)
+            current_totals = Counter()
+            for shard_doc in shards_ref.stream(read_time=read_time):
+                self._record_reads(1)
+                data = shard_doc.to_dict()
+                current_totals.update(self._numeric_fields({key: data.get(key) for key in totals}))
+            
+            rollups_ref = self._upload_rollups_ref(user_id)
+            current_rollups = {}
+            for rollup_doc in rollups_ref.stream(read_time=read_time):
+                self._record_reads(1)
+                current_rollups[rollup_doc.id] = self._numeric_fields(rollup_doc.to_dict())
+            
+            writes = []
+            for day in sorted(set(rollups) | set(current_rollups)):
+                rollup_data = self._increment_fields(self._difference(rollups.get(day, {}), current_rollups.get(day, {})))
+                if rollup_data:
+                    rollup_data['date'] = day
+                    writes.append((rollups_ref.document(day), rollup_data))
+            
+            # 計數器最後寫入，標記每日彙總已建立
+            shard_data = self._increment_fields(self._difference(self._numeric_fields(totals), current_totals))
+            shard_data.update({'rollups_built': True, 'last_modified': datetime.now(timezone.utc)})
+            writes.append((shards_ref.document('0'), shard_data))
+            
+            # 租約逾時被其他程序接手時不寫入（避免重複套用增量）
+            if not self._holds_statistics_rebuild(user_id, token):
+                raise RuntimeError("統計重建租約已失效")
+            
+            # 增量可交換順序，分批提交中途失敗時重新執行即可補齊
+            batch_size = max(1, Config.FIRESTORE_BATCH_MAX_WRITES)
+            for start in range(0, len(writes), batch_size):
+                batch = self.db.batch()
+                chunk = writes[start:start + batch_size]
+                for ref, data in chunk:
+                    batch.set(ref, data, merge=True)
+                batch.commit()
+                self._record_writes(len(chunk))
+            
+            self.read_cache.invalidate(user_id)
+            return totals
         except Exception as e:
-            print(f"獲取統計資料錯誤: {e}")
+            print(f"重建統計資料錯誤: {e}")
             return None
-
-# 創建全域實例
-firebase_service = FirebaseService()
\ No newline at end of file
+        finally:
+            if token is not None:
+                self._release_statistics_rebuild(user_id, token)
+    
+    def _statistics_rebuild_ref(self, user_id):
+        """統計重建租約文件"""
+        return self.db.collection('line_users').document(user_id).collection('statistics_rebuild').document('lease')
+    
+    def _acquire_statistics_rebuild(self, user_id):
+        """取得統計重建租約，回傳租約 token；其他程序持有未過期的租約時回傳 None
+        
+        以 create 建立租約文件，文件已存在（AlreadyExists）表示其他程序正在重建；
+        持有者中斷而遺留的過期租約在交易中接手。
+        """
+        lease_ref = self._statistics_rebuild_ref(user_id)
+        token = uuid.uuid4().hex
+        now = datetime.now(timezone.utc)
+        lease = {'token': token, 'expires_at': now + timedelta(seconds=STATISTICS_REBUILD_LEASE_SECONDS)}
+        try:
+            lease_ref.create(lease)
+            self._record_writes(1)
+            return token
+        except google_exceptions.AlreadyExists:
+            pass
+        
+        @firestore.transactional
+        def take_over_expired(transaction):
+            snapshot = lease_ref.get(transaction=transaction)
+            self._record_reads(1)
+            expires_at = (snapshot.to_dict() or {}).get('expires_at') if snapshot.exists else None
+            if expires_at is not None and to_utc_naive(expires_at) > to_utc_naive(now):
+                return None
+            transaction.set(lease_ref, lease)
+            return token
+        
+        acquired = take_over_expired(self.db.transaction())
+        if acquired:
+            self._record_writes(1)
+        return acquired
+    
+    def _holds_statistics_rebuild(self, user_id, token):
+        """租約是否仍由 token 持有且未過期"""
+        snapshot = self._statistics_rebuild_ref(user_id).get()
+        self._record_reads(1)
+        lease = snapshot.to_dict() if snapshot.exists else None
+        return bool(
+            lease and lease.get('token') == token
+            and to_utc_naive(lease.get('expires_at')) > to_utc_naive(datetime.now(timezone.utc))
+        )
+    
+    def _release_statistics_rebuild(self, user_id, token):
+        """釋放租約（已被其他程序接手時保留）"""
+        lease_ref = self._statistics_rebuild_ref(user_id)
+        try:
+            @firestore.transactional
+            def release(transaction):
+                snapshot = lease_ref.get(transaction=transaction)
+                self._record_reads(1)
+                if snapshot.exists and (snapshot.to_dict() or {}).get('token') == token:
+                    transaction.delete(lease_ref)
+                    return 1
+                return 0
+            
+            self._record_writes(release(self.db.transaction()))
+        except Exception as e:
+            print(f"釋放統計重建租約錯誤: {e}")
+    
+    def _numeric_fields(self, data, prefix=()):
+        """將巢狀資料中的數值欄位展開為 {路徑: 值}"""
+        fields = {}
+        for key, value in (data or {}).items():
+            if isinstance(value, dict):
+                fields.update(self._numeric_fields(value, prefix + (key,)))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                fields[prefix + (key,)] = value
+        return fields
+    
+    def _difference(self, target, current):
+        """{路徑: 目標值 − 目前值}"""
+        return {path: target.get(path, 0) - current.get(path, 0) for path in set(target) | set(current)}
+    
+    def _load_upload_rollups(self, user_id, start_day, end_day):
+        query = self._upload_rollups_ref(user_id).where('date', '>=', start_day).where('date', '<=', end_day)
+        docs = list(query.stream())
+        self._record_reads(len(docs))
+        return {doc.id: doc.to_dict() for doc in docs}
+    
+    async def _load_upload_rollups_async(self, user_id, start_day, end_day):
+        """以非同步用戶端讀取每日上傳彙總"""
+        query = (
+            self._upload_rollups_ref(user_id, self.async_db)
+            .where('date', '>=', start_day).where('date', '<=', end_day)
+        )
+        docs = [doc async for doc in query.stream()]
+        self._record_reads(len(docs))
+        return {doc.id: doc.to_dict() for doc in docs}
+    
+    def _load_user_last_modified(self, user_id):
+        """各統計分片記錄的最後寫入時間取最大值；分片尚無紀錄時以最近修改的條目代替"""
+        shard_docs = list(self._statistics_shards_ref(user_id).stream())
+        self._record_reads(len(shard_docs))
+        
+        timestamps = [doc.to_dict().get('last_modified') for doc in shard_docs]
+        timestamps = [to_utc_naive(value) for value in timestamps if value]
+        if timestamps:
+            return max(timestamps)
+        
+        query = (
+            self.db.collection('line_users').document(user_id).collection('knowledge_base')
+            .order_by('last_modified', direction=firestore.Query.DESCENDING)
+            .select(['last_modified'])
+            .limit(1)
+        )
+        docs = list(query.stream())
+        self._record_reads(len(docs))
+        return to_utc_naive(docs[0].to_dict().get('last_modified')) if docs else None
+    
+    def _load_user_statistics(self, user_id):
+        """從統計計數器分片加總統計資料（錯誤時拋出例外，不寫入快取）"""
+        shard_docs = list(self._statistics_shards_ref(user_id).stream())
+        self._record_reads(len(shard_docs))
+        
+        # 尚未建立計數器或每日彙總的既有用戶，先以完整掃描回填（其他程序正在重建時本次讀取失敗，不寫入快取）
+        if not any(doc.to_dict().get('rollups_built') for doc in shard_docs):
+            if self.rebuild_user_statistics(user_id) is None:
+                raise RuntimeError("重建統計資料失敗或正在重建")
+            shard_docs = list(self._statistics_shards_ref(user_id).stream())
+            self._record_reads(len(shard_docs))
+        
+        return self._sum_statistics_shards(shard_docs)
+    
+    async def _load_user_statistics_async(self, user_id):
+        """以非同步用戶端讀取統計計數器分片（需回填時改以同步方式重建）"""
+        shard_docs = [doc async for doc in self._statistics_shards_ref(user_id, self.async_db).stream()]
+        self._record_reads(len(shard_docs))
+        
+        if not any(doc.to_dict().get('rollups_built') for doc in shard_docs):
+            return self._load_user_statistics(user_id)
+        return self._sum_statistics_shards(shard_docs)
+    
+    def _sum_statistics_shards(self, shard_docs):
+        """加總各統計計數器分片"""
+        total_knowledge = 0
+        bytes_stored = 0
+        category_counts = {}
+        file_type_counts = {}
+        for doc in shard_docs:
+            data = doc.to_dict()
+            total_knowledge += data.get('total_knowledge', 0)
+            bytes_stored += data.get('bytes_stored', 0)
+            for category, count in (data.get('categories') or {}).items():
+                category_counts[category] = category_counts.get(category, 0) + count
+            for file_type, count in (data.get('file_types') or {}).items():
+                file_type_counts[file_type] = file_type_counts.get(file_type, 0) + count
+        
+        return self._build_statistics(total_knowledge, bytes_stored, category_counts, file_type_counts)
\ No newline at end of file
@@ -1,28 +1,48 @@
-﻿from services.firebase_service import firebase_service
+﻿from services.storage import storage
+from services.search_index import search_index
+from services.passage_index import passage_index
+from config import Config
+from utils.pagination import encode_cursor, decode_cursor, decode_offset_cursor, clamp_page_size
+from datetime import datetime
+
+# 知識列表可回傳的欄位與其對應的資料庫欄位
+KNOWLEDGE_FIELD_SOURCES = {
+    'id': (),
+    'title': ('title',),
+    'category': ('category',),
+    'tags': ('tags',),
+    'upload_date': ('upload_date',),
+    'file_size': ('file_info.file_size',),
+    'file_type': ('file_info.file_type',),
+    'original_name': ('file_info.original_name',),
+    'content': ('content',)
+}
+
+# 未指定 fields 時回傳的欄位
+DEFAULT_LIST_FIELDS = ('id', 'title', 'category', 'tags', 'upload_date', 'file_size')
+
+# 接續延後提取的內容時，條目在讀取後被修改而重新合併的次數上限
+APPEND_ATTEMPTS = 3
 
 class KnowledgeService:
     def __init__(self):
-        self.firebase_service = firebase_service
+        self.storage = storage
+        self.search_index = search_index
+        self.passage_index = passage_index
     
-    def create_knowledge(self, user_id, title, category, tags, content, file_info=None):
-        """創建知識條目"""
+    def create_knowledge(self, user_id, title, category, tags, content, file_info=None, knowledge_id=None):
+        """創建知識條目（可指定條目 ID，該條目已存在時視為已建立）"""
         try:
             # 準備知識資料
-            knowledge_data = {
-                'title': title,
-                'category': category,
-                'tags': tags if isinstance(tags, list) else tags.split(','),
-                'content': content
-            }
-            
-            # 如果有文件資訊，加入到資料中
-            if file_info:
-                knowledge_data['file_info'] = file_info
+            knowledge_data = self._build_knowledge_data(title, category, tags, content, file_info)
             
             # 儲存到 Firebase
-            knowledge_id = self.firebase_service.create_knowledge_entry(user_id, knowledge_data)
+            knowledge_id = self.storage.create_knowledge_entry(user_id, knowledge_data, knowledge_id)
             
             if knowledge_id:
+                # 更新搜尋索引與段落索引
+                self.search_index.add_document(user_id, knowledge_id, knowledge_data)
+                self.passage_index.add_document(user_id, knowledge_id, knowledge_data)
                 return True, "知識條目創建成功", knowledge_id
             else:
                 return False, "知識條目創建失敗", None
@@ -30,43 +50,147 @@ class KnowledgeService:
         except Exception as e:
             return False, f"創建知識條目時發生錯誤: {str(e)}", None
     
-    def get_knowledge_list(self, user_id, category=None, search_term=None, limit=50):
-        """獲取知識列表"""
+    def create_knowledge_bulk(self, user_id, items):
+        """批量創建知識條目
+        
+        items 為包含 title、category、tags、content、file_info 的字典列表，
+        回傳與輸入順序相同的 (success, message, knowledge_id) 列表。
+        """
         try:
-            # 從 Firebase 獲取知識列表
-            knowledge_list = self.firebase_service.get_knowledge_list(user_id, category, limit)
+            knowledge_items = [
+                self._build_knowledge_data(
+                    item['title'],
+                    item.get('category', '未分類'),
+                    item.get('tags', []),
+                    item['content'],
+                    item.get('file_info')
+                )
+                for item in items
+            ]
             
-            # 如果有搜尋條件，進行篩選
-            if search_term:
-                filtered_list = []
-                search_term = search_term.lower()
-                
-                for knowledge in knowledge_list:
-                    # 在標題、內容、標籤中搜尋
-                    if (search_term in knowledge.get('title', '').lower() or
-                        search_term in knowledge.get('content', '').lower() or
-                        any(search_term in tag.lower() for tag in knowledge.get('tags', []))):
-                        filtered_list.append(knowledge)
+            knowledge_ids = self.storage.create_knowledge_entries(user_id, knowledge_items)
+            
+            results = []
+            indexed_documents = []
+            for knowledge_data, knowledge_id in zip(knowledge_items, knowledge_ids):
+                if knowledge_id:
+                    indexed_documents.append((knowledge_id, knowledge_data))
+                    results.append((True, "知識條目創建成功", knowledge_id))
+                else:
+                    results.append((False, "知識條目創建失敗", None))
+            
+            # 更新搜尋索引與段落索引
+            if indexed_documents:
+                self.search_index.add_documents(user_id, indexed_documents)
+                self.passage_index.add_documents(user_id, indexed_documents)
+            
+            return results
+            
+        except Exception as e:
+            return [(False, f"創建知識條目時發生錯誤: {str(e)}", None)] * len(items)
+    
+    def _build_knowledge_data(self, title, category, tags, content, file_info=None):
+        """準備知識資料"""
+        knowledge_data = {
+            'title': title,
+            'category': category,
+            'tags': tags if isinstance(tags, list) else tags.split(','),
+            'content': content
+        }
+        
+        # 如果有文件資訊，加入到資料中
+        if file_info:
+            knowledge_data['file_info'] = file_info
+        
+        return knowledge_data
+    
+    def find_duplicate(self, user_id, content_hash):
+        """尋找內容相同的既有知識條目"""
+        try:
+            knowledge_id = self.storage.find_knowledge_by_hash(user_id, content_hash)
+            
+            if knowledge_id:
+                return True, "文件已存在", knowledge_id
+            else:
+                return False, "沒有重複文件", None
                 
-                knowledge_list = filtered_list
+        except Exception as e:
+            return False, f"查詢重複文件時發生錯誤: {str(e)}", None
+    
+    def parse_fields(self, fields_param):
+        """解析 fields 參數（以逗號分隔的欄位名稱），回傳 (success, message, fields)"""
+        if not fields_param:
+            return True, "使用預設欄位", DEFAULT_LIST_FIELDS
+        
+        fields = []
+        for field in fields_param.split(','):
+            field = field.strip()
+            if not field or field in fields:
+                continue
+            if field not in KNOWLEDGE_FIELD_SOURCES:
+                return False, f"不支援的欄位: {field}。可用欄位: {', '.join(KNOWLEDGE_FIELD_SOURCES)}", None
+            fields.append(field)
+        
+        if not fields:
+            return True, "使用預設欄位", DEFAULT_LIST_FIELDS
+        return True, "欄位解析成功", tuple(fields)
+    
+    def _source_fields(self, fields):
+        """回傳欄位所需讀取的資料庫欄位"""
+        source_fields = []
+        for field in fields:
+            for source_field in KNOWLEDGE_FIELD_SOURCES[field]:
+                if source_field not in source_fields:
+                    source_fields.append(source_field)
+        return source_fields
+    
+    def get_knowledge_list(self, user_id, category=None, search_term=None, limit=50, fields=None):
+        """獲取知識列表（fields 指定回傳欄位，只從資料庫讀取所需欄位）"""
+        success, message, page = self.get_knowledge_page(user_id, category, search_term, limit, fields)
+        return success, message, page['items'] if success else []
+    
+    def get_knowledge_page(self, user_id, category=None, search_term=None, limit=50, fields=None, cursor=None):
+        """分頁獲取知識列表，回傳資料為 {'items': [...], 'next_cursor': ...}
+        
+        cursor 為上一頁回傳的 next_cursor，格式錯誤時拋出 ValueError。
+        """
+        # 有搜尋條件時改由倒排索引查詢
+        if search_term:
+            return self.search_knowledge_page(user_id, search_term, category, limit, fields, cursor)
+        
+        position = self._decode_list_cursor(cursor)
+        try:
+            fields = fields or DEFAULT_LIST_FIELDS
+            
+            # 從儲存後端獲取一頁知識列表
+            knowledge_list, next_position = self.storage.get_knowledge_page(
+                user_id, category, clamp_page_size(limit), position, fields=self._source_fields(fields)
+            )
             
             # 格式化回傳資料
-            formatted_list = []
-            for knowledge in knowledge_list:
-                formatted_item = {
-                    'id': knowledge['id'],
-                    'title': knowledge.get('title', '未命名'),
-                    'category': knowledge.get('category', '未分類'),
-                    'tags': knowledge.get('tags', []),
-                    'upload_date': knowledge.get('upload_date', '').strftime('%Y-%m-%d') if knowledge.get('upload_date') else '',
-                    'file_size': self._format_file_size(knowledge.get('file_info', {}).get('file_size', 0))
-                }
-                formatted_list.append(formatted_item)
+            formatted_list = [self._format_knowledge(knowledge, fields) for knowledge in knowledge_list]
             
-            return True, "獲取知識列表成功", formatted_list
+            return True, "獲取知識列表成功", {
+                'items': formatted_list,
+                'next_cursor': self._encode_list_cursor(next_position)
+            }
             
         except Exception as e:
-            return False, f"獲取知識列表時發生錯誤: {str(e)}", []
+            return False, f"獲取知識列表時發生錯誤: {str(e)}", None
+    
+    def _encode_list_cursor(self, position):
+        if position is None or position.get('upload_date') is None:
+            return None
+        return encode_cursor({'upload_date': position['upload_date'].isoformat(), 'id': position['id']})
+    
+    def _decode_list_cursor(self, cursor):
+        if not cursor:
+            return None
+        
+        values = decode_cursor(cursor)
+        if not isinstance(values.get('upload_date'), str) or not isinstance(values.get('id'), str):
+            raise ValueError('無效的分頁游標')
+        return {'upload_date': datetime.fromisoformat(values['upload_date']), 'id': values['id']}
     
     def update_knowledge(self, user_id, knowledge_id, updates):
         """更新知識條目"""
@@ -75,9 +199,10 @@ class KnowledgeService:
             if 'tags' in updates and isinstance(updates['tags'], str):
                 updates['tags'] = updates['tags'].split(',')
             
-            success = self.firebase_service.update_knowledge_entry(user_id, knowledge_id, updates)
+            success = self.storage.update_knowledge_entry(user_id, knowledge_id, updates)
             
             if success:
+                self._reindex(user_id, knowledge_id)
                 return True, "知識條目更新成功"
             else:
                 return False, "知識條目更新失敗"
@@ -85,12 +210,77 @@ class KnowledgeService:
         except Exception as e:
             return False, f"更新知識條目時發生錯誤: {str(e)}"
     
+    def _reindex(self, user_id, knowledge_id):
+        """以更新後的完整條目重建索引"""
+        knowledge = self.storage.get_knowledge_entry(user_id, knowledge_id)
+        if knowledge:
+            self.search_index.add_document(user_id, knowledge_id, knowledge)
+            self.passage_index.add_document(user_id, knowledge_id, knowledge)
+    
+    def append_extracted_content(self, user_id, knowledge_id, content, page_offsets=None):
+        """將延後提取的文件內容接續至知識條目，並將提取狀態標記為完成（page_offsets 為接續內容的各頁起始位置）
+        
+        可重複呼叫：提取狀態已為完成（如 worker 在寫入後、標記任務完成前結束而重新處理）時
+        不再接續。寫入以讀取時的 last_modified 為條件，期間條目被修改（如用戶編輯）時
+        重新讀取並合併，不會覆蓋其他更新。
+        """
+        try:
+            for _ in range(APPEND_ATTEMPTS):
+                knowledge = self.storage.get_knowledge_entry(user_id, knowledge_id)
+                if not knowledge:
+                    return False, "知識條目不存在"
+                
+                updates = self._appended_content_updates(knowledge, content, page_offsets)
+                if updates is None:
+                    return True, "內容已接續"
+                
+                if self.storage.update_knowledge_entry(
+                    user_id, knowledge_id, updates, expected_last_modified=knowledge.get('last_modified')
+                ):
+                    self._reindex(user_id, knowledge_id)
+                    return True, "知識條目更新成功"
+            
+            return False, "知識條目更新失敗"
+            
+        except Exception as e:
+            return False, f"更新知識條目時發生錯誤: {str(e)}"
+    
+    def _appended_content_updates(self, knowledge, content, page_offsets):
+        """計算接續內容後的 content 與 file_info 更新；提取狀態已為完成時回傳 None"""
+        file_info = dict(knowledge.get('file_info') or {})
+        extraction = dict(file_info.get('extraction') or {})
+        if extraction.get('status') == 'complete':
+            return None
+        
+        extraction.update({
+            'status': 'complete',
+            'pages_extracted': extraction.get('page_count', extraction.get('pages_extracted'))
+        })
+        file_info['extraction'] = extraction
+        
+        existing_content = knowledge.get('content') or ''
+        merged_content = '\n'.join(part for part in (existing_content, content) if part)
+        # 接續頁面的起始位置平移至合併後的內容；既有內容沒有頁碼資訊時不記錄
+        if page_offsets is not None and (file_info.get('page_offsets') is not None or not existing_content):
+            shift = len(existing_content) + 1 if existing_content and content else len(existing_content)
+            file_info['page_offsets'] = list(file_info.get('page_offsets') or []) + [
+                min(offset + shift, len(merged_content)) for offset in page_offsets
+            ]
+        else:
+            file_info.pop('page_offsets', None)
+        return {
+            'content': merged_content,
+            'file_info': file_info
+        }
+    
     def delete_knowledge(self, user_id, knowledge_id):
         """刪除知識條目"""
         try:
-            success = self.firebase_service.delete_knowledge_entry(user_id, knowledge_id)
+            success = self.storage.delete_knowledge_entry(user_id, knowledge_id)
             
             if success:
+                self.search_index.remove_document(user_id, knowledge_id)
+                self.passage_index.remove_document(user_id, knowledge_id)
                 return True, "知識條目刪除成功"
             else:
                 return False, "知識條目刪除失敗"
@@ -98,28 +288,216 @@ class KnowledgeService:
         except Exception as e:
             return False, f"刪除知識條目時發生錯誤: {str(e)}"
     
-    def search_knowledge(self, user_id, query):
-        """搜尋知識內容"""
+    def resolve_bulk_targets(self, user_id, knowledge_ids=None, category=None):
+        """決定批量操作的條目：指定的條目 ID 列表，或分類中的所有條目
+        
+        回傳 (success, message, 條目 ID 列表)；重複的 ID 只保留一次，
+        條目數超過 BULK_MAX_ENTRIES 或讀取分類條目失敗時回傳失敗（不以部分條目執行）。
+        依分類選取時包含沒有上傳日期的條目。
+        """
+        if (knowledge_ids is None) == (not category):
+            return False, "請提供條目 ID 列表（ids）或分類篩選條件（category）其中之一", []
+        
+        if knowledge_ids is not None:
+            if not isinstance(knowledge_ids, list) or not all(isinstance(knowledge_id, str) and knowledge_id for knowledge_id in knowledge_ids):
+                return False, "ids 必須為條目 ID 字串列表", []
+            knowledge_ids = list(dict.fromkeys(knowledge_ids))
+        else:
+            knowledge_ids = []
+            try:
+                for knowledge in self.storage.stream_knowledge_entries(user_id, fields=('category',), category=category):
+                    knowledge_ids.append(knowledge['id'])
+                    if len(knowledge_ids) > Config.BULK_MAX_ENTRIES:
+                        break
+            except Exception as e:
+                return False, f"讀取分類條目時發生錯誤: {str(e)}", []
+        
+        if len(knowledge_ids) > Config.BULK_MAX_ENTRIES:
+            return False, f"一次最多處理 {Config.BULK_MAX_ENTRIES} 筆知識條目", []
+        return True, f"共 {len(knowledge_ids)} 筆知識條目", knowledge_ids
+    
+    def bulk_update_knowledge(self, user_id, knowledge_ids, updates):
+        """將相同的更新套用到多筆知識條目，回傳與輸入順序相同的 (success, message, knowledge_id) 列表"""
         try:
-            return self.get_knowledge_list(user_id, search_term=query)
+            # 處理標籤格式
+            if 'tags' in updates and isinstance(updates['tags'], str):
+                updates['tags'] = updates['tags'].split(',')
+            
+            updated, missing = self.storage.update_knowledge_entries(user_id, knowledge_ids, updates)
+            
+            # 以更新後的完整條目更新索引（整批視為一次寫入）
+            if updated:
+                documents = list(updated.items())
+                self.search_index.add_documents(user_id, documents)
+                self.passage_index.add_documents(user_id, documents)
+            
+            return self._bulk_results(knowledge_ids, updated, missing, "知識條目更新成功", "知識條目更新失敗")
+            
         except Exception as e:
-            return False, f"搜尋知識時發生錯誤: {str(e)}", []
+            return [(False, f"更新知識條目時發生錯誤: {str(e)}", knowledge_id) for knowledge_id in knowledge_ids]
+    
+    def bulk_delete_knowledge(self, user_id, knowledge_ids):
+        """刪除多筆知識條目，回傳與輸入順序相同的 (success, message, knowledge_id) 列表"""
+        try:
+            deleted, missing = self.storage.delete_knowledge_entries(user_id, knowledge_ids)
+            
+            if deleted:
+                self.search_index.remove_documents(user_id, deleted)
+                self.passage_index.remove_documents(user_id, deleted)
+            
+            return self._bulk_results(knowledge_ids, set(deleted), missing, "知識條目刪除成功", "知識條目刪除失敗")
+            
+        except Exception as e:
+            return [(False, f"刪除知識條目時發生錯誤: {str(e)}", knowledge_id) for knowledge_id in knowledge_ids]
+    
+    def _bulk_results(self, knowledge_ids, succeeded, missing, success_message, failure_message):
+        """依輸入順序組合批量操作各條目的結果"""
+        missing = set(missing)
+        results = []
+        for knowledge_id in knowledge_ids:
+            if knowledge_id in succeeded:
+                results.append((True, success_message, knowledge_id))
+            elif knowledge_id in missing:
+                results.append((False, "知識條目不存在", knowledge_id))
+            else:
+                results.append((False, failure_message, knowledge_id))
+        return results
+    
+    def search_knowledge(self, user_id, query, category=None, limit=50, fields=None):
+        """搜尋知識內容（倒排索引或後端全文搜尋，依 BM25 分數排序）"""
+        success, message, page = self.search_knowledge_page(user_id, query, category, limit, fields)
+        return success, message, page['items'] if success else []
+    
+    def search_knowledge_page(self, user_id, query, category=None, limit=50, fields=None, cursor=None):
+        """分頁搜尋知識內容，回傳資料為 {'items': [...], 'next_cursor': ...}"""
+        offset = decode_offset_cursor(cursor)
+        try:
+            fields = fields or DEFAULT_LIST_FIELDS
+            limit = clamp_page_size(limit)
+            
+            # 多取一筆以判斷是否還有下一頁；後端提供全文搜尋時直接由資料庫查詢
+            if self.storage.supports_full_text_search:
+                results = self.storage.search_knowledge_entries(user_id, query, category=category, limit=offset + limit + 1)
+            else:
+                results = self.search_index.search(user_id, query, category=category, limit=offset + limit + 1)
+            has_more = len(results) > offset + limit
+            results = results[offset:offset + limit]
+            
+            # 索引只保存中繼資料，要求內容時再讀取命中條目的內容欄位
+            contents = {}
+            if 'content' in fields and results:
+                contents = self.storage.get_knowledge_entries(
+                    user_id, [knowledge_id for knowledge_id, _, _ in results], fields=['content']
+                )
+            
+            formatted_list = []
+            for knowledge_id, score, knowledge in results:
+                knowledge['id'] = knowledge_id
+                if knowledge_id in contents:
+                    knowledge['content'] = contents[knowledge_id].get('content')
+                formatted_item = self._format_knowledge(knowledge, fields)
+                formatted_item['score'] = round(score, 4)
+                formatted_list.append(formatted_item)
+            
+            return True, "搜尋知識成功", {
+                'items': formatted_list,
+                'next_cursor': encode_cursor({'offset': offset + limit}) if has_more else None
+            }
+        except Exception as e:
+            return False, f"搜尋知識時發生錯誤: {str(e)}", None
+    
+    def retrieve_passages(self, user_id, query, k=5, category=None):
+        """檢索與查詢最相關的段落（TF-IDF 餘弦相似度），回傳段落文字、所屬條目與分數"""
+        try:
+            k = max(1, min(int(k), Config.RETRIEVE_MAX_K))
+            results = self.passage_index.retrieve(user_id, query, k=k, category=category)
+            
+            # 索引只保存段落位置，所有段落的內容以一次批量讀取取得
+            texts = self.storage.read_knowledge_passages(
+                user_id, [(knowledge_id, start, end) for knowledge_id, (start, end), _, _ in results]
+            )
+            passages = []
+            for (knowledge_id, (start, end), score, metadata), text in zip(results, texts):
+                passages.append({
+                    'knowledge_id': knowledge_id,
+                    'title': metadata.get('title'),
+                    'category': metadata.get('category'),
+                    'text': (text or '').strip(),
+                    'start': start,
+                    'end': end,
+                    'score': round(score, 4)
+                })
+            
+            return True, "段落檢索成功", passages
+            
+        except Exception as e:
+            return False, f"檢索段落時發生錯誤: {str(e)}", []
+    
+    def read_knowledge_content(self, user_id, knowledge_id, start=None, end=None, page=None, end_page=None):
+        """讀取知識條目內容的一段（字元或頁碼範圍，單次最多 CONTENT_RANGE_MAX_CHARS 字元）
+        
+        回傳內容片段與所在位置，條目不存在時回傳 None；範圍無效時拋出 ValueError。
+        """
+        return self.storage.read_knowledge_content(
+            user_id, knowledge_id, start=start, end=end, page=page, end_page=end_page,
+            max_chars=Config.CONTENT_RANGE_MAX_CHARS
+        )
     
     def get_all_categories(self, user_id):
         """獲取所有分類"""
         try:
-            knowledge_list = self.firebase_service.get_knowledge_list(user_id, limit=1000)
-            categories = set()
+            categories = self._load_categories(user_id)
             
-            for knowledge in knowledge_list:
-                if 'category' in knowledge and knowledge['category']:
-                    categories.add(knowledge['category'])
+            if categories is None:
+                return False, "無法獲取分類", []
             
-            return True, "獲取分類成功", list(categories)
+            return True, "獲取分類成功", categories
             
         except Exception as e:
             return False, f"獲取分類時發生錯誤: {str(e)}", []
     
+    def get_categories_page(self, user_id, limit=50, cursor=None):
+        """分頁獲取分類，回傳資料為 {'items': [...], 'next_cursor': ...}"""
+        offset = decode_offset_cursor(cursor)
+        try:
+            categories = self._load_categories(user_id)
+            
+            if categories is None:
+                return False, "無法獲取分類", None
+            
+            limit = clamp_page_size(limit)
+            has_more = len(categories) > offset + limit
+            return True, "獲取分類成功", {
+                'items': categories[offset:offset + limit],
+                'next_cursor': encode_cursor({'offset': offset + limit}) if has_more else None
+            }
+            
+        except Exception as e:
+            return False, f"獲取分類時發生錯誤: {str(e)}", None
+    
+    def _load_categories(self, user_id):
+        """從統計計數器取得分類（依名稱排序），不需掃描知識條目"""
+        statistics = self.storage.get_user_statistics(user_id)
+        if statistics is None:
+            return None
+        return sorted(statistics.get('category_counts', {}))
+    
+    def _format_knowledge(self, knowledge, fields=None):
+        """格式化知識條目（只輸出 fields 指定的欄位）"""
+        file_info = knowledge.get('file_info') or {}
+        formatters = {
+            'id': lambda: knowledge['id'],
+            'title': lambda: knowledge.get('title', '未命名'),
+            'category': lambda: knowledge.get('category', '未分類'),
+            'tags': lambda: knowledge.get('tags', []),
+            'upload_date': lambda: knowledge.get('upload_date', '').strftime('%Y-%m-%d') if knowledge.get('upload_date') else '',
+            'file_size': lambda: self._format_file_size(file_info.get('file_size', 0)),
+            'file_type': lambda: file_info.get('file_type', ''),
+            'original_name': lambda: file_info.get('original_name', ''),
+            'content': lambda: knowledge.get('content', '')
+        }
+        return {field: formatters[field]() for field in fields or DEFAULT_LIST_FIELDS}
+    
     def _format_file_size(self, size_bytes):
         """格式化文件大小"""
         if size_bytes == 0:
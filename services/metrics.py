@@ -0,0 +1,230 @@
+﻿import os
+import json
+import uuid
+import fcntl
+import time
+import atexit
+import threading
+from config import Config
+
+# 請求延遲分桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 每個請求的文件讀取數分桶
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+# 指標定義：名稱 -> (類型, 說明, 分桶)
+METRICS = {
+    'http_requests_total': ('counter', 'HTTP 請求數', None),
+    'http_request_duration_seconds': ('histogram', 'HTTP 請求處理時間（秒）', LATENCY_BUCKETS),
+    'http_request_storage_reads': ('histogram', '每個請求讀取的儲存文件數', COUNT_BUCKETS),
+    'storage_documents_read_total': ('counter', '讀取的儲存文件數', None),
+    'storage_documents_written_total': ('counter', '寫入的儲存文件數', None),
+    'storage_round_trips_total': ('counter', '儲存後端往返次數', None),
+    'storage_operation_duration_seconds': ('histogram', '儲存後端操作時間（秒）', LATENCY_BUCKETS),
+    'extraction_duration_seconds': ('histogram', '文件文字提取時間（秒）', LATENCY_BUCKETS),
+    'extraction_failures_total': ('counter', '文件文字提取失敗數', None),
+    'admission_requests_total': ('counter', '准入控制判定次數（依類別與結果）', None),
+    'admission_bytes_total': ('counter', '准入控制計入額度的位元組數', None)
+}
+
+class MetricsRegistry:
+    """程序內指標與跨程序彙總
+    
+    每個程序在記憶體中累計計數器與直方圖，並定期寫入 metrics_dir 下以
+    程序 ID 命名的檔案；輸出時合併目錄中所有檔案，使多個 gunicorn worker
+    的指標可由任一 worker 的 /metrics 取得。已結束程序的檔案會併入封存檔，
+    計數器不會因 worker 重啟而減少。未指定 metrics_dir 時只輸出本程序的指標。
+    """
+    
+    def __init__(self, metrics_dir=None, flush_interval=5.0):
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reset()
+        atexit.register(self.flush, force=True)
+    
+    def _reset(self):
+        # (名稱, 標籤) -> 數值；直方圖為 [各分桶計數..., 總和, 次數]
+        self._values = {}
+        self._token = uuid.uuid4().hex[:8]
+        self._last_flush = time.monotonic()
+        self._pid = os.getpid()
+    
+    def _check_fork(self):
+        """fork 後子程序不沿用父程序累計的數值"""
+        if self._pid != os.getpid():
+            self._reset()
+    
+    def _key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+    
+    def inc(self, name, labels=None, value=1):
+        """計數器遞增"""
+        with self._lock:
+            self._check_fork()
+            key = self._key(name, labels)
+            self._values[key] = self._values.get(key, 0) + value
+    
+    def observe(self, name, value, labels=None):
+        """記錄直方圖觀測值"""
+        buckets = METRICS[name][2]
+        with self._lock:
+            self._check_fork()
+            key = self._key(name, labels)
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [0] * (len(buckets) + 1) + [0.0, 0]
+            
+            index = len(buckets)
+            for bucket_index, bound in enumerate(buckets):
+                if value <= bound:
+                    index = bucket_index
+                    break
+            histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+    
+    def _serialize(self):
+        return [[name, list(labels), value] for (name, labels), value in self._values.items()]
+    
+    def _file_path(self):
+        return os.path.join(self.metrics_dir, f"metrics-{self._pid}-{self._token}.json")
+    
+    def flush(self, force=False):
+        """將本程序的指標寫入檔案（距上次寫入未達 flush_interval 時略過）"""
+        if not self.metrics_dir:
+            return
+        
+        with self._lock:
+            self._check_fork()
+            if not force and time.monotonic() - self._last_flush < self.flush_interval:
+                return
+            self._last_flush = time.monotonic()
+            payload = self._serialize()
+            path = self._file_path()
+        
+        try:
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as metrics_file:
+                json.dump(payload, metrics_file)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"寫入指標檔案錯誤: {e}")
+    
+    def _merge(self, merged, entries):
+        for name, labels, value in entries:
+            key = (name, tuple(tuple(label) for label in labels))
+            if name not in METRICS:
+                continue
+            if isinstance(value, list):
+                existing = merged.get(key)
+                merged[key] = [a + b for a, b in zip(existing, value)] if existing else list(value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    
+    def _is_process_alive(self, pid):
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+    
+    def _read_file(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as metrics_file:
+                return json.load(metrics_file)
+        except (OSError, ValueError):
+            return []
+    
+    def collect(self):
+        """合併所有程序的指標，回傳 {(名稱, 標籤): 數值}"""
+        self.flush(force=True)
+        
+        merged = {}
+        if not self.metrics_dir:
+            with self._lock:
+                self._merge(merged, self._serialize())
+            return merged
+        
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        archive_path = os.path.join(self.metrics_dir, 'archive.json')
+        with open(os.path.join(self.metrics_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                archived = {}
+                self._merge(archived, self._read_file(archive_path))
+                archived_changed = False
+                
+                for filename in os.listdir(self.metrics_dir):
+                    if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                        continue
+                    path = os.path.join(self.metrics_dir, filename)
+                    entries = self._read_file(path)
+                    
+                    pid = int(filename.split('-')[1])
+                    if self._is_process_alive(pid):
+                        self._merge(merged, entries)
+                    else:
+                        # 已結束程序的指標併入封存檔
+                        self._merge(archived, entries)
+                        archived_changed = True
+                        os.remove(path)
+                
+                if archived_changed:
+                    temp_path = f"{archive_path}.tmp"
+                    with open(temp_path, 'w', encoding='utf-8') as archive_file:
+                        json.dump([[name, list(labels), value] for (name, labels), value in archived.items()], archive_file)
+                    os.replace(temp_path, archive_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        
+        for (name, labels), value in archived.items():
+            self._merge(merged, [[name, labels, value]])
+        return merged
+    
+    def render(self):
+        """以 Prometheus 文字格式輸出所有程序的指標"""
+        merged = self.collect()
+        lines = []
+        for name, (metric_type, description, buckets) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            
+            for (metric_name, labels), value in sorted(merged.items()):
+                if metric_name != name:
+                    continue
+                
+                if metric_type == 'counter':
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value[:-2]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-2])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+        
+        return '\n'.join(lines) + '\n'
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# 創建全域實例
+metrics = MetricsRegistry(Config.METRICS_DIR, Config.METRICS_FLUSH_INTERVAL)
@@ -0,0 +1,311 @@
+﻿import math
+import threading
+from functools import partial
+from config import Config
+from services.storage import storage
+from services.read_cache import cache_generations
+from services.search_index import SearchIndexManager, VERSION_FIELDS
+from utils.lazy_import import lazy_import
+from utils.passage_splitter import split_passages
+from utils.text_tokenizer import TermLookup, tokenize
+
+np = lazy_import('numpy')
+
+# 建立段落索引時從資料庫讀取的欄位
+PASSAGE_FIELDS = ('title', 'category', 'content')
+
+
+class UserPassageIndex:
+    """單一用戶的段落 TF-IDF 索引（稀疏矩陣，餘弦相似度排序）
+    
+    每個知識條目的內容切分為重疊段落，段落向量採 lnc.ltc 權重：段落詞頻取
+    1 + log(tf) 並做長度正規化，IDF 只在查詢時套用，因此新增或刪除段落不需
+    重新計算其他段落的權重。
+    
+    段落詞彙矩陣分為兩部分：以 CSC 格式（每個詞彙一段連續的段落編號與權重
+    陣列）保存的主矩陣，以及新寫入段落的增量區。查詢時兩部分分別以向量化
+    運算累加分數；增量區超過 delta_limit 或已刪除段落過多時合併回主矩陣。
+    
+    單一 CJK 字元與拉丁字母前綴的查詢詞彙經由 TermLookup 展開，段落對該查詢詞彙
+    的權重取展開詞彙中的最大值。
+    """
+    
+    def __init__(self, passage_chars=500, passage_overlap=100, delta_limit=256):
+        self.passage_chars = passage_chars
+        self.passage_overlap = passage_overlap
+        self.delta_limit = delta_limit
+        # 主矩陣：詞彙 -> 欄位編號；欄位 i 的段落為 indices[indptr[i]:indptr[i + 1]]
+        self.vocabulary = {}
+        self.indptr = None
+        self.indices = None
+        self.data = None
+        # 增量區：詞彙 -> ([段落編號], [權重])
+        self.delta = {}
+        self.delta_passages = 0
+        # 曾出現的詞彙（合併時不移除，查詢時以主矩陣與增量區過濾）
+        self.terms = TermLookup()
+        # 段落資訊（編號即為列表索引）與仍有效的段落標記
+        self.passage_docs = []
+        self.passage_spans = []
+        self.alive = bytearray()
+        self.removed_passages = 0
+        # 條目 ID -> 段落編號列表 / 中繼資料
+        self.doc_passages = {}
+        self.documents = {}
+        # 建立索引時的用戶資料版本號
+        self.generation = 0
+        self._lock = threading.RLock()
+    
+    def __len__(self):
+        return len(self.documents)
+    
+    @property
+    def passage_count(self):
+        return len(self.passage_docs) - self.removed_passages
+    
+    def _passage_vectors(self, content):
+        """切分段落並計算各段落的正規化詞彙權重，回傳 [(段落範圍, {詞彙: 權重})]"""
+        vectors = []
+        for start, end in split_passages(content, self.passage_chars, self.passage_overlap):
+            counts = {}
+            for token in tokenize(content[start:end]):
+                counts[token] = counts.get(token, 0) + 1
+            if not counts:
+                continue
+            
+            weights = {token: 1.0 + math.log(count) for token, count in counts.items()}
+            norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+            vectors.append(((start, end), {token: weight / norm for token, weight in weights.items()}))
+        return vectors
+    
+    def add_document(self, doc_id, data):
+        """加入或取代文件的所有段落"""
+        content = data.get('content') or ''
+        if not isinstance(content, str):
+            content = ''
+        vectors = self._passage_vectors(content)
+        
+        with self._lock:
+            self._remove(doc_id)
+            passage_ids = []
+            for span, weights in vectors:
+                passage_id = len(self.passage_docs)
+                self.passage_docs.append(doc_id)
+                self.passage_spans.append(span)
+                self.alive.append(1)
+                for token, weight in weights.items():
+                    entry = self.delta.get(token)
+                    if entry is None:
+                        entry = self.delta[token] = ([], [])
+                        if token not in self.vocabulary:
+                            self.terms.add(token)
+                    entry[0].append(passage_id)
+                    entry[1].append(weight)
+                passage_ids.append(passage_id)
+            
+            self.delta_passages += len(passage_ids)
+            self.doc_passages[doc_id] = passage_ids
+            self.documents[doc_id] = {'title': data.get('title'), 'category': data.get('category')}
+    
+    def remove_document(self, doc_id):
+        """移除文件的所有段落"""
+        with self._lock:
+            self._remove(doc_id)
+    
+    def _remove(self, doc_id):
+        passage_ids = self.doc_passages.pop(doc_id, None)
+        if passage_ids is None:
+            return
+        
+        for passage_id in passage_ids:
+            self.alive[passage_id] = 0
+        self.removed_passages += len(passage_ids)
+        self.documents.pop(doc_id, None)
+    
+    def _needs_compaction(self):
+        total = len(self.passage_docs)
+        return self.delta_passages > self.delta_limit or (total and self.removed_passages > total // 4)
+    
+    def compact(self):
+        """將增量區與主矩陣合併，並移除已刪除的段落與不再出現的詞彙"""
+        with self._lock:
+            alive = np.frombuffer(bytes(self.alive), dtype=np.uint8).astype(bool)
+            # 段落重新編號（只保留有效段落）
+            new_ids = np.cumsum(alive, dtype=np.int64) - 1
+            
+            terms = list(self.vocabulary)
+            columns = [np.empty(0, dtype=np.int64)]
+            rows = [np.empty(0, dtype=np.int64)]
+            values = [np.empty(0, dtype=np.float32)]
+            if self.indptr is not None:
+                columns.append(np.repeat(np.arange(len(terms), dtype=np.int64), np.diff(self.indptr)))
+                rows.append(self.indices.astype(np.int64))
+                values.append(self.data)
+            
+            term_columns = dict(self.vocabulary)
+            for token, (passage_ids, weights) in self.delta.items():
+                column = term_columns.get(token)
+                if column is None:
+                    column = term_columns[token] = len(terms)
+                    terms.append(token)
+                columns.append(np.full(len(passage_ids), column, dtype=np.int64))
+                rows.append(np.asarray(passage_ids, dtype=np.int64))
+                values.append(np.asarray(weights, dtype=np.float32))
+            
+            columns = np.concatenate(columns)
+            rows = np.concatenate(rows)
+            values = np.concatenate(values)
+            keep = alive[rows] if len(rows) else np.zeros(0, dtype=bool)
+            columns, rows, values = columns[keep], new_ids[rows[keep]], values[keep]
+            
+            # 依詞彙欄位排序（欄位內維持段落編號順序），並移除已無段落的詞彙
+            order = np.lexsort((rows, columns))
+            columns, rows, values = columns[order], rows[order], values[order]
+            counts = np.bincount(columns, minlength=len(terms))
+            used = np.flatnonzero(counts)
+            
+            self.vocabulary = {terms[column]: index for index, column in enumerate(used.tolist())}
+            self.indptr = np.concatenate(([0], np.cumsum(counts[used]))).astype(np.int64)
+            self.indices = rows.astype(np.int32)
+            self.data = values.astype(np.float32)
+            
+            live_ids = np.flatnonzero(alive).tolist()
+            self.passage_docs = [self.passage_docs[passage_id] for passage_id in live_ids]
+            self.passage_spans = [self.passage_spans[passage_id] for passage_id in live_ids]
+            self.alive = bytearray(b'\x01' * len(live_ids))
+            self.removed_passages = 0
+            self.delta = {}
+            self.delta_passages = 0
+            
+            self.doc_passages = {}
+            for passage_id, doc_id in enumerate(self.passage_docs):
+                self.doc_passages.setdefault(doc_id, []).append(passage_id)
+    
+    def _term_df(self, term):
+        """詞彙出現的段落數（已壓縮的矩陣與尚未壓縮的增量合計）"""
+        column = self.vocabulary.get(term)
+        delta_entry = self.delta.get(term)
+        term_df = int(self.indptr[column + 1] - self.indptr[column]) if column is not None else 0
+        return term_df + (len(delta_entry[0]) if delta_entry else 0)
+    
+    def retrieve(self, query, k=5, category=None):
+        """檢索與查詢最相關的段落，回傳依分數排序的 [(doc_id, (起始位置, 結束位置), score, metadata)]
+        
+        同一條目中互相重疊的段落只保留分數最高者。
+        """
+        query_counts = {}
+        for token in tokenize(query):
+            query_counts[token] = query_counts.get(token, 0) + 1
+        if not query_counts or k <= 0:
+            return []
+        
+        with self._lock:
+            if self._needs_compaction():
+                self.compact()
+            
+            passage_total = len(self.passage_docs)
+            live_passages = self.passage_count
+            if live_passages == 0:
+                return []
+            
+            # 查詢向量：1 + log(tf) 乘以 IDF 後正規化（展開詞彙的段落數相加，至多為全部段落）
+            query_terms = []
+            for token, count in query_counts.items():
+                sources = []
+                df = 0
+                for term in self.terms.expand(token, frequency=self._term_df):
+                    term_df = self._term_df(term)
+                    if term_df:
+                        sources.append((self.vocabulary.get(term), self.delta.get(term)))
+                        df += term_df
+                if df == 0:
+                    continue
+                idf = math.log((live_passages + 1) / (min(df, live_passages) + 1)) + 1.0
+                query_terms.append((sources, (1.0 + math.log(count)) * idf))
+            if not query_terms:
+                return []
+            
+            query_norm = math.sqrt(sum(weight * weight for _, weight in query_terms))
+            scores = np.zeros(passage_total, dtype=np.float32)
+            for sources, weight in query_terms:
+                weight /= query_norm
+                if len(sources) == 1:
+                    self._accumulate(scores, sources[0], weight, np.add)
+                else:
+                    term_scores = np.zeros(passage_total, dtype=np.float32)
+                    for source in sources:
+                        self._accumulate(term_scores, source, 1.0, np.maximum)
+                    scores += weight * term_scores
+            
+            if self.removed_passages:
+                scores[np.frombuffer(bytes(self.alive), dtype=np.uint8) == 0] = 0
+            
+            candidates = np.flatnonzero(scores > 0)
+            # 先只排序分數最高的部分段落；略過重疊段落或其他分類後不足 k 筆時再排序全部
+            limit = min(len(candidates), k * 4)
+            while True:
+                if limit < len(candidates):
+                    top = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+                else:
+                    top = candidates
+                top = top[np.argsort(-scores[top], kind='stable')]
+                results = self._select(top.tolist(), scores, k, category)
+                if len(results) >= k or limit >= len(candidates):
+                    return results
+                limit = len(candidates)
+    
+    def _accumulate(self, scores, source, weight, combine):
+        """以 combine（相加或取最大值）將一個詞彙在主矩陣與增量區的段落權重併入 scores"""
+        column, delta_entry = source
+        # 同一詞彙欄位中段落編號不重複，可直接以索引更新
+        if column is not None:
+            start, end = self.indptr[column], self.indptr[column + 1]
+            rows = self.indices[start:end]
+            scores[rows] = combine(scores[rows], weight * self.data[start:end])
+        if delta_entry:
+            rows = np.asarray(delta_entry[0], dtype=np.int64)
+            scores[rows] = combine(scores[rows], weight * np.asarray(delta_entry[1], dtype=np.float32))
+    
+    def _select(self, passage_ids, scores, k, category):
+        """依序選出最多 k 個段落，略過其他分類與同一條目中互相重疊的段落"""
+        results = []
+        selected_spans = {}
+        for passage_id in passage_ids:
+            doc_id = self.passage_docs[passage_id]
+            metadata = self.documents[doc_id]
+            if category and metadata.get('category') != category:
+                continue
+            
+            start, end = self.passage_spans[passage_id]
+            spans = selected_spans.setdefault(doc_id, [])
+            if any(start < other_end and other_start < end for other_start, other_end in spans):
+                continue
+            spans.append((start, end))
+            
+            results.append((doc_id, (start, end), float(scores[passage_id]), dict(metadata)))
+            if len(results) >= k:
+                break
+        return results
+
+
+class PassageIndexManager(SearchIndexManager):
+    """管理各用戶的段落索引（建立、補齊與失效規則與搜尋索引相同）"""
+    
+    def retrieve(self, user_id, query, k=5, category=None):
+        """檢索用戶知識中最相關的段落"""
+        return self.get_index(user_id).retrieve(query, k=k, category=category)
+
+# 創建全域實例
+passage_index = PassageIndexManager(
+    loader=partial(storage.stream_knowledge_entries, fields=PASSAGE_FIELDS + VERSION_FIELDS),
+    version_loader=partial(storage.stream_knowledge_entries, fields=VERSION_FIELDS),
+    fetcher=partial(storage.get_knowledge_entries, fields=PASSAGE_FIELDS + VERSION_FIELDS),
+    generations=cache_generations,
+    max_users=Config.PASSAGE_INDEX_MAX_USERS,
+    index_factory=partial(
+        UserPassageIndex,
+        passage_chars=Config.PASSAGE_CHARS,
+        passage_overlap=Config.PASSAGE_OVERLAP,
+        delta_limit=Config.PASSAGE_INDEX_DELTA_LIMIT
+    )
+)
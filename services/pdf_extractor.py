@@ -0,0 +1,102 @@
+﻿import io
+import time
+from contextlib import contextmanager
+from utils.lazy_import import lazy_import
+
+PyPDF2 = lazy_import('PyPDF2')
+pdfplumber = lazy_import('pdfplumber')
+
+# 可選用的 PDF 提取後端
+PDF_BACKENDS = ('pypdf2', 'pdfplumber')
+
+# 自動選擇後端時抽樣的頁數
+AUTO_SAMPLE_PAGES = 3
+# 抽樣文字的平均行長低於此值時，視為 PyPDF2 未能正確還原字距（逐字斷行）
+AUTO_MIN_LINE_LENGTH = 3
+
+@contextmanager
+def _open_source(source):
+    """以檔案物件開啟 PDF（位元組內容或文件路徑）"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield io.BytesIO(source)
+    else:
+        with open(source, 'rb') as pdf_file:
+            yield pdf_file
+
+def count_pages(source):
+    """PDF 總頁數"""
+    with _open_source(source) as pdf_file:
+        return len(PyPDF2.PdfReader(pdf_file).pages)
+
+def select_backend(source, backend='auto', page_count=None):
+    """決定文件使用的提取後端
+    
+    backend 為 auto 時先以速度較快的 PyPDF2 抽樣幾頁：抽樣失敗或文字幾乎
+    都是逐字斷行時改用版面分析較完整的 pdfplumber。
+    """
+    if backend in PDF_BACKENDS:
+        return backend
+    if backend != 'auto':
+        raise ValueError(f"不支援的 PDF 提取後端: {backend}")
+    
+    page_count = count_pages(source) if page_count is None else page_count
+    if page_count == 0:
+        return 'pypdf2'
+    
+    step = max(1, page_count // AUTO_SAMPLE_PAGES)
+    sample_pages = list(range(0, page_count, step))[:AUTO_SAMPLE_PAGES]
+    try:
+        with _open_source(source) as pdf_file:
+            reader = PyPDF2.PdfReader(pdf_file)
+            sample = '\n'.join(reader.pages[index].extract_text() or '' for index in sample_pages)
+    except Exception:
+        return 'pdfplumber'
+    
+    lines = [line for line in sample.splitlines() if line.strip()]
+    if lines and sum(len(line.strip()) for line in lines) / len(lines) < AUTO_MIN_LINE_LENGTH:
+        return 'pdfplumber'
+    return 'pypdf2'
+
+def extract_pages(source, start, end, backend='pypdf2', deadline=None):
+    """提取第 start 到 end-1 頁的文字，回傳 (各頁文字列表, 下一個未提取的頁碼)
+    
+    指定 deadline（time.time() 時間戳記）時，超過期限即停止（至少提取一頁），
+    未提取的頁面由呼叫端另行處理；下一個未提取的頁碼等於 end 表示全部完成。
+    """
+    texts = []
+    with _open_source(source) as pdf_file:
+        if backend == 'pdfplumber':
+            with pdfplumber.open(pdf_file) as pdf:
+                for index in range(start, end):
+                    if deadline is not None and index > start and time.time() >= deadline:
+                        return texts, index
+                    page = pdf.pages[index]
+                    texts.append(page.extract_text() or '')
+                    # 釋放頁面解析快取，避免長文件佔用大量記憶體
+                    page.flush_cache()
+        else:
+            reader = PyPDF2.PdfReader(pdf_file)
+            for index in range(start, end):
+                if deadline is not None and index > start and time.time() >= deadline:
+                    return texts, index
+                texts.append(reader.pages[index].extract_text() or '')
+    return texts, end
+
+def plan_ranges(start, end, parts, min_pages):
+    """將頁碼區間切分為最多 parts 段、每段至少 min_pages 頁的連續區間"""
+    total = end - start
+    if total <= 0:
+        return []
+    
+    parts = max(1, min(parts, total // max(1, min_pages)))
+    size, remainder = divmod(total, parts)
+    ranges = []
+    for index in range(parts):
+        range_end = start + size + (1 if index < remainder else 0)
+        ranges.append((start, range_end))
+        start = range_end
+    return ranges
+
+def join_pages(texts):
+    """合併各頁文字（一次合併，避免重複字串串接）"""
+    return '\n'.join(texts).strip()
@@ -0,0 +1,188 @@
+﻿import os
+import copy
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from config import Config
+
+class GenerationStore:
+    """各用戶資料版本號
+    
+    每次寫入時遞增用戶的版本號，快取與搜尋索引以版本號判斷資料是否過期。
+    指定 db_path 時版本號保存於 SQLite 檔案，同一主機的多個程序共用；
+    未指定時僅保存於目前程序。
+    """
+    
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._initialized = False
+    
+    def _connection(self):
+        """取得目前執行緒的資料庫連線（fork 後重新建立）"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+                    setup = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+                    try:
+                        setup.execute('PRAGMA journal_mode=WAL')
+                        setup.execute(
+                            'CREATE TABLE IF NOT EXISTS generations (user_id TEXT PRIMARY KEY, generation INTEGER NOT NULL)'
+                        )
+                    finally:
+                        setup.close()
+                    self._initialized = True
+        
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+    
+    def get(self, user_id):
+        """讀取用戶目前的版本號"""
+        if not self.db_path:
+            with self._lock:
+                return self._memory.get(user_id, 0)
+        
+        row = self._connection().execute(
+            'SELECT generation FROM generations WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        return row[0] if row else 0
+    
+    def bump(self, user_id):
+        """遞增用戶版本號，回傳新的版本號"""
+        if not self.db_path:
+            with self._lock:
+                generation = self._memory.get(user_id, 0) + 1
+                self._memory[user_id] = generation
+                return generation
+        
+        row = self._connection().execute(
+            'INSERT INTO generations (user_id, generation) VALUES (?, 1) '
+            'ON CONFLICT (user_id) DO UPDATE SET generation = generation + 1 RETURNING generation',
+            (user_id,)
+        ).fetchone()
+        return row[0]
+
+class ReadCache:
+    """讀取快取（TTL 與 LRU，依筆數與位元組數上限淘汰）
+    
+    以 (用戶ID, 查詢參數) 為鍵保存讀取結果，並記錄讀取當時的用戶版本號；
+    用戶資料寫入後版本號改變，舊結果即不再使用。
+    """
+    
+    def __init__(self, generations, ttl, max_entries, max_bytes):
+        self.generations = generations
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # (user_id, key) -> (版本號, 到期時間, 值, 大小)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+    
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_entries > 0
+    
+    def get_or_load(self, user_id, key, loader):
+        """讀取快取，未命中或已過期時呼叫 loader 載入並保存
+        
+        loader 拋出例外時不寫入快取。回傳值為快取內容的副本。
+        """
+        if not self.enabled:
+            return loader()
+        
+        # 先讀取版本號再載入資料，載入期間若有寫入，結果會以舊版本號保存而不被使用
+        generation = self.generations.get(user_id)
+        cache_key = (user_id, key)
+        hit, value = self._lookup(cache_key, generation)
+        if hit:
+            return value
+        
+        value = loader()
+        self._put(cache_key, generation, value)
+        return copy.deepcopy(value)
+    
+    async def get_or_load_async(self, user_id, key, loader):
+        """get_or_load 的協程版本，loader 為回傳協程的函式（與同步版本共用快取）"""
+        if not self.enabled:
+            return await loader()
+        
+        generation = self.generations.get(user_id)
+        cache_key = (user_id, key)
+        hit, value = self._lookup(cache_key, generation)
+        if hit:
+            return value
+        
+        value = await loader()
+        self._put(cache_key, generation, value)
+        return copy.deepcopy(value)
+    
+    def _lookup(self, cache_key, generation):
+        """查詢快取，回傳 (是否命中, 快取內容的副本)"""
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0] == generation and entry[1] > time.monotonic():
+                self._entries.move_to_end(cache_key)
+                self._stats['hits'] += 1
+                return True, copy.deepcopy(entry[2])
+            self._stats['misses'] += 1
+        return False, None
+    
+    def _put(self, cache_key, generation, value):
+        size = len(json.dumps(value, default=str, ensure_ascii=False).encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        
+        with self._lock:
+            old_entry = self._entries.pop(cache_key, None)
+            if old_entry is not None:
+                self._bytes -= old_entry[3]
+            
+            self._entries[cache_key] = (generation, time.monotonic() + self.ttl, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[3]
+                self._stats['evictions'] += 1
+    
+    def invalidate(self, user_id):
+        """用戶資料已寫入：遞增版本號（通知其他程序）並移除本程序的快取，回傳新的版本號"""
+        generation = self.generations.bump(user_id)
+        
+        with self._lock:
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[0] == user_id]:
+                self._bytes -= self._entries.pop(cache_key)[3]
+            self._stats['invalidations'] += 1
+        return generation
+    
+    def get_stats(self):
+        """快取命中統計"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0
+        return stats
+
+# 創建全域實例
+cache_generations = GenerationStore(Config.READ_CACHE_GENERATION_DB)
+read_cache = ReadCache(
+    generations=cache_generations,
+    ttl=Config.READ_CACHE_TTL,
+    max_entries=Config.READ_CACHE_MAX_ENTRIES,
+    max_bytes=Config.READ_CACHE_MAX_BYTES
+)
@@ -0,0 +1,369 @@
+﻿import math
+import heapq
+import threading
+from functools import partial
+from collections import OrderedDict
+from config import Config
+from services.storage import storage
+from services.read_cache import cache_generations
+from utils.text_tokenizer import TermLookup, tokenize
+
+# 各欄位詞頻權重
+FIELD_WEIGHTS = {
+    'title': 3.0,
+    'tags': 2.0,
+    'content': 1.0
+}
+
+# 欄位之間的位置間隔，避免跨欄位誤判為連續片語
+FIELD_POSITION_GAP = 1000
+
+# 索引時保留的文件中繼資料欄位
+METADATA_FIELDS = ('title', 'category', 'tags', 'upload_date', 'file_info')
+
+# 建立索引時從資料庫讀取的欄位
+INDEXED_FIELDS = ('content',) + METADATA_FIELDS
+
+# 判斷條目是否在索引建立後修改過的欄位
+VERSION_FIELDS = ('last_modified',)
+
+# 本程序寫入後尚不知道儲存的修改時間，下次補齊時重新讀取
+_STALE = object()
+
+
+class UserSearchIndex:
+    """單一用戶的倒排索引（位置型 postings，BM25 排序）
+    
+    單一 CJK 字元與拉丁字母前綴的查詢詞彙經由 TermLookup 展開，以展開後各詞彙
+    postings 的聯集比對，行為與子字串搜尋一致。
+    """
+    
+    def __init__(self, k1=1.2, b=0.75, max_content_chars=None):
+        self.k1 = k1
+        self.b = b
+        self.max_content_chars = max_content_chars
+        # term -> {doc_id: [加權詞頻, 位置列表]}
+        self.postings = {}
+        self.terms = TermLookup()
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.documents = {}
+        self.total_length = 0.0
+        # 建立索引時的用戶資料版本號
+        self.generation = 0
+        self._lock = threading.RLock()
+    
+    def __len__(self):
+        return len(self.documents)
+    
+    def _analyze(self, data):
+        """將文件各欄位切詞，回傳 {term: [加權詞頻, 位置列表]} 與文件長度"""
+        tags = data.get('tags') or []
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        
+        content = data.get('content') or ''
+        if not isinstance(content, str):
+            content = ''
+        if self.max_content_chars and len(content) > self.max_content_chars:
+            content = content[:self.max_content_chars]
+        
+        fields = (
+            ('title', data.get('title') or ''),
+            ('tags', ' '.join(str(tag) for tag in tags)),
+            ('content', content)
+        )
+        
+        terms = {}
+        length = 0.0
+        offset = 0
+        for field, text in fields:
+            weight = FIELD_WEIGHTS[field]
+            tokens = tokenize(text)
+            for position, token in enumerate(tokens):
+                entry = terms.get(token)
+                if entry is None:
+                    entry = terms[token] = [0.0, []]
+                entry[0] += weight
+                entry[1].append(offset + position)
+            length += weight * len(tokens)
+            offset += len(tokens) + FIELD_POSITION_GAP
+        
+        return terms, length
+    
+    def add_document(self, doc_id, data):
+        """加入或取代文件"""
+        terms, length = self._analyze(data)
+        metadata = {field: data.get(field) for field in METADATA_FIELDS if field in data}
+        
+        with self._lock:
+            self._remove(doc_id)
+            for term, entry in terms.items():
+                doc_postings = self.postings.get(term)
+                if doc_postings is None:
+                    doc_postings = self.postings[term] = {}
+                    self.terms.add(term)
+                doc_postings[doc_id] = entry
+            self.doc_terms[doc_id] = tuple(terms)
+            self.doc_lengths[doc_id] = length
+            self.documents[doc_id] = metadata
+            self.total_length += length
+    
+    def remove_document(self, doc_id):
+        """移除文件"""
+        with self._lock:
+            self._remove(doc_id)
+    
+    def _remove(self, doc_id):
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        
+        for term in terms:
+            doc_postings = self.postings.get(term)
+            if doc_postings is None:
+                continue
+            doc_postings.pop(doc_id, None)
+            if not doc_postings:
+                del self.postings[term]
+        
+        self.total_length -= self.doc_lengths.pop(doc_id, 0.0)
+        self.documents.pop(doc_id, None)
+    
+    def _is_phrase(self, doc_id, query_tokens, token_postings):
+        """檢查查詢詞彙是否在文件中連續出現（token_postings 為各查詢詞彙展開後的 postings）"""
+        first_positions = token_postings[query_tokens[0]][doc_id][1]
+        other_positions = [
+            set(token_postings[token][doc_id][1]) for token in query_tokens[1:]
+        ]
+        for start in first_positions:
+            if all(start + i + 1 in positions for i, positions in enumerate(other_positions)):
+                return True
+        return False
+    
+    def search(self, query, category=None, limit=50):
+        """搜尋文件，回傳依 BM25 分數排序的 [(doc_id, score, metadata)]"""
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return []
+        
+        unique_tokens = list(dict.fromkeys(query_tokens))
+        
+        with self._lock:
+            doc_count = len(self.documents)
+            if doc_count == 0:
+                return []
+            
+            term_postings = []
+            for token in unique_tokens:
+                doc_postings = self._expanded_postings(token)
+                if not doc_postings:
+                    # 所有查詢詞彙都必須出現
+                    return []
+                term_postings.append((token, doc_postings))
+            token_postings = dict(term_postings)
+            
+            # 從最稀有的詞彙開始取交集
+            term_postings.sort(key=lambda item: len(item[1]))
+            candidates = set(term_postings[0][1])
+            for _, doc_postings in term_postings[1:]:
+                candidates.intersection_update(doc_postings)
+                if not candidates:
+                    return []
+            
+            if category:
+                candidates = {
+                    doc_id for doc_id in candidates
+                    if self.documents[doc_id].get('category') == category
+                }
+            
+            avg_length = self.total_length / doc_count if doc_count else 0.0
+            idf = {
+                token: math.log(1 + (doc_count - len(doc_postings) + 0.5) / (len(doc_postings) + 0.5))
+                for token, doc_postings in term_postings
+            }
+            
+            scored = []
+            for doc_id in candidates:
+                length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length) if avg_length else self.k1
+                score = 0.0
+                for token, doc_postings in term_postings:
+                    tf = doc_postings[doc_id][0]
+                    score += idf[token] * tf * (self.k1 + 1) / (tf + length_norm)
+                
+                # 查詢詞彙連續出現（片語）時加分
+                if len(query_tokens) > 1 and self._is_phrase(doc_id, query_tokens, token_postings):
+                    score *= 1.5
+                
+                scored.append((score, doc_id))
+            
+            top = heapq.nlargest(limit, scored) if limit else sorted(scored, reverse=True)
+            return [(doc_id, score, dict(self.documents[doc_id])) for score, doc_id in top]
+    
+    def _expanded_postings(self, token):
+        """查詢詞彙展開後的 postings：{doc_id: [加權詞頻合計, 位置列表]}（沒有符合的詞彙時為 None）"""
+        expanded = self.terms.expand(token, frequency=lambda term: len(self.postings.get(term, ())))
+        matches = [self.postings[term] for term in expanded if term in self.postings]
+        if len(matches) <= 1:
+            return matches[0] if matches else None
+        
+        merged = {}
+        for doc_postings in matches:
+            for doc_id, (frequency, positions) in doc_postings.items():
+                entry = merged.get(doc_id)
+                if entry is None:
+                    merged[doc_id] = [frequency, list(positions)]
+                else:
+                    entry[0] += frequency
+                    entry[1].extend(positions)
+        return merged
+
+
+class SearchIndexManager:
+    """管理各用戶的倒排索引，首次搜尋時從資料庫建立
+    
+    索引記錄建立時的用戶資料版本號與各條目的修改時間；其他程序寫入而使版本號
+    改變時，下次搜尋以 version_loader 讀取所有條目的修改時間（不讀取內容），
+    只以 fetcher 重新讀取新增或修改過的條目並移除已刪除的條目。未指定
+    version_loader 與 fetcher 或補齊失敗時重新建立索引。
+    """
+    
+    def __init__(self, loader, generations, max_users=100, max_content_chars=None, index_factory=None,
+                 version_loader=None, fetcher=None):
+        self._loader = loader
+        self._version_loader = version_loader
+        self._fetcher = fetcher
+        self._generations = generations
+        self._max_users = max_users
+        self._index_factory = index_factory or partial(UserSearchIndex, max_content_chars=max_content_chars)
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self._build_locks = {}
+    
+    def _get_loaded(self, user_id):
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None:
+                self._indexes.move_to_end(user_id)
+            return index
+    
+    def get_index(self, user_id):
+        """取得用戶索引，尚未建立或已過期時從資料庫載入
+        
+        載入失敗時拋出例外，不保存只含部分條目的索引（否則在用戶下次寫入前都會漏掉條目）。
+        """
+        generation = self._generations.get(user_id)
+        index = self._get_loaded(user_id)
+        if index is not None and index.generation == generation:
+            return index
+        
+        with self._lock:
+            build_lock = self._build_locks.setdefault(user_id, threading.Lock())
+        
+        with build_lock:
+            generation = self._generations.get(user_id)
+            index = self._get_loaded(user_id)
+            if index is not None and index.generation == generation:
+                return index
+            
+            if index is not None and self._version_loader is not None and self._fetcher is not None:
+                try:
+                    self._catch_up(user_id, index)
+                    index.generation = generation
+                    return index
+                except Exception as e:
+                    print(f"搜尋索引增量更新錯誤: {e}")
+                    self.invalidate(user_id)
+            
+            index = self._index_factory()
+            index.generation = generation
+            index.versions = {}
+            for knowledge in self._loader(user_id):
+                index.add_document(knowledge['id'], knowledge)
+                index.versions[knowledge['id']] = knowledge.get('last_modified')
+            
+            with self._lock:
+                self._indexes[user_id] = index
+                self._indexes.move_to_end(user_id)
+                while len(self._indexes) > self._max_users:
+                    evicted_user, _ = self._indexes.popitem(last=False)
+                    self._build_locks.pop(evicted_user, None)
+            return index
+    
+    def _catch_up(self, user_id, index):
+        """依各條目的修改時間補齊過期的索引（讀取失敗時拋出例外）"""
+        current = {entry['id']: entry.get('last_modified') for entry in self._version_loader(user_id)}
+        changed = [doc_id for doc_id, version in current.items() if index.versions.get(doc_id, _STALE) != version]
+        removed = [doc_id for doc_id in index.versions if doc_id not in current]
+        
+        fetched = self._fetcher(user_id, changed) if changed else {}
+        if len(fetched) < len(changed):
+            # 讀取失敗或條目在期間被刪除，交由重新建立處理
+            raise RuntimeError(f"無法讀取 {len(changed) - len(fetched)} 筆變更的條目")
+        
+        for doc_id in removed:
+            index.remove_document(doc_id)
+            index.versions.pop(doc_id, None)
+        for doc_id, data in fetched.items():
+            index.add_document(doc_id, data)
+            index.versions[doc_id] = data.get('last_modified')
+    
+    def _apply_write(self, user_id, apply):
+        """將本程序剛完成的一次寫入套用到已載入的索引
+        
+        寫入後版本號應恰好比索引多 1；若期間有其他程序的寫入，則保留過期的索引，
+        留待下次搜尋時補齊（包含這次寫入）。
+        """
+        index = self._get_loaded(user_id)
+        if index is None:
+            return
+        
+        generation = self._generations.get(user_id)
+        if generation == index.generation + 1:
+            apply(index)
+            index.generation = generation
+    
+    def add_document(self, user_id, doc_id, data):
+        """新增或更新文件（僅在索引已載入時更新，否則留待下次載入）"""
+        self.add_documents(user_id, [(doc_id, data)])
+    
+    def add_documents(self, user_id, documents):
+        """新增同一次批量寫入的多筆文件，documents 為 (doc_id, data) 列表"""
+        def apply(index):
+            for doc_id, data in documents:
+                index.add_document(doc_id, data)
+                index.versions[doc_id] = _STALE
+        
+        self._apply_write(user_id, apply)
+    
+    def remove_document(self, user_id, doc_id):
+        """移除文件"""
+        self.remove_documents(user_id, [doc_id])
+    
+    def remove_documents(self, user_id, doc_ids):
+        """移除同一次批量刪除的多筆文件"""
+        def apply(index):
+            for doc_id in doc_ids:
+                index.remove_document(doc_id)
+                index.versions.pop(doc_id, None)
+        
+        self._apply_write(user_id, apply)
+    
+    def invalidate(self, user_id):
+        """丟棄用戶索引，下次搜尋時重新建立"""
+        with self._lock:
+            self._indexes.pop(user_id, None)
+    
+    def search(self, user_id, query, category=None, limit=50):
+        """搜尋用戶知識"""
+        return self.get_index(user_id).search(query, category=category, limit=limit)
+
+# 創建全域實例
+search_index = SearchIndexManager(
+    loader=partial(storage.stream_knowledge_entries, fields=INDEXED_FIELDS + VERSION_FIELDS),
+    version_loader=partial(storage.stream_knowledge_entries, fields=VERSION_FIELDS),
+    fetcher=partial(storage.get_knowledge_entries, fields=INDEXED_FIELDS + VERSION_FIELDS),
+    generations=cache_generations,
+    max_users=Config.SEARCH_INDEX_MAX_USERS,
+    max_content_chars=Config.SEARCH_INDEX_MAX_CONTENT_CHARS
+)
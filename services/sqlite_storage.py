@@ -0,0 +1,627 @@
+﻿import os
+import json
+import uuid
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta, timezone
+from services.storage_backend import StorageBackend
+from utils.text_tokenizer import tokenize
+from utils.time_utils import to_utc_naive
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_profiles (
+    user_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS knowledge (
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    title TEXT,
+    category TEXT,
+    content TEXT,
+    upload_date TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    file_type TEXT,
+    size_bytes INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL,
+    UNIQUE (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS idx_knowledge_user_date ON knowledge (user_id, upload_date DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_knowledge_user_category_date ON knowledge (user_id, category, upload_date DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_knowledge_user_hash ON knowledge (user_id, content_hash);
+CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_fts USING fts5 (title, tags, content);
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id TEXT PRIMARY KEY,
+    last_modified TEXT NOT NULL
+);
+"""
+
+# 以獨立欄位保存的知識條目欄位（其餘欄位以 JSON 保存於 data 欄位）
+COLUMN_FIELDS = ('title', 'category', 'content', 'upload_date', 'last_modified')
+
+# 日期以固定格式的 UTC 字串保存，使字串排序等同時間排序
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# 列表查詢不含內容時讀取的欄位
+SUMMARY_COLUMNS = 'id, title, category, upload_date, last_modified, data'
+
+# 全文搜尋各欄位權重（與記憶體倒排索引相同）
+FTS_WEIGHTS = (3.0, 2.0, 1.0)
+
+# 批量操作時每次查詢的條目數（低於 SQLite 預設的參數數量上限）
+BULK_QUERY_SIZE = 500
+
+class SQLiteStorage(StorageBackend):
+    """嵌入式 SQLite 儲存後端
+    
+    適用於單機部署與測試。資料庫使用 WAL 模式，多個程序可同時讀取；
+    內容以與倒排索引相同的切詞方式寫入 FTS5 全文索引。
+    """
+    
+    backend_name = 'sqlite'
+    supports_full_text_search = True
+    
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = db_path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+    
+    def _connection(self):
+        """取得目前執行緒的資料庫連線（fork 後重新建立）"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+                    setup = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+                    try:
+                        setup.execute('PRAGMA journal_mode=WAL')
+                        setup.executescript(SCHEMA)
+                    finally:
+                        setup.close()
+                    self._initialized = True
+        
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA synchronous=NORMAL')
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+    
+    def warm_up(self):
+        """預先建立資料庫與連線"""
+        return self._connection()
+    
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+    
+    # 資料轉換
+    
+    def _format_date(self, value):
+        value = to_utc_naive(value)
+        return value.strftime(DATE_FORMAT) if value else None
+    
+    def _parse_date(self, value):
+        return datetime.strptime(value, DATE_FORMAT) if value else None
+    
+    def _row_values(self, knowledge_data):
+        """知識條目轉為資料表欄位值"""
+        data = {key: value for key, value in knowledge_data.items() if key not in COLUMN_FIELDS and key != 'id'}
+        file_info = knowledge_data.get('file_info') or {}
+        return {
+            'title': knowledge_data.get('title'),
+            'category': knowledge_data.get('category'),
+            'content': knowledge_data.get('content'),
+            'upload_date': self._format_date(knowledge_data.get('upload_date')),
+            'last_modified': self._format_date(knowledge_data.get('last_modified')),
+            'content_hash': file_info.get('content_hash'),
+            'file_type': file_info.get('file_type'),
+            'size_bytes': self._knowledge_size(knowledge_data),
+            'data': json.dumps(data, ensure_ascii=False, default=str)
+        }
+    
+    def _row_to_knowledge(self, row):
+        """資料列轉為知識條目"""
+        knowledge = json.loads(row['data'])
+        keys = row.keys()
+        for field in ('title', 'category', 'content'):
+            if field in keys and row[field] is not None:
+                knowledge[field] = row[field]
+        knowledge['upload_date'] = self._parse_date(row['upload_date'])
+        knowledge['last_modified'] = self._parse_date(row['last_modified'])
+        knowledge['id'] = row['id']
+        return knowledge
+    
+    def _fts_values(self, knowledge_data):
+        """以倒排索引的切詞結果寫入全文索引（CJK 二元組以空白分隔）"""
+        tags = knowledge_data.get('tags') or []
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        return (
+            ' '.join(tokenize(knowledge_data.get('title') or '')),
+            ' '.join(tokenize(' '.join(str(tag) for tag in tags))),
+            ' '.join(tokenize(knowledge_data.get('content') or ''))
+        )
+    
+    def _columns(self, fields):
+        """依讀取欄位決定查詢的資料表欄位（不需要內容時略過 content 欄位）"""
+        if fields is None or any(field == 'content' or field.startswith('content.') for field in fields):
+            return '*'
+        return SUMMARY_COLUMNS
+    
+    def _insert(self, connection, user_id, knowledge_id, knowledge_data):
+        values = self._row_values(knowledge_data)
+        cursor = connection.execute(
+            'INSERT INTO knowledge (user_id, id, title, category, content, upload_date, last_modified, '
+            'content_hash, file_type, size_bytes, data) '
+            'VALUES (:user_id, :id, :title, :category, :content, :upload_date, :last_modified, '
+            ':content_hash, :file_type, :size_bytes, :data)',
+            {**values, 'user_id': user_id, 'id': knowledge_id}
+        )
+        connection.execute(
+            'INSERT INTO knowledge_fts (rowid, title, tags, content) VALUES (?, ?, ?, ?)',
+            (cursor.lastrowid,) + self._fts_values(knowledge_data)
+        )
+    
+    def _rewrite(self, connection, rowid, knowledge):
+        """以更新後的條目覆寫資料列與全文索引"""
+        values = self._row_values(knowledge)
+        connection.execute(
+            'UPDATE knowledge SET title = :title, category = :category, content = :content, '
+            'upload_date = :upload_date, last_modified = :last_modified, content_hash = :content_hash, '
+            'file_type = :file_type, size_bytes = :size_bytes, data = :data WHERE rowid = :rowid',
+            {**values, 'rowid': rowid}
+        )
+        connection.execute('DELETE FROM knowledge_fts WHERE rowid = ?', (rowid,))
+        connection.execute(
+            'INSERT INTO knowledge_fts (rowid, title, tags, content) VALUES (?, ?, ?, ?)',
+            (rowid,) + self._fts_values(knowledge)
+        )
+    
+    def _select_rows(self, connection, user_id, knowledge_ids, columns='rowid, *'):
+        """分段查詢多筆條目，回傳 {條目 ID: 資料列}"""
+        rows = {}
+        for start in range(0, len(knowledge_ids), BULK_QUERY_SIZE):
+            chunk = knowledge_ids[start:start + BULK_QUERY_SIZE]
+            placeholders = ', '.join('?' * len(chunk))
+            for row in connection.execute(
+                f'SELECT {columns} FROM knowledge WHERE user_id = ? AND id IN ({placeholders})', (user_id, *chunk)
+            ):
+                rows[row['id']] = row
+        self._record_reads(len(rows))
+        return rows
+    
+    def _touch_user(self, connection, user_id):
+        """在寫入交易中記錄用戶資料最後寫入時間（刪除條目後仍保留，供條件式請求判斷）"""
+        connection.execute(
+            'INSERT INTO user_state (user_id, last_modified) VALUES (?, ?) '
+            'ON CONFLICT (user_id) DO UPDATE SET last_modified = excluded.last_modified',
+            (user_id, self._format_date(datetime.now(timezone.utc)))
+        )
+    
+    # 用戶資料
+    
+    def get_user_profile(self, user_id):
+        """獲取用戶資料"""
+        try:
+            row = self._connection().execute(
+                'SELECT data FROM user_profiles WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            self._record_reads(1)
+            
+            if row is None:
+                return None
+            
+            profile = json.loads(row['data'])
+            for field in ('created_at', 'last_active'):
+                if profile.get(field):
+                    profile[field] = datetime.fromisoformat(profile[field])
+            return profile
+        except Exception as e:
+            print(f"獲取用戶資料錯誤: {e}")
+            return None
+    
+    def create_user_profile(self, user_id, profile_data):
+        """創建用戶資料"""
+        try:
+            profile_data.update({
+                'created_at': datetime.now(),
+                'last_active': datetime.now()
+            })
+            
+            with self._transaction() as connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO user_profiles (user_id, data) VALUES (?, ?)',
+                    (user_id, json.dumps(profile_data, ensure_ascii=False, default=lambda value: value.isoformat()))
+                )
+            self._record_writes(1)
+            return True
+        except Exception as e:
+            print(f"創建用戶資料錯誤: {e}")
+            return False
+    
+    def list_user_ids(self):
+        """列出所有用戶ID"""
+        rows = self._connection().execute(
+            'SELECT DISTINCT user_id FROM knowledge UNION SELECT user_id FROM user_profiles'
+        ).fetchall()
+        return [row['user_id'] for row in rows]
+    
+    # 知識條目
+    
+    def create_knowledge_entry(self, user_id, knowledge_data, knowledge_id=None):
+        """創建知識條目（指定的條目 ID 已存在時不重複寫入）"""
+        try:
+            self._prepare_knowledge_data(knowledge_data)
+            knowledge_id = knowledge_id or uuid.uuid4().hex[:20]
+            
+            with self._transaction() as connection:
+                existing = connection.execute(
+                    'SELECT 1 FROM knowledge WHERE user_id = ? AND id = ?', (user_id, knowledge_id)
+                ).fetchone()
+                if existing is not None:
+                    return knowledge_id
+                self._insert(connection, user_id, knowledge_id, knowledge_data)
+                self._touch_user(connection, user_id)
+            self._record_writes(1)
+            
+            self.read_cache.invalidate(user_id)
+            return knowledge_id
+        except Exception as e:
+            print(f"創建知識條目錯誤: {e}")
+            return None
+    
+    def create_knowledge_entries(self, user_id, knowledge_items):
+        """批量創建知識條目（單一交易寫入），回傳與輸入順序相同的條目 ID 列表"""
+        try:
+            knowledge_ids = []
+            with self._transaction() as connection:
+                for knowledge_data in knowledge_items:
+                    self._prepare_knowledge_data(knowledge_data)
+                    knowledge_id = uuid.uuid4().hex[:20]
+                    self._insert(connection, user_id, knowledge_id, knowledge_data)
+                    knowledge_ids.append(knowledge_id)
+                if knowledge_ids:
+                    self._touch_user(connection, user_id)
+            self._record_writes(len(knowledge_ids))
+            
+            if knowledge_ids:
+                self.read_cache.invalidate(user_id)
+            return knowledge_ids
+        except Exception as e:
+            print(f"批次寫入錯誤: {e}")
+            return [None] * len(knowledge_items)
+    
+    def get_knowledge_entry(self, user_id, knowledge_id):
+        """獲取單一知識條目"""
+        try:
+            row = self._connection().execute(
+                'SELECT * FROM knowledge WHERE user_id = ? AND id = ?', (user_id, knowledge_id)
+            ).fetchone()
+            self._record_reads(1)
+            
+            return self._row_to_knowledge(row) if row is not None else None
+        except Exception as e:
+            print(f"獲取知識條目錯誤: {e}")
+            return None
+    
+    def get_knowledge_entries(self, user_id, knowledge_ids, fields=None):
+        """一次讀取多筆知識條目，回傳 {條目 ID: 資料}（不存在的條目不包含在內）"""
+        try:
+            knowledge_ids = list(knowledge_ids)
+            entries = {}
+            # 分批查詢，避免超過 SQLite 參數數量上限
+            for start in range(0, len(knowledge_ids), 500):
+                chunk = knowledge_ids[start:start + 500]
+                rows = self._connection().execute(
+                    f"SELECT {self._columns(fields)} FROM knowledge WHERE user_id = ? AND id IN ({', '.join('?' * len(chunk))})",
+                    [user_id] + chunk
+                ).fetchall()
+                self._record_reads(len(rows))
+                for row in rows:
+                    entries[row['id']] = self._row_to_knowledge(row)
+            return entries
+        except Exception as e:
+            print(f"獲取知識條目錯誤: {e}")
+            return {}
+    
+    def find_knowledge_by_hash(self, user_id, content_hash):
+        """依文件內容雜湊尋找既有知識條目，回傳條目 ID"""
+        try:
+            row = self._connection().execute(
+                'SELECT id FROM knowledge WHERE user_id = ? AND content_hash = ? LIMIT 1', (user_id, content_hash)
+            ).fetchone()
+            self._record_reads(1)
+            return row['id'] if row is not None else None
+        except Exception as e:
+            print(f"查詢重複文件錯誤: {e}")
+            return None
+    
+    def stream_knowledge_entries(self, user_id, since=None, fields=None, category=None):
+        """逐筆讀取用戶所有知識條目（不受筆數限制，可指定上傳日期下限、讀取欄位與分類；錯誤時拋出例外）"""
+        count = 0
+        try:
+            sql = f"SELECT {self._columns(fields)} FROM knowledge WHERE user_id = ?"
+            params = [user_id]
+            if since is not None:
+                sql += ' AND upload_date >= ?'
+                params.append(self._format_date(since))
+            if category:
+                sql += ' AND category = ?'
+                params.append(category)
+            
+            cursor = self._connection().execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(200)
+                if not rows:
+                    break
+                for row in rows:
+                    count += 1
+                    yield self._row_to_knowledge(row)
+        finally:
+            self._record_reads(count)
+    
+    def update_knowledge_entry(self, user_id, knowledge_id, updates, expected_last_modified=None):
+        """更新知識條目（updates 的鍵可使用 a.b 表示巢狀欄位）"""
+        try:
+            updates['last_modified'] = datetime.now()
+            
+            with self._transaction() as connection:
+                row = connection.execute(
+                    'SELECT rowid, * FROM knowledge WHERE user_id = ? AND id = ?', (user_id, knowledge_id)
+                ).fetchone()
+                self._record_reads(1)
+                if row is None:
+                    raise ValueError(f"知識條目不存在: {knowledge_id}")
+                
+                knowledge = self._row_to_knowledge(row)
+                if expected_last_modified is not None and knowledge.get('last_modified') != expected_last_modified:
+                    raise ValueError(f"知識條目已被修改: {knowledge_id}")
+                knowledge = self._merge_updates(knowledge, updates)
+                self._rewrite(connection, row['rowid'], knowledge)
+                self._touch_user(connection, user_id)
+            self._record_writes(1)
+            
+            self.read_cache.invalidate(user_id)
+            return True
+        except Exception as e:
+            print(f"更新知識條目錯誤: {e}")
+            return False
+    
+    def delete_knowledge_entry(self, user_id, knowledge_id):
+        """刪除知識條目"""
+        try:
+            with self._transaction() as connection:
+                row = connection.execute(
+                    'SELECT rowid FROM knowledge WHERE user_id = ? AND id = ?', (user_id, knowledge_id)
+                ).fetchone()
+                if row is not None:
+                    connection.execute('DELETE FROM knowledge WHERE rowid = ?', (row['rowid'],))
+                    connection.execute('DELETE FROM knowledge_fts WHERE rowid = ?', (row['rowid'],))
+                    self._touch_user(connection, user_id)
+            self._record_writes(1 if row is not None else 0)
+            
+            self.read_cache.invalidate(user_id)
+            return True
+        except Exception as e:
+            print(f"刪除知識條目錯誤: {e}")
+            return False
+    
+    def update_knowledge_entries(self, user_id, knowledge_ids, updates):
+        """批量更新知識條目（單一交易寫入）"""
+        try:
+            updates = {**updates, 'last_modified': datetime.now()}
+            updated = {}
+            with self._transaction() as connection:
+                rows = self._select_rows(connection, user_id, knowledge_ids)
+                for knowledge_id, row in rows.items():
+                    knowledge = self._merge_updates(self._row_to_knowledge(row), updates)
+                    self._rewrite(connection, row['rowid'], knowledge)
+                    updated[knowledge_id] = knowledge
+                if updated:
+                    self._touch_user(connection, user_id)
+            self._record_writes(len(updated))
+            
+            if updated:
+                self.read_cache.invalidate(user_id)
+            return updated, [knowledge_id for knowledge_id in knowledge_ids if knowledge_id not in updated]
+        except Exception as e:
+            print(f"批量更新知識條目錯誤: {e}")
+            return {}, []
+    
+    def delete_knowledge_entries(self, user_id, knowledge_ids):
+        """批量刪除知識條目（單一交易寫入）"""
+        try:
+            with self._transaction() as connection:
+                rows = self._select_rows(connection, user_id, knowledge_ids, columns='rowid, id')
+                rowids = [(row['rowid'],) for row in rows.values()]
+                connection.executemany('DELETE FROM knowledge WHERE rowid = ?', rowids)
+                connection.executemany('DELETE FROM knowledge_fts WHERE rowid = ?', rowids)
+                if rows:
+                    self._touch_user(connection, user_id)
+            self._record_writes(len(rows))
+            
+            if rows:
+                self.read_cache.invalidate(user_id)
+            deleted = [knowledge_id for knowledge_id in knowledge_ids if knowledge_id in rows]
+            return deleted, [knowledge_id for knowledge_id in knowledge_ids if knowledge_id not in rows]
+        except Exception as e:
+            print(f"批量刪除知識條目錯誤: {e}")
+            return [], []
+    
+    def search_knowledge_entries(self, user_id, query, category=None, limit=50):
+        """FTS5 全文搜尋（所有詞彙都須出現，依 BM25 分數排序）"""
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens:
+            return []
+        
+        match = ' '.join('"' + token.replace('"', '""') + '"' for token in query_tokens)
+        sql = (
+            f"SELECT k.id, k.title, k.category, k.upload_date, k.last_modified, k.data, "
+            f"bm25(knowledge_fts, {', '.join(str(weight) for weight in FTS_WEIGHTS)}) AS rank "
+            "FROM knowledge_fts JOIN knowledge k ON k.rowid = knowledge_fts.rowid "
+            "WHERE knowledge_fts MATCH ? AND k.user_id = ?"
+        )
+        params = [match, user_id]
+        if category:
+            sql += ' AND k.category = ?'
+            params.append(category)
+        sql += ' ORDER BY rank LIMIT ?'
+        params.append(limit)
+        
+        rows = self._connection().execute(sql, params).fetchall()
+        self._record_reads(len(rows))
+        
+        results = []
+        for row in rows:
+            knowledge = self._row_to_knowledge(row)
+            # bm25() 分數越小越相關，轉為越大越相關
+            results.append((knowledge.pop('id'), -row['rank'], knowledge))
+        return results
+    
+    def read_knowledge_content(self, user_id, knowledge_id, start=None, end=None, page=None, end_page=None, max_chars=None):
+        """讀取知識條目內容的一段（以 substr 只取出範圍內的字元，不讀取完整內容）"""
+        connection = self._connection()
+        # 兩次查詢在同一個讀取交易中，使範圍與內容一致
+        connection.execute('BEGIN')
+        try:
+            row = connection.execute(
+                "SELECT rowid, length(content) AS length, json_extract(data, '$.file_info.page_offsets') AS page_offsets "
+                'FROM knowledge WHERE user_id = ? AND id = ?',
+                (user_id, knowledge_id)
+            ).fetchone()
+            self._record_reads(1)
+            if row is None:
+                return None
+            
+            length = row['length'] or 0
+            page_offsets = json.loads(row['page_offsets']) if row['page_offsets'] is not None else None
+            range_start, range_end = self._resolve_content_range(
+                length, page_offsets, start, end, page, end_page, max_chars
+            )
+            content = connection.execute(
+                'SELECT substr(content, ?, ?) FROM knowledge WHERE rowid = ?',
+                (range_start + 1, range_end - range_start, row['rowid'])
+            ).fetchone()[0]
+        finally:
+            connection.execute('COMMIT')
+        return self._content_range_result(content or '', range_start, range_end, length, page_offsets)
+    
+    # 列表與統計
+    
+    def _load_knowledge_page(self, user_id, category, limit, cursor, fields):
+        """從 SQLite 讀取一頁知識列表"""
+        sql = f"SELECT {self._columns(fields)} FROM knowledge WHERE user_id = ? AND upload_date IS NOT NULL"
+        params = [user_id]
+        
+        if category:
+            sql += ' AND category = ?'
+            params.append(category)
+        
+        if cursor:
+            position = self._format_date(cursor['upload_date'])
+            sql += ' AND (upload_date < ? OR (upload_date = ? AND id < ?))'
+            params.extend([position, position, cursor['id']])
+        
+        # 多讀取一筆以判斷是否還有下一頁
+        sql += ' ORDER BY upload_date DESC, id DESC LIMIT ?'
+        params.append(limit + 1)
+        
+        rows = self._connection().execute(sql, params).fetchall()
+        self._record_reads(len(rows))
+        
+        knowledge_list = [self._row_to_knowledge(row) for row in rows[:limit]]
+        
+        next_position = None
+        if len(rows) > limit and knowledge_list:
+            last = knowledge_list[-1]
+            next_position = {'upload_date': last.get('upload_date'), 'id': last['id']}
+        
+        return knowledge_list, next_position
+    
+    def _load_user_statistics(self, user_id):
+        """以索引彙總查詢計算統計資料"""
+        rows = self._connection().execute(
+            'SELECT category, file_type, COUNT(*) AS count, SUM(size_bytes) AS bytes '
+            'FROM knowledge WHERE user_id = ? GROUP BY category, file_type',
+            (user_id,)
+        ).fetchall()
+        self._record_reads(len(rows))
+        
+        total_knowledge = 0
+        bytes_stored = 0
+        category_counts = {}
+        file_type_counts = {}
+        for row in rows:
+            total_knowledge += row['count']
+            bytes_stored += row['bytes'] or 0
+            category = row['category'] or '未分類'
+            file_type = row['file_type'] or '未知'
+            category_counts[category] = category_counts.get(category, 0) + row['count']
+            file_type_counts[file_type] = file_type_counts.get(file_type, 0) + row['count']
+        
+        return self._build_statistics(total_knowledge, bytes_stored, category_counts, file_type_counts)
+    
+    def _load_upload_rollups(self, user_id, start_day, end_day):
+        """依 UTC 日期、小時與分類彙總上傳數（格式與 Firestore 每日彙總相同）"""
+        end_exclusive = (date.fromisoformat(end_day) + timedelta(days=1)).isoformat()
+        rows = self._connection().execute(
+            'SELECT substr(upload_date, 1, 10) AS day, substr(upload_date, 12, 2) AS hour, category, '
+            'COUNT(*) AS count, SUM(size_bytes) AS bytes FROM knowledge '
+            'WHERE user_id = ? AND upload_date >= ? AND upload_date < ? GROUP BY day, hour, category',
+            (user_id, start_day, end_exclusive)
+        ).fetchall()
+        self._record_reads(len(rows))
+        
+        rollups = {}
+        for row in rows:
+            rollup = rollups.setdefault(row['day'], {'date': row['day'], 'count': 0, 'bytes': 0, 'hours': {}, 'categories': {}})
+            bucket = rollup['hours'].setdefault(row['hour'], {'count': 0, 'bytes': 0})
+            category = row['category'] or '未分類'
+            rollup['count'] += row['count']
+            rollup['bytes'] += row['bytes'] or 0
+            bucket['count'] += row['count']
+            bucket['bytes'] += row['bytes'] or 0
+            rollup['categories'][category] = rollup['categories'].get(category, 0) + row['count']
+        return rollups
+    
+    def _load_user_last_modified(self, user_id):
+        """讀取用戶最後寫入時間；尚無紀錄的既有用戶以條目中最新的修改時間代替"""
+        connection = self._connection()
+        row = connection.execute('SELECT last_modified FROM user_state WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            row = connection.execute(
+                'SELECT MAX(last_modified) AS last_modified FROM knowledge WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        self._record_reads(1)
+        return self._parse_date(row['last_modified'])
+    
+    def rebuild_user_statistics(self, user_id):
+        """SQLite 統計由查詢即時計算，無需重建；回傳目前的統計總數"""
+        try:
+            self.read_cache.invalidate(user_id)
+            statistics = self._load_user_statistics(user_id)
+            return {
+                'total_knowledge': statistics['total_knowledge'],
+                'bytes_stored': statistics['bytes_stored'],
+                'categories': statistics['category_counts'],
+                'file_types': statistics['file_type_counts']
+            }
+        except Exception as e:
+            print(f"重建統計資料錯誤: {e}")
+            return None
@@ -1,156 +1,224 @@
-﻿from services.firebase_service import firebase_service
-from datetime import datetime, timedelta
+﻿import asyncio
+from services.storage import storage
+from services.async_runtime import event_loop_runner
+from config import Config
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# 儀表板本週與本月上傳數涵蓋的天數（含今日）
+WEEK_DAYS = 7
+MONTH_DAYS = 30
 
 class StatisticsService:
     def __init__(self):
-        self.firebase_service = firebase_service
+        self.storage = storage
     
-    def get_user_statistics(self, user_id):
-        """獲取用戶統計資料"""
+    def aggregate(self, user_id, include_time_statistics=True):
+        """統計聚合引擎：一次讀取用戶資料並計算所有儀表板指標
+        
+        分類與文件類型分佈取自寫入時維護的統計計數器；時間相關統計只讀取
+        最近 MONTH_DAYS 天的每日彙總，並在單次走訪中完成今日/本週/本月與 7 日趨勢的分桶。
+        ASYNC_STORAGE 啟用且後端支援非同步讀取時，計數器與每日彙總並行讀取。
+        """
+        if self._reads_concurrently(include_time_statistics):
+            return event_loop_runner.run(self.aggregate_async(user_id, include_time_statistics))
+        
+        today = datetime.now(timezone.utc).date()
+        month_start = today - timedelta(days=MONTH_DAYS - 1)
+        basic_stats = self.storage.get_user_statistics(user_id)
+        rollups = None
+        if basic_stats is not None and include_time_statistics:
+            rollups = self.storage.get_upload_rollups(user_id, month_start.isoformat(), today.isoformat())
+        return self._build_snapshot(basic_stats, rollups, include_time_statistics, today, month_start)
+    
+    async def aggregate_async(self, user_id, include_time_statistics=True):
+        """aggregate 的協程版本（供 async 視圖使用，協程中不可呼叫同步的 aggregate）
+        
+        未啟用並行讀取時依序執行同步讀取。
+        """
+        if not self._reads_concurrently(include_time_statistics):
+            return self.aggregate(user_id, include_time_statistics)
+        
+        today = datetime.now(timezone.utc).date()
+        month_start = today - timedelta(days=MONTH_DAYS - 1)
+        basic_stats, rollups = await asyncio.gather(
+            self.storage.get_user_statistics_async(user_id),
+            self.storage.get_upload_rollups_async(user_id, month_start.isoformat(), today.isoformat())
+        )
+        return self._build_snapshot(basic_stats, rollups, include_time_statistics, today, month_start)
+    
+    def _reads_concurrently(self, include_time_statistics):
+        """計數器與每日彙總是否以非同步用戶端並行讀取"""
+        return include_time_statistics and Config.ASYNC_STORAGE and self.storage.supports_async_reads
+    
+    def _build_snapshot(self, basic_stats, rollups, include_time_statistics, today, month_start):
+        """由統計計數器與每日彙總組合聚合結果（計數器讀取失敗時回傳 None）"""
+        if basic_stats is None:
+            return None
+        
+        category_counts = basic_stats.get('category_counts', {})
+        file_type_counts = basic_stats.get('file_type_counts', {})
+        total_count = basic_stats.get('total_knowledge', 0)
+        
+        snapshot = {
+            'basic': basic_stats,
+            'category_distribution': dict(category_counts),
+            'category_statistics': self._build_category_statistics(category_counts, total_count),
+            'file_type_statistics': dict(file_type_counts)
+        }
+        
+        if include_time_statistics:
+            snapshot.update(self._aggregate_time_statistics(rollups or {}, today, month_start))
+        
+        return snapshot
+    
+    def _aggregate_time_statistics(self, rollups, today, month_start, trend_days=7):
+        """由每日上傳彙總計算今日/本週/本月上傳數與上傳趨勢
+        
+        日期皆為 UTC（其他時區使用 get_upload_trend）；本週與本月分別為含今日的最近
+        WEEK_DAYS 與 MONTH_DAYS 天，upload_trend 依日期由舊到新排列。
+        """
+        def uploads_since(start):
+            return sum(
+                rollup.get('count', 0) for day, rollup in rollups.items()
+                if day >= start.isoformat()
+            )
+        
+        upload_trend = []
+        for i in range(trend_days - 1, -1, -1):
+            day = (today - timedelta(days=i)).isoformat()
+            upload_trend.append({
+                'date': day,
+                'count': rollups.get(day, {}).get('count', 0)
+            })
+        
+        return {
+            'today_uploads': uploads_since(today),
+            'weekly_uploads': uploads_since(today - timedelta(days=WEEK_DAYS - 1)),
+            'monthly_uploads': uploads_since(month_start),
+            'upload_trend': upload_trend
+        }
+    
+    def get_upload_trend(self, user_id, days=None, start_date=None, end_date=None, tz_name=None):
+        """獲取任意日期區間的每日上傳趨勢
+        
+        日期以 tz_name 指定的時區計算（預設 UTC），依每日彙總中的每小時分桶
+        換算至當地日期，讀取成本與天數成正比。參數錯誤時拋出 ValueError。
+        """
+        try:
+            tz = ZoneInfo(tz_name or 'UTC')
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"不支援的時區: {tz_name}")
+        
+        end = date.fromisoformat(end_date) if end_date else datetime.now(tz).date()
+        if start_date:
+            start = date.fromisoformat(start_date)
+        else:
+            start = end - timedelta(days=int(days or 7) - 1)
+        
+        if start > end:
+            raise ValueError("開始日期不可晚於結束日期")
+        if (end - start).days + 1 > Config.TREND_MAX_DAYS:
+            raise ValueError(f"日期區間不可超過 {Config.TREND_MAX_DAYS} 天")
+        
         try:
-            # 獲取基本統計
-            basic_stats = self.firebase_service.get_user_statistics(user_id)
+            # 時區位移最多一天，前後各多讀取一天的 UTC 彙總
+            rollups = self.storage.get_upload_rollups(
+                user_id, (start - timedelta(days=1)).isoformat(), (end + timedelta(days=1)).isoformat()
+            )
+            if rollups is None:
+                return False, "無法獲取上傳趨勢", None
             
-            if basic_stats is None:
-                return False, "無法獲取統計資料", None
+            counts = {}
+            sizes = {}
+            category_counts = {}
+            for day, rollup in rollups.items():
+                utc_day = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+                for hour, bucket in (rollup.get('hours') or {}).items():
+                    local_day = (utc_day + timedelta(hours=int(hour))).astimezone(tz).date()
+                    if start <= local_day <= end:
+                        counts[local_day] = counts.get(local_day, 0) + bucket.get('count', 0)
+                        sizes[local_day] = sizes.get(local_day, 0) + bucket.get('bytes', 0)
+                
+                # 分類只按 UTC 日期彙總，以 UTC 日期落在區間內者計算
+                if start.isoformat() <= day <= end.isoformat():
+                    for category, count in (rollup.get('categories') or {}).items():
+                        category_counts[category] = category_counts.get(category, 0) + count
             
-            # 獲取詳細統計
-            detailed_stats = self._get_detailed_statistics(user_id)
+            trend = []
+            for i in range((end - start).days + 1):
+                day = start + timedelta(days=i)
+                trend.append({
+                    'date': day.isoformat(),
+                    'count': counts.get(day, 0),
+                    'bytes': sizes.get(day, 0)
+                })
             
-            # 合併統計資料
-            stats = {
-                **basic_stats,
-                **detailed_stats
+            return True, "上傳趨勢獲取成功", {
+                'from': start.isoformat(),
+                'to': end.isoformat(),
+                'timezone': str(tz),
+                'total_uploads': sum(counts.values()),
+                'total_bytes': sum(sizes.values()),
+                'category_counts': {key: count for key, count in category_counts.items() if count > 0},
+                'trend': trend
             }
             
-            return True, "統計資料獲取成功", stats
-            
         except Exception as e:
-            return False, f"獲取統計資料時發生錯誤: {str(e)}", None
+            return False, f"獲取上傳趨勢時發生錯誤: {str(e)}", None
     
-    def _get_detailed_statistics(self, user_id):
-        """獲取詳細統計資料"""
-        try:
-            # 獲取所有知識條目
-            knowledge_list = self.firebase_service.get_knowledge_list(user_id, limit=1000)
-            
-            if not knowledge_list:
-                return {
-                    'today_uploads': 0,
-                    'weekly_uploads': 0,
-                    'monthly_uploads': 0,
-                    'category_distribution': {},
-                    'upload_trend': []
-                }
-            
-            # 計算時間相關統計
-            now = datetime.now()
-            today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            week_start = today_start - timedelta(days=7)
-            month_start = today_start - timedelta(days=30)
-            
-            today_uploads = 0
-            weekly_uploads = 0
-            monthly_uploads = 0
-            category_count = {}
-            
-            for knowledge in knowledge_list:
-                # 統計上傳時間
-                upload_date = knowledge.get('upload_date')
-                if upload_date:
-                    if isinstance(upload_date, str):
-                        # 如果是字串，嘗試解析
-                        try:
-                            upload_date = datetime.fromisoformat(upload_date.replace('Z', '+00:00'))
-                        except:
-                            continue
-                    
-                    if upload_date >= today_start:
-                        today_uploads += 1
-                    if upload_date >= week_start:
-                        weekly_uploads += 1
-                    if upload_date >= month_start:
-                        monthly_uploads += 1
-                
-                # 統計分類
-                category = knowledge.get('category', '未分類')
-                category_count[category] = category_count.get(category, 0) + 1
-            
-            # 生成上傳趨勢（最近7天）
-            upload_trend = self._generate_upload_trend(knowledge_list)
-            
-            return {
-                'today_uploads': today_uploads,
-                'weekly_uploads': weekly_uploads,
-                'monthly_uploads': monthly_uploads,
-                'category_distribution': category_count,
-                'upload_trend': upload_trend
+    def _build_category_statistics(self, category_counts, total_count):
+        """計算分類數量與百分比"""
+        category_stats = {}
+        for category, count in category_counts.items():
+            category_stats[category] = {
+                'count': count,
+                'percentage': round((count / total_count) * 100, 2) if total_count > 0 else 0
             }
+        return category_stats
+    
+    def _build_user_statistics(self, snapshot):
+        """組合用戶統計資料"""
+        return {
+            **snapshot['basic'],
+            'today_uploads': snapshot['today_uploads'],
+            'weekly_uploads': snapshot['weekly_uploads'],
+            'monthly_uploads': snapshot['monthly_uploads'],
+            'category_distribution': snapshot['category_distribution'],
+            'upload_trend': snapshot['upload_trend']
+        }
+    
+    def get_user_statistics(self, user_id):
+        """獲取用戶統計資料"""
+        try:
+            return self._user_statistics_result(self.aggregate(user_id))
             
         except Exception as e:
-            print(f"獲取詳細統計時發生錯誤: {e}")
-            return {}
+            return False, f"獲取統計資料時發生錯誤: {str(e)}", None
     
-    def _generate_upload_trend(self, knowledge_list):
-        """生成最近7天的上傳趨勢"""
+    async def get_user_statistics_async(self, user_id):
+        """get_user_statistics 的協程版本"""
         try:
-            trend = []
-            now = datetime.now()
-            
-            for i in range(7):
-                date = now - timedelta(days=i)
-                date_start = date.replace(hour=0, minute=0, second=0, microsecond=0)
-                date_end = date_start + timedelta(days=1)
-                
-                count = 0
-                for knowledge in knowledge_list:
-                    upload_date = knowledge.get('upload_date')
-                    if upload_date:
-                        if isinstance(upload_date, str):
-                            try:
-                                upload_date = datetime.fromisoformat(upload_date.replace('Z', '+00:00'))
-                            except:
-                                continue
-                        
-                        if date_start <= upload_date < date_end:
-                            count += 1
-                
-                trend.append({
-                    'date': date.strftime('%Y-%m-%d'),
-                    'count': count
-                })
-            
-            return list(reversed(trend))  # 反轉使日期從舊到新
+            return self._user_statistics_result(await self.aggregate_async(user_id))
             
         except Exception as e:
-            print(f"生成上傳趨勢時發生錯誤: {e}")
-            return []
+            return False, f"獲取統計資料時發生錯誤: {str(e)}", None
+    
+    def _user_statistics_result(self, snapshot):
+        if snapshot is None:
+            return False, "無法獲取統計資料", None
+        
+        return True, "統計資料獲取成功", self._build_user_statistics(snapshot)
     
     def get_category_statistics(self, user_id):
         """獲取分類統計"""
         try:
-            knowledge_list = self.firebase_service.get_knowledge_list(user_id, limit=1000)
-            
-            category_stats = {}
-            total_count = len(knowledge_list)
+            snapshot = self.aggregate(user_id, include_time_statistics=False)
             
-            for knowledge in knowledge_list:
-                category = knowledge.get('category', '未分類')
-                if category not in category_stats:
-                    category_stats[category] = {
-                        'count': 0,
-                        'percentage': 0
-                    }
-                category_stats[category]['count'] += 1
+            if snapshot is None:
+                return False, "無法獲取分類統計", {}
             
-            # 計算百分比
-            if total_count > 0:
-                for category in category_stats:
-                    category_stats[category]['percentage'] = round(
-                        (category_stats[category]['count'] / total_count) * 100, 2
-                    )
-            
-            return True, "分類統計獲取成功", category_stats
+            return True, "分類統計獲取成功", snapshot['category_statistics']
             
         except Exception as e:
             return False, f"獲取分類統計時發生錯誤: {str(e)}", {}
@@ -158,22 +226,43 @@ class StatisticsService:
     def get_file_type_statistics(self, user_id):
         """獲取文件類型統計"""
         try:
-            knowledge_list = self.firebase_service.get_knowledge_list(user_id, limit=1000)
-            
-            file_type_stats = {}
+            snapshot = self.aggregate(user_id, include_time_statistics=False)
             
-            for knowledge in knowledge_list:
-                file_info = knowledge.get('file_info', {})
-                file_type = file_info.get('file_type', '未知')
-                
-                if file_type not in file_type_stats:
-                    file_type_stats[file_type] = 0
-                file_type_stats[file_type] += 1
+            if snapshot is None:
+                return False, "無法獲取文件類型統計", {}
             
-            return True, "文件類型統計獲取成功", file_type_stats
+            return True, "文件類型統計獲取成功", snapshot['file_type_statistics']
             
         except Exception as e:
             return False, f"獲取文件類型統計時發生錯誤: {str(e)}", {}
+    
+    def get_dashboard_statistics(self, user_id):
+        """獲取儀表板數據（單次聚合）"""
+        try:
+            return self._dashboard_result(self.aggregate(user_id))
+            
+        except Exception as e:
+            return False, f"獲取儀表板數據時發生錯誤: {str(e)}", None
+    
+    async def get_dashboard_statistics_async(self, user_id):
+        """get_dashboard_statistics 的協程版本"""
+        try:
+            return self._dashboard_result(await self.aggregate_async(user_id))
+            
+        except Exception as e:
+            return False, f"獲取儀表板數據時發生錯誤: {str(e)}", None
+    
+    def _dashboard_result(self, snapshot):
+        if snapshot is None:
+            return False, "無法獲取統計資料", None
+        
+        dashboard_data = {
+            'basic_statistics': self._build_user_statistics(snapshot),
+            'category_statistics': snapshot['category_statistics'],
+            'file_type_statistics': snapshot['file_type_statistics']
+        }
+        
+        return True, "儀表板數據獲取成功", dashboard_data
 
 # 創建全域實例
 statistics_service = StatisticsService()
\ No newline at end of file
@@ -0,0 +1,18 @@
+﻿from config import Config
+
+def create_storage_backend(backend=None):
+    """依 STORAGE_BACKEND 建立儲存後端（firestore 或 sqlite）"""
+    backend = (backend or Config.STORAGE_BACKEND).lower()
+    
+    if backend == 'firestore':
+        from services.firebase_service import FirebaseService
+        return FirebaseService()
+    
+    if backend == 'sqlite':
+        from services.sqlite_storage import SQLiteStorage
+        return SQLiteStorage(Config.SQLITE_DB_PATH)
+    
+    raise ValueError(f"不支援的儲存後端: {backend}")
+
+# 創建全域實例
+storage = create_storage_backend()
@@ -0,0 +1,472 @@
+﻿import time
+import inspect
+from abc import ABC, abstractmethod
+import threading
+from bisect import bisect_left, bisect_right
+from functools import wraps
+from datetime import datetime
+from services.metrics import metrics
+from services.read_cache import read_cache
+from utils.time_utils import to_utc_naive
+
+# 記錄操作時間指標的後端方法
+INSTRUMENTED_OPERATIONS = (
+    'get_user_profile', 'create_user_profile', 'create_knowledge_entry', 'create_knowledge_entries',
+    'get_knowledge_entry', 'get_knowledge_entries', 'find_knowledge_by_hash', 'stream_knowledge_entries',
+    'update_knowledge_entry', 'delete_knowledge_entry', 'search_knowledge_entries', 'read_knowledge_content',
+    'read_knowledge_passages', 'rebuild_user_statistics',
+    '_load_knowledge_page', '_load_user_statistics', '_load_upload_rollups',
+    '_load_user_statistics_async', '_load_upload_rollups_async'
+)
+
+def _instrument(operation, method):
+    """以操作時間直方圖包裝後端方法（產生器以完整走訪的時間計算，協程以等待完成的時間計算）"""
+    if inspect.iscoroutinefunction(method):
+        @wraps(method)
+        async def coroutine_wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                self._observe_operation(operation, time.perf_counter() - start)
+        return coroutine_wrapper
+    
+    if inspect.isgeneratorfunction(method):
+        @wraps(method)
+        def generator_wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                yield from method(self, *args, **kwargs)
+            finally:
+                self._observe_operation(operation, time.perf_counter() - start)
+        return generator_wrapper
+    
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._observe_operation(operation, time.perf_counter() - start)
+    return wrapper
+
+class StorageBackend(ABC):
+    """知識庫儲存後端介面
+    
+    定義用戶資料、知識條目 CRUD、列表與統計的讀寫方法。列表與統計的讀取
+    經由讀取快取，各後端只需實作 _load_* 方法；寫入後須呼叫
+    read_cache.invalidate 使快取失效。未實作任一抽象方法的後端無法建立實例；
+    search_knowledge_entries 與 migrate_content_encoding 只在對應的 supports_*
+    為 True 時需要實作。
+    """
+    
+    # 指標標籤使用的後端名稱
+    backend_name = 'storage'
+    
+    # 後端是否提供全文搜尋（否則由記憶體倒排索引搜尋）
+    supports_full_text_search = False
+    
+    # 後端是否壓縮保存條目內容（可使用 migrate_content_encoding 改寫既有條目）
+    supports_content_compression = False
+    
+    # 後端是否提供非阻塞的 _load_*_async 讀取（否則協程版本依序執行同步讀取）
+    supports_async_reads = False
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for operation in INSTRUMENTED_OPERATIONS:
+            method = cls.__dict__.get(operation)
+            if method is not None:
+                setattr(cls, operation, _instrument(operation, method))
+    
+    def __init__(self):
+        self._read_tracker = threading.local()
+        self.read_cache = read_cache
+        self.metrics = metrics
+    
+    def _observe_operation(self, operation, elapsed):
+        self.metrics.observe(
+            'storage_operation_duration_seconds', elapsed,
+            {'backend': self.backend_name, 'operation': operation.lstrip('_')}
+        )
+    
+    def reset_read_count(self):
+        """重設目前執行緒的文件讀取、寫入與往返計數"""
+        self._read_tracker.count = 0
+        self._read_tracker.writes = 0
+        self._read_tracker.round_trips = 0
+    
+    def get_read_count(self):
+        """目前執行緒自上次重設以來讀取的文件數"""
+        return getattr(self._read_tracker, 'count', 0)
+    
+    def get_usage(self):
+        """目前執行緒自上次重設以來的 {'reads', 'writes', 'round_trips'}"""
+        return {
+            'reads': self.get_read_count(),
+            'writes': getattr(self._read_tracker, 'writes', 0),
+            'round_trips': getattr(self._read_tracker, 'round_trips', 0)
+        }
+    
+    def _record_reads(self, count):
+        """記錄一次查詢的文件讀取數（查詢即使沒有結果也計為一次讀取）"""
+        self._read_tracker.count = self.get_read_count() + max(1, count)
+        self._read_tracker.round_trips = getattr(self._read_tracker, 'round_trips', 0) + 1
+    
+    def _record_writes(self, count):
+        """記錄一次提交的文件寫入數"""
+        self._read_tracker.writes = getattr(self._read_tracker, 'writes', 0) + count
+        self._read_tracker.round_trips = getattr(self._read_tracker, 'round_trips', 0) + 1
+    
+    def warm_up(self):
+        """預先建立連線（可選，供 worker 啟動時呼叫）"""
+    
+    # 用戶資料
+    
+    @abstractmethod
+    def get_user_profile(self, user_id):
+        """獲取用戶資料"""
+        raise NotImplementedError
+    
+    @abstractmethod
+    def create_user_profile(self, user_id, profile_data):
+        """創建用戶資料"""
+        raise NotImplementedError
+    
+    @abstractmethod
+    def list_user_ids(self):
+        """列出所有用戶ID"""
+        raise NotImplementedError
+    
+    # 知識條目
+    
+    @abstractmethod
+    def create_knowledge_entry(self, user_id, knowledge_data, knowledge_id=None):
+        """創建知識條目，回傳條目 ID（失敗為 None）
+        
+        指定 knowledge_id 時以該 ID 建立；該條目已存在時不重複寫入，直接回傳該 ID
+        （供重新排入的上傳任務重試時使用）。
+        """
+        raise NotImplementedError
+    
+    @abstractmethod
+    def create_knowledge_entries(self, user_id, knowledge_items):
+        """批量創建知識條目，回傳與輸入順序相同的條目 ID 列表（失敗為 None）"""
+        raise NotImplementedError
+    
+    @abstractmethod
+    def get_knowledge_entry(self, user_id, knowledge_id):
+        """獲取單一知識條目"""
+        raise NotImplementedError
+    
+    @abstractmethod
+    def get_knowledge_entries(self, user_id, knowledge_ids, fields=None):
+        """一次讀取多筆知識條目，回傳 {條目 ID: 資料}（不存在的條目不包含在內）"""
+        raise NotImplementedError
+    
+    @abstractmethod
+    def find_knowledge_by_hash(self, user_id, content_hash):
+        """依文件內容雜湊尋找既有知識條目，回傳條目 ID"""
+        raise NotImplementedError
+    
+    @abstractmethod
+    def stream_knowledge_entries(self, user_id, since=None, fields=None, category=None):
+        """逐筆讀取用戶所有知識條目（不受筆數限制，可指定上傳日期下限、讀取欄位與分類）
+        
+        讀取中途失敗時拋出例外，不可只回傳部分條目（搜尋索引、統計重建與批量操作以此判斷是否讀取完整）。
+        """
+        raise NotImplementedError
+    
+    @abstractmethod
+    def update_knowledge_entry(self, user_id, knowledge_id, updates, expected_last_modified=None):
+        """更新知識條目
+        
+        指定 expected_last_modified 時，只在條目的 last_modified 仍為該值（讀取後未被修改）時
+        於同一交易中寫入，否則不寫入並回傳 False。
+        """
+        raise NotImplementedError
+    
+    @abstractmethod
+    def delete_knowledge_entry(self, user_id, knowledge_id):
+        """刪除知識條目"""
+        raise NotImplementedError
+    
+    @abstractmethod
+    def update_knowledge_entries(self, user_id, knowledge_ids, updates):
+        """將相同的更新套用到多筆知識條目
+        
+        回傳 (已更新的條目 {條目 ID: 更新後資料}, 不存在的條目 ID 列表)；
+        兩者皆不包含的條目為寫入失敗。
+        """
+        raise NotImplementedError
+    
+    @abstractmethod
+    def delete_knowledge_entries(self, user_id, knowledge_ids):
+        """刪除多筆知識條目，回傳 (已刪除的條目 ID 列表, 不存在的條目 ID 列表)；兩者皆不包含的條目為寫入失敗"""
+        raise NotImplementedError
+    
+    def search_knowledge_entries(self, user_id, query, category=None, limit=50):
+        """全文搜尋，回傳依分數排序的 (條目 ID, 分數, 中繼資料) 列表"""
+        raise NotImplementedError
+    
+    def read_knowledge_content(self, user_id, knowledge_id, start=None, end=None, page=None, end_page=None, max_chars=None):
+        """讀取知識條目內容的一段，回傳 {'content', 'start', 'end', 'length', 'pages', 'page_count'}
+        
+        可指定字元範圍 [start, end) 或頁碼範圍 page 至 end_page（從 1 起算、含頭尾，
+        條目須有頁碼資訊）；max_chars 限制回傳的字元數。條目不存在時回傳 None，
+        範圍無效時拋出 ValueError。預設讀取完整條目後擷取，後端可覆寫為只讀取需要的部分。
+        """
+        knowledge = self.get_knowledge_entry(user_id, knowledge_id)
+        if knowledge is None:
+            return None
+        
+        content = knowledge.get('content') or ''
+        page_offsets = (knowledge.get('file_info') or {}).get('page_offsets')
+        range_start, range_end = self._resolve_content_range(
+            len(content), page_offsets, start, end, page, end_page, max_chars
+        )
+        return self._content_range_result(content[range_start:range_end], range_start, range_end, len(content), page_offsets)
+    
+    def read_knowledge_passages(self, user_id, passages):
+        """一次讀取多個段落，passages 為 (條目 ID, 起始位置, 結束位置) 列表
+        
+        回傳與輸入順序相同的段落文字列表（條目不存在時為 None）。預設以一次批量讀取
+        取得所有涉及條目的內容後擷取，後端可覆寫為只讀取需要的部分。
+        """
+        knowledge_ids = list(dict.fromkeys(knowledge_id for knowledge_id, _, _ in passages))
+        entries = self.get_knowledge_entries(user_id, knowledge_ids, fields=['content']) if knowledge_ids else {}
+        
+        texts = []
+        for knowledge_id, start, end in passages:
+            knowledge = entries.get(knowledge_id)
+            texts.append((knowledge.get('content') or '')[start:end] if knowledge is not None else None)
+        return texts
+    
+    # 列表與統計（經讀取快取）
+    
+    def get_knowledge_list(self, user_id, category=None, limit=50, fields=None):
+        """獲取知識列表（可指定 fields 只讀取部分欄位）"""
+        knowledge_list, _ = self.get_knowledge_page(user_id, category, limit, fields=fields)
+        return knowledge_list
+    
+    def get_knowledge_page(self, user_id, category=None, limit=50, cursor=None, fields=None):
+        """依上傳日期由新到舊分頁讀取知識列表，回傳 (知識列表, 下一頁位置)
+        
+        以 (upload_date, 條目 ID) 作為排序鍵，cursor 為上一頁最後一筆的
+        {'upload_date': ..., 'id': ...}；期間新增的條目不會造成重複或遺漏。
+        沒有下一頁時下一頁位置為 None。
+        """
+        cache_key = (
+            'knowledge_page', category, limit,
+            (cursor['upload_date'], cursor['id']) if cursor else None,
+            tuple(fields) if fields is not None else None
+        )
+        try:
+            return self.read_cache.get_or_load(
+                user_id, cache_key, lambda: self._load_knowledge_page(user_id, category, limit, cursor, fields)
+            )
+        except Exception as e:
+            print(f"獲取知識列表錯誤: {e}")
+            return [], None
+    
+    def get_user_statistics(self, user_id):
+        """獲取用戶統計資料"""
+        try:
+            return self.read_cache.get_or_load(user_id, ('user_statistics',), lambda: self._load_user_statistics(user_id))
+        except Exception as e:
+            print(f"獲取統計資料錯誤: {e}")
+            return None
+    
+    def get_user_last_modified(self, user_id):
+        """用戶知識資料最後一次寫入（新增、更新或刪除）的 UTC 時間；沒有紀錄時回傳 None"""
+        try:
+            return self.read_cache.get_or_load(user_id, ('last_modified',), lambda: self._load_user_last_modified(user_id))
+        except Exception as e:
+            print(f"獲取最後修改時間錯誤: {e}")
+            return None
+    
+    def get_upload_rollups(self, user_id, start_day, end_day):
+        """讀取 UTC 日期區間（含頭尾，格式 YYYY-MM-DD）的每日上傳彙總，回傳 {日期: 彙總}"""
+        try:
+            return self.read_cache.get_or_load(
+                user_id, ('upload_rollups', start_day, end_day),
+                lambda: self._load_upload_rollups(user_id, start_day, end_day)
+            )
+        except Exception as e:
+            print(f"獲取上傳彙總錯誤: {e}")
+            return None
+    
+    async def get_user_statistics_async(self, user_id):
+        """get_user_statistics 的協程版本（以 event_loop_runner 執行，可與其他讀取並行）"""
+        try:
+            return await self.read_cache.get_or_load_async(
+                user_id, ('user_statistics',), lambda: self._load_user_statistics_async(user_id)
+            )
+        except Exception as e:
+            print(f"獲取統計資料錯誤: {e}")
+            return None
+    
+    async def get_upload_rollups_async(self, user_id, start_day, end_day):
+        """get_upload_rollups 的協程版本"""
+        try:
+            return await self.read_cache.get_or_load_async(
+                user_id, ('upload_rollups', start_day, end_day),
+                lambda: self._load_upload_rollups_async(user_id, start_day, end_day)
+            )
+        except Exception as e:
+            print(f"獲取上傳彙總錯誤: {e}")
+            return None
+    
+    @abstractmethod
+    def rebuild_user_statistics(self, user_id):
+        """重建用戶統計資料，回傳統計總數（失敗為 None）"""
+        raise NotImplementedError
+    
+    def migrate_content_encoding(self, user_id, dry_run=False):
+        """將既有條目內容改寫為目前設定的壓縮格式，回傳改寫統計"""
+        raise NotImplementedError
+    
+    @abstractmethod
+    def _load_knowledge_page(self, user_id, category, limit, cursor, fields):
+        """讀取一頁知識列表（錯誤時拋出例外，不寫入快取）"""
+        raise NotImplementedError
+    
+    @abstractmethod
+    def _load_user_statistics(self, user_id):
+        """讀取用戶統計資料（錯誤時拋出例外，不寫入快取）"""
+        raise NotImplementedError
+    
+    @abstractmethod
+    def _load_upload_rollups(self, user_id, start_day, end_day):
+        """讀取每日上傳彙總（錯誤時拋出例外，不寫入快取）"""
+        raise NotImplementedError
+    
+    async def _load_user_statistics_async(self, user_id):
+        """非同步讀取用戶統計資料；預設直接執行同步讀取（本機資料庫的讀取不需等待網路）"""
+        return self._load_user_statistics(user_id)
+    
+    async def _load_upload_rollups_async(self, user_id, start_day, end_day):
+        """非同步讀取每日上傳彙總；預設直接執行同步讀取"""
+        return self._load_upload_rollups(user_id, start_day, end_day)
+    
+    @abstractmethod
+    def _load_user_last_modified(self, user_id):
+        """讀取用戶資料最後寫入時間（錯誤時拋出例外，不寫入快取）"""
+        raise NotImplementedError
+    
+    # 共用輔助方法
+    
+    def _prepare_knowledge_data(self, knowledge_data):
+        """補上新知識條目的時間戳記與狀態"""
+        knowledge_data.update({
+            'upload_date': datetime.now(),
+            'last_modified': datetime.now(),
+            'status': 'completed'
+        })
+        return knowledge_data
+    
+    def _merge_updates(self, knowledge_data, updates):
+        """回傳套用更新後的條目副本（updates 的鍵可使用 a.b 表示巢狀欄位）"""
+        knowledge = dict(knowledge_data)
+        for key, value in updates.items():
+            target = knowledge
+            parts = key.split('.')
+            for part in parts[:-1]:
+                nested = target.get(part)
+                target[part] = dict(nested) if isinstance(nested, dict) else {}
+                target = target[part]
+            target[parts[-1]] = value
+        return knowledge
+    
+    def _knowledge_size(self, knowledge_data):
+        """上傳文件以原始文件大小計算，手動建立的條目以內容位元組數計算"""
+        file_info = knowledge_data.get('file_info') or {}
+        if 'file_size' in file_info:
+            return file_info.get('file_size') or 0
+        return len((knowledge_data.get('content') or '').encode('utf-8'))
+    
+    def _statistics_contribution(self, knowledge_data):
+        """單一知識條目對統計計數器的貢獻"""
+        if not knowledge_data:
+            return {}
+        
+        file_info = knowledge_data.get('file_info') or {}
+        return {
+            ('total_knowledge',): 1,
+            ('bytes_stored',): self._knowledge_size(knowledge_data),
+            ('categories', knowledge_data.get('category') or '未分類'): 1,
+            ('file_types', file_info.get('file_type') or '未知'): 1
+        }
+    
+    def _rollup_contribution(self, knowledge_data):
+        """單一知識條目對每日上傳彙總的貢獻，回傳 (UTC 日期, {路徑: 增量})"""
+        if not knowledge_data:
+            return None, {}
+        
+        upload_date = to_utc_naive(knowledge_data.get('upload_date'))
+        if upload_date is None:
+            return None, {}
+        
+        size = self._knowledge_size(knowledge_data)
+        hour = f"{upload_date.hour:02d}"
+        return upload_date.strftime('%Y-%m-%d'), {
+            ('count',): 1,
+            ('bytes',): size,
+            ('hours', hour, 'count'): 1,
+            ('hours', hour, 'bytes'): size,
+            ('categories', knowledge_data.get('category') or '未分類'): 1
+        }
+    
+    def _resolve_content_range(self, length, page_offsets, start, end, page, end_page, max_chars):
+        """將字元或頁碼範圍轉為內容中的 (起始位置, 結束位置)，範圍無效時拋出 ValueError"""
+        if page is not None:
+            if not page_offsets:
+                raise ValueError("此知識條目沒有頁碼資訊")
+            end_page = page if end_page is None else end_page
+            if not 1 <= page <= end_page <= len(page_offsets):
+                raise ValueError(f"頁碼須介於 1 到 {len(page_offsets)} 之間")
+            start = page_offsets[page - 1]
+            end = page_offsets[end_page] if end_page < len(page_offsets) else length
+        else:
+            start = 0 if start is None else start
+            end = length if end is None else end
+            if start < 0 or end < start:
+                raise ValueError("無效的字元範圍")
+        
+        start = min(start, length)
+        end = min(end, length)
+        if max_chars is not None:
+            end = min(end, start + max_chars)
+        return start, end
+    
+    def _content_range_result(self, content, start, end, length, page_offsets):
+        """組合內容片段的回傳資料（pages 為片段涵蓋的頁碼範圍）"""
+        pages = None
+        if page_offsets:
+            first_page = max(1, bisect_right(page_offsets, start))
+            pages = [first_page, max(first_page, bisect_left(page_offsets, end))]
+        return {
+            'content': content,
+            'start': start,
+            'end': end,
+            'length': length,
+            'pages': pages,
+            'page_count': len(page_offsets) if page_offsets is not None else None
+        }
+    
+    def _build_statistics(self, total_knowledge, bytes_stored, category_counts, file_type_counts):
+        """組合用戶統計資料（略過數量為 0 的分類與文件類型）
+        
+        今日與本週上傳數由 StatisticsService 依每日上傳彙總計算，不在計數器統計中提供。
+        """
+        category_counts = {key: count for key, count in category_counts.items() if count > 0}
+        file_type_counts = {key: count for key, count in file_type_counts.items() if count > 0}
+        
+        return {
+            'total_knowledge': total_knowledge,
+            'categories_count': len(category_counts),
+            'category_counts': category_counts,
+            'file_type_counts': file_type_counts,
+            'bytes_stored': bytes_stored,
+            'knowledge_completion': 100  # 簡化版本
+        }
@@ -0,0 +1,433 @@
+﻿import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from config import Config
+from services.file_processor import file_processor
+from services.knowledge_service import knowledge_service
+from utils.upload_spool import persist_spool
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS upload_jobs (
+    job_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    category TEXT,
+    total_files INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_job_files (
+    job_id TEXT NOT NULL,
+    file_index INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    title TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    spool_path TEXT,
+    status TEXT NOT NULL,
+    message TEXT,
+    knowledge_id TEXT,
+    start_page INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_pid INTEGER,
+    worker_token TEXT,
+    heartbeat_at TEXT,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    PRIMARY KEY (job_id, file_index)
+);
+CREATE INDEX IF NOT EXISTS idx_upload_job_files_status ON upload_job_files (status, created_at);
+"""
+
+class UploadJobQueue:
+    """以 SQLite 保存的非同步上傳任務佇列
+    
+    上傳的文件先保存到本機暫存目錄並寫入佇列，由背景工作執行緒逐一提取文字
+    並建立知識條目。佇列狀態保存在磁碟上，同一主機的多個 gunicorn worker
+    共用同一佇列；處理中的文件由處理程序定期更新心跳時間，程序中斷後心跳逾時的
+    文件會重新排入佇列。
+    """
+    
+    def __init__(self, job_dir, worker_count, poll_interval, max_attempts, retention_hours,
+                 heartbeat_interval=10.0, heartbeat_timeout=60.0):
+        self.job_dir = job_dir
+        self.db_path = os.path.join(job_dir, 'upload_jobs.sqlite3')
+        self.files_dir = os.path.join(job_dir, 'files')
+        self.worker_count = worker_count
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retention_hours = retention_hours
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self._workers_pid = None
+        self._worker_token = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._initialized = False
+    
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+    
+    def _ensure_initialized(self):
+        if self._initialized:
+            return
+        
+        with self._lock:
+            if self._initialized:
+                return
+            os.makedirs(self.files_dir, exist_ok=True)
+            connection = self._connect()
+            try:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.executescript(SCHEMA)
+                self._migrate(connection)
+            finally:
+                connection.close()
+            self._initialized = True
+    
+    def _migrate(self, connection):
+        """為舊版佇列資料庫補上新增的欄位"""
+        columns = {row['name'] for row in connection.execute('PRAGMA table_info(upload_job_files)')}
+        if 'start_page' not in columns:
+            connection.execute('ALTER TABLE upload_job_files ADD COLUMN start_page INTEGER')
+        if 'worker_token' not in columns:
+            connection.execute('ALTER TABLE upload_job_files ADD COLUMN worker_token TEXT')
+            connection.execute('ALTER TABLE upload_job_files ADD COLUMN heartbeat_at TEXT')
+    
+    def _ensure_workers(self):
+        """在目前程序啟動背景工作與心跳執行緒（fork 後於各 worker 中分別啟動）
+        
+        每個程序以隨機 token 識別所處理的文件；容器重啟後 pid 可能被重複使用，
+        不能以 pid 判斷處理者是否仍在執行。
+        """
+        if self._workers_pid == os.getpid():
+            return
+        
+        with self._lock:
+            if self._workers_pid == os.getpid():
+                return
+            self._workers_pid = os.getpid()
+            self._worker_token = uuid.uuid4().hex
+            self._wakeup = threading.Event()
+            threading.Thread(
+                target=self._heartbeat_loop, args=(self._worker_token,), name='upload-job-heartbeat', daemon=True
+            ).start()
+            for index in range(self.worker_count):
+                worker = threading.Thread(target=self._worker_loop, name=f'upload-job-worker-{index}', daemon=True)
+                worker.start()
+    
+    def submit(self, user_id, files, category='未分類'):
+        """提交上傳任務
+        
+        files 為 (spool, filename, title, tags) 列表，回傳任務 ID。
+        """
+        self._ensure_initialized()
+        
+        job_id = uuid.uuid4().hex
+        now = datetime.now().isoformat()
+        job_files_dir = os.path.join(self.files_dir, job_id)
+        os.makedirs(job_files_dir, exist_ok=True)
+        
+        rows = []
+        for index, (spool, filename, title, tags) in enumerate(files):
+            spool_path = persist_spool(spool, os.path.join(job_files_dir, str(index)))
+            # 預先產生條目 ID，使任務在建立條目後中斷而重新排入時不會建立重複條目
+            knowledge_id = uuid.uuid4().hex[:20]
+            rows.append((job_id, index, filename, title, json.dumps(tags, ensure_ascii=False), spool_path, 'queued',
+                         knowledge_id, now))
+        
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(
+                'INSERT INTO upload_jobs (job_id, user_id, category, total_files, created_at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, user_id, category, len(rows), now)
+            )
+            connection.executemany(
+                'INSERT INTO upload_job_files (job_id, file_index, filename, title, tags, spool_path, status, '
+                'knowledge_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        
+        self._ensure_workers()
+        self._wakeup.set()
+        return job_id
+    
+    def defer_extraction(self, user_id, knowledge_id, file_content, filename, start_page):
+        """排入延後提取任務：提取 PDF 自 start_page 起的剩餘頁面並接續至既有知識條目
+        
+        file_content 為上傳暫存檔，回傳任務 ID。
+        """
+        self._ensure_initialized()
+        
+        job_id = uuid.uuid4().hex
+        now = datetime.now().isoformat()
+        job_files_dir = os.path.join(self.files_dir, job_id)
+        os.makedirs(job_files_dir, exist_ok=True)
+        spool_path = persist_spool(file_content, os.path.join(job_files_dir, '0'))
+        
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(
+                'INSERT INTO upload_jobs (job_id, user_id, category, total_files, created_at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, user_id, None, 1, now)
+            )
+            connection.execute(
+                'INSERT INTO upload_job_files (job_id, file_index, filename, title, tags, spool_path, status, '
+                'knowledge_id, start_page, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, 0, filename, filename, '[]', spool_path, 'queued', knowledge_id, start_page, now)
+            )
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        
+        self._ensure_workers()
+        self._wakeup.set()
+        return job_id
+    
+    def get_job(self, job_id):
+        """查詢任務與各文件的處理進度"""
+        self._ensure_initialized()
+        
+        connection = self._connect()
+        try:
+            job = connection.execute('SELECT * FROM upload_jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if job is None:
+                return None
+            file_rows = connection.execute(
+                'SELECT * FROM upload_job_files WHERE job_id = ? ORDER BY file_index', (job_id,)
+            ).fetchall()
+        finally:
+            connection.close()
+        
+        files = []
+        counts = {'queued': 0, 'processing': 0, 'completed': 0, 'failed': 0}
+        for row in file_rows:
+            counts[row['status']] += 1
+            files.append({
+                'filename': row['filename'],
+                'status': row['status'],
+                'success': row['status'] == 'completed' if row['status'] in ('completed', 'failed') else None,
+                # 一般文件的條目 ID 於提交時預先產生，完成前不回報
+                'knowledge_id': row['knowledge_id'] if row['status'] == 'completed' or row['start_page'] is not None else None,
+                'message': row['message']
+            })
+        
+        if counts['queued'] == len(files):
+            status = 'queued'
+        elif counts['queued'] or counts['processing']:
+            status = 'processing'
+        else:
+            status = 'completed'
+        
+        return {
+            'job_id': job['job_id'],
+            'user_id': job['user_id'],
+            'status': status,
+            'created_at': job['created_at'],
+            'total_files': job['total_files'],
+            'completed_files': counts['completed'],
+            'failed_files': counts['failed'],
+            'pending_files': counts['queued'] + counts['processing'],
+            'files': files
+        }
+    
+    def _requeue_stale(self, connection):
+        """將心跳逾時（處理程序已結束）的處理中文件重新排入佇列
+        
+        舊版佇列遺留、沒有心跳時間的文件以開始處理時間判斷。
+        """
+        cutoff = (datetime.now() - timedelta(seconds=self.heartbeat_timeout)).isoformat()
+        rows = connection.execute(
+            "SELECT job_id, file_index, attempts FROM upload_job_files "
+            "WHERE status = 'processing' AND worker_token IS NOT ? AND COALESCE(heartbeat_at, started_at) < ?",
+            (self._worker_token, cutoff)
+        ).fetchall()
+        for row in rows:
+            if row['attempts'] >= self.max_attempts:
+                connection.execute(
+                    "UPDATE upload_job_files SET status = 'failed', message = ?, finished_at = ? "
+                    "WHERE job_id = ? AND file_index = ? AND status = 'processing'",
+                    ('處理過程中斷次數過多', datetime.now().isoformat(), row['job_id'], row['file_index'])
+                )
+            else:
+                connection.execute(
+                    "UPDATE upload_job_files SET status = 'queued', worker_pid = NULL, worker_token = NULL, heartbeat_at = NULL "
+                    "WHERE job_id = ? AND file_index = ? AND status = 'processing'",
+                    (row['job_id'], row['file_index'])
+                )
+    
+    def _heartbeat_loop(self, token):
+        """定期更新本程序處理中文件的心跳時間"""
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                connection = self._connect()
+                try:
+                    connection.execute(
+                        "UPDATE upload_job_files SET heartbeat_at = ? WHERE status = 'processing' AND worker_token = ?",
+                        (datetime.now().isoformat(), token)
+                    )
+                finally:
+                    connection.close()
+            except Exception as e:
+                print(f"上傳任務心跳錯誤: {e}")
+    
+    def _claim_next(self):
+        """取得下一個待處理文件並標記為處理中"""
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            self._requeue_stale(connection)
+            row = connection.execute(
+                'SELECT f.*, j.user_id, j.category FROM upload_job_files f '
+                'JOIN upload_jobs j ON j.job_id = f.job_id '
+                "WHERE f.status = 'queued' ORDER BY f.created_at, f.file_index LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                now = datetime.now().isoformat()
+                connection.execute(
+                    "UPDATE upload_job_files SET status = 'processing', worker_pid = ?, worker_token = ?, "
+                    'attempts = attempts + 1, started_at = ?, heartbeat_at = ? '
+                    'WHERE job_id = ? AND file_index = ?',
+                    (os.getpid(), self._worker_token, now, now, row['job_id'], row['file_index'])
+                )
+            connection.execute('COMMIT')
+            return row
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+    
+    def _finish(self, row, success, message, knowledge_id=None):
+        connection = self._connect()
+        try:
+            connection.execute(
+                'UPDATE upload_job_files SET status = ?, message = ?, knowledge_id = ?, spool_path = NULL, finished_at = ? '
+                'WHERE job_id = ? AND file_index = ?',
+                ('completed' if success else 'failed', message, knowledge_id, datetime.now().isoformat(),
+                 row['job_id'], row['file_index'])
+            )
+        finally:
+            connection.close()
+        
+        if row['spool_path']:
+            try:
+                os.remove(row['spool_path'])
+            except OSError:
+                pass
+    
+    def _process(self, row):
+        """提取文字並建立知識條目"""
+        spool_path = row['spool_path']
+        if row['start_page'] is not None:
+            self._process_remainder(row)
+            return
+        
+        success, message, processed_data = file_processor.process_file(spool_path, row['filename'])
+        if not success:
+            self._finish(row, False, message)
+            return
+        
+        success, create_message, knowledge_id = knowledge_service.create_knowledge(
+            user_id=row['user_id'],
+            title=row['title'],
+            category=row['category'],
+            tags=json.loads(row['tags']),
+            content=processed_data['content'],
+            file_info=processed_data['file_info'],
+            knowledge_id=row['knowledge_id']
+        )
+        if success:
+            self._finish(row, True, '上傳成功', knowledge_id)
+        else:
+            self._finish(row, False, create_message)
+    
+    def _process_remainder(self, row):
+        """提取延後的 PDF 頁面並接續至既有知識條目"""
+        success, content, page_offsets = file_processor.extract_pdf_pages(row['spool_path'], row['start_page'])
+        if not success:
+            self._finish(row, False, content, row['knowledge_id'])
+            return
+        
+        success, message = knowledge_service.append_extracted_content(
+            row['user_id'], row['knowledge_id'], content, page_offsets
+        )
+        self._finish(row, success, '提取完成' if success else message, row['knowledge_id'])
+    
+    def _cleanup(self):
+        """清除超過保存期限的已完成任務"""
+        cutoff = (datetime.now() - timedelta(hours=self.retention_hours)).isoformat()
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            expired = [
+                row['job_id'] for row in connection.execute(
+                    'SELECT job_id FROM upload_jobs WHERE created_at < ? AND job_id NOT IN '
+                    "(SELECT job_id FROM upload_job_files WHERE status IN ('queued', 'processing'))",
+                    (cutoff,)
+                )
+            ]
+            for job_id in expired:
+                connection.execute('DELETE FROM upload_job_files WHERE job_id = ?', (job_id,))
+                connection.execute('DELETE FROM upload_jobs WHERE job_id = ?', (job_id,))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        
+        for job_id in expired:
+            job_files_dir = os.path.join(self.files_dir, job_id)
+            try:
+                for filename in os.listdir(job_files_dir):
+                    os.remove(os.path.join(job_files_dir, filename))
+                os.rmdir(job_files_dir)
+            except OSError:
+                pass
+    
+    def _worker_loop(self):
+        last_cleanup = 0
+        while True:
+            try:
+                if time.monotonic() - last_cleanup > 3600:
+                    self._cleanup()
+                    last_cleanup = time.monotonic()
+                
+                row = self._claim_next()
+                if row is None:
+                    # 等待新任務（其他程序提交的任務以輪詢發現）
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+                
+                try:
+                    self._process(row)
+                except Exception as e:
+                    self._finish(row, False, f'處理文件時發生錯誤: {str(e)}')
+            except Exception as e:
+                print(f"上傳任務處理錯誤: {e}")
+                time.sleep(self.poll_interval)
+    
+    def start(self):
+        """啟動背景工作執行緒（處理先前遺留的任務）"""
+        self._ensure_initialized()
+        self._ensure_workers()
+
+# 創建全域實例
+upload_job_queue = UploadJobQueue(
+    job_dir=Config.UPLOAD_JOB_DIR,
+    worker_count=Config.UPLOAD_JOB_WORKERS,
+    poll_interval=Config.UPLOAD_JOB_POLL_INTERVAL,
+    max_attempts=Config.UPLOAD_JOB_MAX_ATTEMPTS,
+    retention_hours=Config.UPLOAD_JOB_RETENTION_HOURS,
+    heartbeat_interval=Config.UPLOAD_JOB_HEARTBEAT_INTERVAL,
+    heartbeat_timeout=Config.UPLOAD_JOB_HEARTBEAT_TIMEOUT
+)
@@ -0,0 +1,22 @@
+﻿import time
+import threading
+from services.storage import storage
+from services.file_processor import file_processor
+
+def warm_up():
+    """預先建立儲存後端連線並載入提取函式庫，回傳各步驟耗時（秒）"""
+    timings = {}
+    for name, step in (('storage', storage.warm_up), ('extractors', file_processor.warm_up)):
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            print(f"預熱 {name} 錯誤: {e}")
+        timings[name] = round(time.perf_counter() - start, 4)
+    return timings
+
+def start_warm_up():
+    """在背景執行緒預熱，不延遲 worker 開始接受請求"""
+    thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,12 @@
+﻿import os
+import sys
+
+# 測試在單一程序內執行，不使用提取程序池、跨程序共用狀態與指標檔案
+os.environ.setdefault('EXTRACTION_POOL_SIZE', '0')
+os.environ.setdefault('READ_CACHE_GENERATION_DB', '')
+os.environ.setdefault('METRICS_DIR', '')
+os.environ.setdefault('ADMISSION_DB', '')
+os.environ.setdefault('STORAGE_BACKEND', 'sqlite')
+os.environ.setdefault('SQLITE_DB_PATH', ':memory:')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,26 @@
+﻿import pytest
+from utils.encoding_detector import SAMPLE_SIZE, decode_text
+
+# 開頭取樣之後才出現中文的文件（如英文前言較長的 README）
+ASCII_PREAMBLE = ('This project is documented in English first. ' * 400)[:SAMPLE_SIZE + 1024] + '\n'
+# 中文只在結尾少量出現，錯誤數低於容許比例，不能只靠逐一嘗試候選編碼時的錯誤數判斷
+TRADITIONAL_TEXT = '授權說明：請參閱檔案。\n'
+SIMPLIFIED_TEXT = '许可说明：请参阅文件。\n'
+
+
+@pytest.mark.parametrize('text, encoding', [
+    (TRADITIONAL_TEXT, 'big5'),
+    (SIMPLIFIED_TEXT, 'gbk')
+], ids=['big5', 'gbk'])
+def test_ascii_prefixed_multibyte_file(text, encoding):
+    content = ASCII_PREAMBLE + text
+    decoded, detected = decode_text(content.encode(encoding))
+    
+    assert detected == encoding
+    assert decoded == content
+    assert '�' not in decoded
+
+
+def test_ascii_prefixed_utf8_file():
+    content = ASCII_PREAMBLE + TRADITIONAL_TEXT
+    assert decode_text(content.encode('utf-8')) == (content, 'utf-8')
@@ -0,0 +1,119 @@
+﻿import pytest
+from services.read_cache import GenerationStore
+from services.search_index import SearchIndexManager, UserSearchIndex
+from services.passage_index import UserPassageIndex
+from utils import text_tokenizer
+
+DOCUMENTS = {
+    'ml': {'title': '機器學習入門', 'category': '研究', 'content': '深度學習與神經網路的基礎概念，使用 Python programming 實作。'},
+    'cook': {'title': '料理筆記', 'category': '生活', 'content': '今天做了番茄炒蛋，味道很好。'},
+    'alone': {'title': '筆記', 'category': '生活', 'content': '學 是單獨出現的字。'}
+}
+
+
+def _search_index():
+    index = UserSearchIndex()
+    for doc_id, data in DOCUMENTS.items():
+        index.add_document(doc_id, data)
+    return index
+
+
+def _passage_index():
+    index = UserPassageIndex(passage_chars=200, passage_overlap=20)
+    for doc_id, data in DOCUMENTS.items():
+        index.add_document(doc_id, data)
+    return index
+
+
+def test_single_cjk_character_matches_inside_longer_runs():
+    assert {doc_id for doc_id, _, _ in _search_index().search('學')} == {'ml', 'alone'}
+    assert {doc_id for doc_id, _, _, _ in _passage_index().retrieve('學', k=5)} == {'ml', 'alone'}
+
+
+def test_latin_prefix_matches_longer_words():
+    for query in ('program', 'pyth', 'Programming'):
+        assert [doc_id for doc_id, _, _ in _search_index().search(query)] == ['ml']
+        assert [doc_id for doc_id, _, _, _ in _passage_index().retrieve(query, k=5)] == ['ml']
+
+
+def test_short_latin_terms_match_whole_words_only():
+    assert _search_index().search('py') == []
+
+
+def test_expansion_follows_writes():
+    index = _search_index()
+    index.add_document('new', {'title': '統計學', 'content': 'statistics'})
+    assert 'new' in {doc_id for doc_id, _, _ in index.search('學')}
+    assert [doc_id for doc_id, _, _ in index.search('stat')] == ['new']
+    
+    index.remove_document('ml')
+    assert {doc_id for doc_id, _, _ in index.search('學')} == {'alone', 'new'}
+    assert index.search('program') == []
+
+
+def test_multi_character_queries_still_require_all_terms():
+    assert [doc_id for doc_id, _, _ in _search_index().search('深度學習')] == ['ml']
+    assert _search_index().search('深度料理') == []
+
+
+def test_failed_load_is_not_cached():
+    attempts = []
+    
+    def loader(user_id):
+        attempts.append(user_id)
+        yield {'id': 'ml', **DOCUMENTS['ml']}
+        if len(attempts) == 1:
+            raise ConnectionError('stream interrupted')
+        yield {'id': 'cook', **DOCUMENTS['cook']}
+    
+    manager = SearchIndexManager(loader, GenerationStore())
+    with pytest.raises(ConnectionError):
+        manager.search('u1', '番茄')
+    
+    assert [doc_id for doc_id, _, _ in manager.search('u1', '番茄')] == ['cook']
+    assert len(attempts) == 2
+
+
+def test_stale_index_catches_up_only_changed_entries():
+    store = {doc_id: {**data, 'last_modified': 1} for doc_id, data in DOCUMENTS.items()}
+    fetched = []
+    
+    def loader(user_id):
+        return [{'id': doc_id, **data} for doc_id, data in store.items()]
+    
+    def fetcher(user_id, doc_ids):
+        fetched.append(sorted(doc_ids))
+        return {doc_id: dict(store[doc_id]) for doc_id in doc_ids if doc_id in store}
+    
+    generations = GenerationStore()
+    manager = SearchIndexManager(loader, generations, version_loader=loader, fetcher=fetcher)
+    index = manager.get_index('u1')
+    assert [doc_id for doc_id, _, _ in manager.search('u1', '番茄')] == ['cook']
+    
+    # 其他程序期間的多次寫入：修改、刪除與新增
+    store['cook'] = {**store['cook'], 'content': '今天做了咖哩飯。', 'last_modified': 2}
+    del store['ml']
+    store['soup'] = {'title': '湯品', 'content': '番茄蛋花湯', 'last_modified': 2}
+    generations.bump('u1')
+    generations.bump('u1')
+    
+    assert [doc_id for doc_id, _, _ in manager.search('u1', '番茄')] == ['soup']
+    assert [doc_id for doc_id, _, _ in manager.search('u1', '咖哩')] == ['cook']
+    assert manager.search('u1', '深度學習') == []
+    assert manager.get_index('u1') is index
+    assert fetched == [['cook', 'soup']]
+
+
+def test_expansion_cap_keeps_most_frequent_terms(monkeypatch):
+    monkeypatch.setattr(text_tokenizer, 'MAX_EXPANSIONS', 3)
+    documents = {f'rare{index}': {'content': f'學{char}'} for index, char in enumerate('一丁七丈')}
+    documents.update({f'common{index}': {'content': '學習'} for index in range(3)})
+    
+    search_index = UserSearchIndex()
+    passage_index = UserPassageIndex(passage_chars=200, passage_overlap=20)
+    for doc_id, data in documents.items():
+        search_index.add_document(doc_id, data)
+        passage_index.add_document(doc_id, data)
+    
+    assert {f'common{index}' for index in range(3)} <= {doc_id for doc_id, _, _ in search_index.search('學')}
+    assert {f'common{index}' for index in range(3)} <= {doc_id for doc_id, _, _, _ in passage_index.retrieve('學', k=10)}
@@ -0,0 +1,23 @@
+﻿import pytest
+from benchmarks.memory_storage import InMemoryStorage
+from services.firebase_service import FirebaseService
+from services.sqlite_storage import SQLiteStorage
+from services.storage_backend import StorageBackend
+
+
+def test_incomplete_backend_cannot_be_instantiated():
+    class PartialStorage(StorageBackend):
+        def get_user_profile(self, user_id):
+            return None
+    
+    with pytest.raises(TypeError, match='_load_user_statistics'):
+        PartialStorage()
+
+
+@pytest.mark.parametrize('backend', [SQLiteStorage, FirebaseService, InMemoryStorage])
+def test_backends_implement_every_abstract_method(backend):
+    assert not backend.__abstractmethods__
+
+
+def test_complete_backend_instantiates():
+    assert InMemoryStorage().get_user_profile('u1') is None
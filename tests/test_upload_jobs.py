@@ -0,0 +1,92 @@
+﻿import os
+import time
+from datetime import datetime, timedelta
+import pytest
+from benchmarks.memory_storage import InMemoryStorage
+from services.knowledge_service import knowledge_service
+from services.upload_jobs import UploadJobQueue
+from utils.upload_spool import SpoolFile
+
+
+@pytest.fixture
+def queue(tmp_path):
+    # 不啟動工作執行緒，由測試直接呼叫 _claim_next
+    queue = UploadJobQueue(str(tmp_path), worker_count=0, poll_interval=0.1, max_attempts=3, retention_hours=1,
+                           heartbeat_interval=0.05, heartbeat_timeout=60)
+    queue.start()
+    return queue
+
+
+def submit_file(queue):
+    spool = SpoolFile(1024)
+    spool.write(b'hello')
+    with spool:
+        return queue.submit('u1', [(spool, 'a.txt', 'a', [])])
+
+
+def mark_processing(queue, job_id, token, heartbeat_at):
+    """模擬其他程序正在處理的文件（pid 與目前程序相同，如容器重啟後重複使用的 pid）"""
+    connection = queue._connect()
+    try:
+        connection.execute(
+            "UPDATE upload_job_files SET status = 'processing', worker_pid = ?, worker_token = ?, attempts = 1, "
+            'started_at = ?, heartbeat_at = ? WHERE job_id = ?',
+            (os.getpid(), token, heartbeat_at.isoformat(), heartbeat_at.isoformat(), job_id)
+        )
+    finally:
+        connection.close()
+
+
+def test_stale_heartbeat_is_requeued_even_if_pid_is_reused(queue):
+    job_id = submit_file(queue)
+    mark_processing(queue, job_id, 'previous-process', datetime.now() - timedelta(minutes=5))
+    
+    row = queue._claim_next()
+    
+    assert row is not None and row['job_id'] == job_id
+    assert queue.get_job(job_id)['files'][0]['status'] == 'processing'
+
+
+def test_live_heartbeat_is_not_requeued(queue):
+    job_id = submit_file(queue)
+    mark_processing(queue, job_id, 'other-process', datetime.now())
+    
+    assert queue._claim_next() is None
+
+
+def test_heartbeat_refreshes_claimed_files(queue):
+    job_id = submit_file(queue)
+    row = queue._claim_next()
+    assert row['job_id'] == job_id
+    
+    connection = queue._connect()
+    try:
+        claimed_at = connection.execute('SELECT heartbeat_at FROM upload_job_files WHERE job_id = ?', (job_id,)).fetchone()[0]
+        time.sleep(0.2)
+        refreshed_at = connection.execute('SELECT heartbeat_at FROM upload_job_files WHERE job_id = ?', (job_id,)).fetchone()[0]
+    finally:
+        connection.close()
+    
+    assert refreshed_at > claimed_at
+
+
+def test_requeued_job_does_not_duplicate_created_entry(queue, monkeypatch):
+    storage = InMemoryStorage()
+    monkeypatch.setattr(knowledge_service, 'storage', storage)
+    job_id = submit_file(queue)
+    
+    # 模擬建立條目後、記錄完成前程序中斷
+    with monkeypatch.context() as patch:
+        patch.setattr(queue, '_finish', lambda *args, **kwargs: None)
+        queue._process(queue._claim_next())
+    assert queue.get_job(job_id)['files'][0]['knowledge_id'] is None
+    
+    mark_processing(queue, job_id, 'previous-process', datetime.now() - timedelta(minutes=5))
+    queue._process(queue._claim_next())
+    
+    knowledge_ids = list(storage._entries['u1'])
+    assert len(knowledge_ids) == 1
+    assert queue.get_job(job_id)['files'][0] == {
+        'filename': 'a.txt', 'status': 'completed', 'success': True,
+        'knowledge_id': knowledge_ids[0], 'message': '上傳成功'
+    }
@@ -0,0 +1,109 @@
+﻿import io
+import os
+import tracemalloc
+import pytest
+from flask import request
+from config import Config
+from main import create_app
+from utils.upload_spool import SpoolFile
+
+BOUNDARY = 'spool-test-boundary'
+MB = 1024 * 1024
+# 單一請求解析期間允許的 Python 配置峰值（與文件大小無關）
+PEAK_LIMIT = 2 * MB
+
+
+class MultipartStream(io.RawIOBase):
+    """依需要產生 multipart 請求本文，不在記憶體中保存整個上傳內容"""
+    
+    def __init__(self, size):
+        self.head = (
+            f'--{BOUNDARY}\r\n'
+            'Content-Disposition: form-data; name="file"; filename="large.txt"\r\n'
+            'Content-Type: text/plain\r\n\r\n'
+        ).encode()
+        self.tail = f'\r\n--{BOUNDARY}--\r\n'.encode()
+        self.size = size
+        self.length = len(self.head) + size + len(self.tail)
+        self.position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.length}[whence]
+        self.position = max(0, min(self.length, base + offset))
+        return self.position
+    
+    def readinto(self, buffer):
+        count = min(len(buffer), self.length - self.position)
+        body_end = len(self.head) + self.size
+        written = 0
+        while written < count:
+            position = self.position + written
+            if position < len(self.head):
+                chunk = self.head[position:position + count - written]
+            elif position < body_end:
+                chunk = b'a' * min(count - written, body_end - position)
+            else:
+                offset = position - body_end
+                chunk = self.tail[offset:offset + count - written]
+            buffer[written:written + len(chunk)] = chunk
+            written += len(chunk)
+        self.position += count
+        return count
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(Config, 'MAX_FILE_SIZE', 32 * MB)
+    app = create_app()
+    app.config['MAX_CONTENT_LENGTH'] = 64 * MB
+    return app
+
+
+def parse_upload(app, size):
+    """解析一個 size 位元組的上傳，回傳 (暫存檔狀態, 解析期間的配置峰值)"""
+    stream = MultipartStream(size)
+    with app.test_request_context(
+        '/api/upload',
+        method='POST',
+        input_stream=stream,
+        content_type=f'multipart/form-data; boundary={BOUNDARY}',
+        content_length=stream.length
+    ):
+        tracemalloc.start()
+        try:
+            spool = request.files['file'].stream
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        
+        # 請求結束時暫存檔即被關閉刪除，須在請求內檢查
+        assert isinstance(spool, SpoolFile)
+        spool.flush()
+        state = {'size': spool.size, 'exceeded': spool.exceeded, 'stored': os.path.getsize(spool.path)}
+    return state, peak
+
+
+def test_upload_peak_memory_is_independent_of_file_size(app):
+    peaks = []
+    for size in (1 * MB, 8 * MB, 24 * MB):
+        state, peak = parse_upload(app, size)
+        assert state == {'size': size, 'exceeded': False, 'stored': size}
+        peaks.append(peak)
+    
+    assert max(peaks) < PEAK_LIMIT, peaks
+    # 文件大小增加 24 倍，峰值不應隨之成長
+    assert peaks[-1] < peaks[0] + 256 * 1024, peaks
+
+
+def test_oversized_upload_is_discarded(app):
+    state, peak = parse_upload(app, 40 * MB)
+    
+    assert state['exceeded']
+    assert state['stored'] == 0
+    assert peak < PEAK_LIMIT
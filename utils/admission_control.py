@@ -0,0 +1,79 @@
+﻿from flask import g, jsonify, request
+from services.admission import admission, retry_after_seconds
+
+# 拒絕原因對應的訊息
+REJECTION_MESSAGES = {
+    'concurrency': '同時處理中的請求過多',
+    'requests': '請求過於頻繁',
+    'bytes': '資料傳輸量超過限制'
+}
+
+
+def admit_request(user_id, request_class, request_bytes=0):
+    """對目前請求進行准入判定，拒絕時回傳 429 回應，准入時回傳 None（名額於請求結束時釋放）"""
+    if not admission.enabled or g.get('admission_slot'):
+        return None
+    
+    try:
+        slot_id, reason, retry_after = admission.acquire(user_id, request_class, request_bytes)
+    except Exception as e:
+        # 無法讀寫額度狀態時不阻擋請求
+        print(f"准入控制錯誤: {e}")
+        return None
+    
+    if slot_id is None:
+        seconds = retry_after_seconds(retry_after)
+        response = jsonify({
+            'success': False,
+            'message': f'{REJECTION_MESSAGES[reason]}，請於 {seconds} 秒後重試'
+        })
+        response.status_code = 429
+        response.headers['Retry-After'] = str(seconds)
+        return response
+    
+    g.admission_slot = slot_id
+    g.admission_user = (user_id, request_class)
+    return None
+
+
+def register_admission_control(app):
+    """註冊 API 請求的准入控制
+    
+    上傳請求由上傳藍圖自行判定（用戶ID只在表單中時須先解析表單），其餘 /api 請求以路由參數
+    或 user_id 查詢參數中的用戶ID判定；無法識別用戶的請求不受限制。GET/HEAD 請求計入讀取
+    額度，位元組數以回應大小計算並在回應完成後扣除；其他方法計入寫入額度，位元組數以
+    請求本文大小計算。
+    """
+    
+    @app.before_request
+    def admit_api_request():
+        if not admission.enabled or request.blueprint is None or request.method == 'OPTIONS':
+            return None
+        if request.blueprint == 'upload' and request.method == 'POST':
+            return None
+        
+        user_id = (request.view_args or {}).get('user_id') or request.args.get('user_id')
+        if not user_id:
+            return None
+        if request.method in ('GET', 'HEAD'):
+            return admit_request(user_id, 'read')
+        return admit_request(user_id, 'write', request.content_length or 0)
+    
+    @app.after_request
+    def charge_response_bytes(response):
+        user = g.get('admission_user')
+        if user and user[1] == 'read' and not response.direct_passthrough and not response.is_streamed:
+            try:
+                admission.charge(user[0], user[1], response.calculate_content_length() or 0)
+            except Exception as e:
+                print(f"准入控制錯誤: {e}")
+        return response
+    
+    @app.teardown_request
+    def release_admission_slot(exc):
+        slot_id = g.pop('admission_slot', None)
+        if slot_id:
+            try:
+                admission.release(slot_id)
+            except Exception as e:
+                print(f"准入控制錯誤: {e}")
@@ -0,0 +1,63 @@
+﻿import gzip
+from flask import request
+from config import Config
+
+try:
+    import brotli
+except ImportError:
+    # brotli 為可選依賴，未安裝時只提供 gzip
+    brotli = None
+
+# 會壓縮的回應類型
+COMPRESSIBLE_MIMETYPES = ('application/json',)
+
+
+def _choose_encoding():
+    """依 Accept-Encoding 選擇壓縮格式（brotli 優先），用戶端不接受壓縮時回傳 None"""
+    accept = request.accept_encodings
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding):
+    """以指定格式壓縮回應內容"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=Config.RESPONSE_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=Config.RESPONSE_GZIP_LEVEL, mtime=0)
+
+
+def register_response_compression(app):
+    """註冊 JSON 回應壓縮（超過 RESPONSE_COMPRESSION_MIN_BYTES 的回應以 brotli 或 gzip 壓縮）"""
+    if not Config.RESPONSE_COMPRESSION:
+        return
+    
+    @app.after_request
+    def compress_response(response):
+        # 304 不含內容，但須與完整回應宣告相同的 Vary
+        if response.status_code == 304:
+            response.vary.add('Accept-Encoding')
+            return response
+        
+        if (
+            response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers
+        ):
+            return response
+        
+        response.vary.add('Accept-Encoding')
+        data = response.get_data()
+        if len(data) < Config.RESPONSE_COMPRESSION_MIN_BYTES:
+            return response
+        
+        encoding = _choose_encoding()
+        if encoding is None:
+            return response
+        
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
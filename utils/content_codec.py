@@ -0,0 +1,74 @@
+﻿import zlib
+from config import Config
+
+try:
+    import zstandard
+except ImportError:
+    # zstandard 為可選依賴，未安裝時設定為 zstd 會改用 zlib
+    zstandard = None
+
+# 知識條目中記錄內容壓縮格式的欄位（沒有此欄位表示內容為未壓縮的文字）
+ENCODING_FIELD = 'content_encoding'
+
+CODECS = ('zlib', 'zstd')
+
+
+def resolve_codec(codec=None):
+    """決定實際使用的壓縮格式（未指定時依 CONTENT_COMPRESSION），不壓縮時回傳 None"""
+    codec = (codec or Config.CONTENT_COMPRESSION or 'none').lower()
+    if codec not in CODECS:
+        return None
+    if codec == 'zstd' and zstandard is None:
+        return 'zlib'
+    return codec
+
+
+def compress(data, codec):
+    """以指定格式壓縮位元組"""
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=Config.CONTENT_ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, Config.CONTENT_ZLIB_LEVEL)
+
+
+def encode_content(text, codec=None, min_bytes=None):
+    """壓縮條目內容，回傳 (儲存值, 壓縮格式)
+    
+    內容未達 min_bytes（預設 CONTENT_COMPRESSION_MIN_BYTES）、設定為不壓縮，
+    或壓縮後沒有變小時，回傳 (原文字, None)。
+    """
+    codec = resolve_codec(codec)
+    if codec is None or not isinstance(text, str):
+        return text, None
+    
+    data = text.encode('utf-8')
+    if len(data) < (Config.CONTENT_COMPRESSION_MIN_BYTES if min_bytes is None else min_bytes):
+        return text, None
+    
+    compressed = compress(data, codec)
+    if len(compressed) >= len(data):
+        return text, None
+    return compressed, codec
+
+
+def decode_content(value, encoding):
+    """還原條目內容（encoding 為 None 時原值回傳）"""
+    if not encoding or value is None:
+        return value
+    
+    data = bytes(value)
+    if encoding == 'zlib':
+        return zlib.decompress(data).decode('utf-8')
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("內容以 zstd 壓縮，但未安裝 zstandard")
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    raise ValueError(f"不支援的內容壓縮格式: {encoding}")
+
+
+def stored_size(value):
+    """內容儲存值的位元組數"""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    return len(value)
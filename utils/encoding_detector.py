@@ -0,0 +1,128 @@
+﻿import re
+import codecs
+
+# 以 BOM 判斷的編碼（UTF-32 的 BOM 以 UTF-16 的 BOM 開頭，須先比對）
+BOM_ENCODINGS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16')
+)
+
+# 沒有 BOM 時的候選編碼（依優先順序）；單位元組的 cp1252 幾乎能解碼任何內容，
+# 只在多位元組編碼的錯誤都超過容許範圍時採用
+MULTIBYTE_ENCODINGS = ('utf-8', 'big5', 'gbk')
+FALLBACK_ENCODING = 'cp1252'
+CANDIDATE_ENCODINGS = MULTIBYTE_ENCODINGS + (FALLBACK_ENCODING,)
+
+# 偵測編碼時取樣的位元組數
+SAMPLE_SIZE = 16384
+
+# 雙位元組字元中尾碼位於 0x40-0x7E 的比例：Big5 常用字與全形標點約有四成，
+# GB2312 範圍的常用字則幾乎沒有，以此區分兩者皆可解碼的內容
+BIG5_LOW_TRAIL_RATIO = 0.1
+
+# 解碼時可容忍的錯誤位元組比例（超過時改用下一個候選編碼）
+MAX_ERROR_RATIO = 0.001
+
+_DOUBLE_BYTE_PATTERN = re.compile(rb'[\x81-\xfe](?:([\x40-\x7e])|[\x80-\xfe])')
+
+
+def _count_errors(data, encoding, final):
+    """以 encoding 解碼 data 的錯誤數（final 為 False 時結尾不完整的字元不計）"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    return decoder.decode(data, final=final).count('\ufffd')
+
+
+def _low_trail_ratio(sample):
+    """雙位元組字元中尾碼位於 0x40-0x7E 的比例"""
+    pairs = _DOUBLE_BYTE_PATTERN.findall(sample)
+    if not pairs:
+        return 0.0
+    return (len(pairs) - pairs.count(b'')) / len(pairs)
+
+
+def detect_encoding(sample, complete=False):
+    """由文件開頭的取樣判斷編碼（complete 表示取樣即為整份文件）
+    
+    有 BOM 時直接採用；否則以各多位元組編碼解碼取樣，在錯誤數不超過容許
+    範圍的編碼中選擇錯誤最少者。Big5 與 GBK 錯誤數相同時依尾碼分佈判斷。
+    """
+    sample = bytes(sample[:SAMPLE_SIZE])
+    for bom, encoding in BOM_ENCODINGS:
+        if sample.startswith(bom):
+            return encoding
+    
+    errors = {}
+    for encoding in MULTIBYTE_ENCODINGS:
+        errors[encoding] = _count_errors(sample, encoding, complete)
+        # 純 ASCII 或合法的 UTF-8 不需再嘗試其他編碼
+        if encoding == 'utf-8' and errors[encoding] == 0:
+            return encoding
+    
+    tolerance = int(len(sample) * MAX_ERROR_RATIO)
+    fewest = min(errors.values())
+    if fewest > tolerance:
+        return FALLBACK_ENCODING
+    
+    candidates = [encoding for encoding in MULTIBYTE_ENCODINGS if errors[encoding] == fewest]
+    if 'big5' in candidates and 'gbk' in candidates:
+        return 'big5' if _low_trail_ratio(sample) > BIG5_LOW_TRAIL_RATIO else 'gbk'
+    return candidates[0]
+
+
+def decode(buffer, encoding, chunk_size=1048576, max_errors=None):
+    """以固定大小區塊逐段解碼，回傳 (文字, 錯誤數)
+    
+    無法解碼的位元組以 U+FFFD 取代；錯誤數超過 max_errors 時提前停止並回傳 (None, 錯誤數)。
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    parts = []
+    error_count = 0
+    length = len(buffer)
+    for offset in range(0, length, chunk_size):
+        text = decoder.decode(buffer[offset:offset + chunk_size], final=offset + chunk_size >= length)
+        error_count += text.count('\ufffd')
+        if max_errors is not None and error_count > max_errors:
+            return None, error_count
+        parts.append(text)
+    return ''.join(parts), error_count
+
+
+def _run_start(buffer, position):
+    """position 所在的連續非 ASCII 位元組的起點（其前一個位元組為 ASCII 或雙位元組的尾碼，必為字元邊界）"""
+    start = position
+    while start > 0 and buffer[start - 1] >= 0x80:
+        start -= 1
+    return start
+
+
+def decode_text(buffer, chunk_size=1048576):
+    """偵測編碼並解碼整份文件，回傳 (文字, 編碼)；所有候選編碼都無法解碼時回傳 (None, None)
+    
+    通常只需以偵測到的編碼完整解碼一次。開頭取樣無法判斷（如前 16KB 皆為 ASCII）
+    而之後出現無法解碼的位元組時，先以該處的非 ASCII 內容重新偵測並完整解碼；
+    仍失敗時改以取代模式逐段解碼，錯誤過多（偵測錯誤）時提前停止並依序嘗試其他候選編碼。
+    """
+    detected = detect_encoding(buffer[:SAMPLE_SIZE], complete=len(buffer) <= SAMPLE_SIZE)
+    try:
+        return str(buffer, detected), detected
+    except UnicodeDecodeError as e:
+        error_position = e.start
+    
+    candidates = (detected,)
+    start = _run_start(buffer, error_position)
+    redetected = detect_encoding(buffer[start:start + SAMPLE_SIZE], complete=start + SAMPLE_SIZE >= len(buffer))
+    if redetected != detected:
+        try:
+            return str(buffer, redetected), redetected
+        except UnicodeDecodeError:
+            candidates = (redetected, detected)
+    
+    max_errors = max(1, int(len(buffer) * MAX_ERROR_RATIO))
+    for encoding in candidates + tuple(encoding for encoding in CANDIDATE_ENCODINGS if encoding not in candidates):
+        text, _ = decode(buffer, encoding, chunk_size, max_errors)
+        if text is not None:
+            return text, encoding
+    return None, None
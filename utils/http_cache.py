@@ -0,0 +1,76 @@
+﻿import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from flask import current_app, make_response, request
+from werkzeug.http import http_date
+from services.storage import storage
+
+# 需要用戶端每次向伺服器驗證的回應（以 ETag / Last-Modified 取得 304）
+REVALIDATE = 'private, no-cache'
+
+
+def _validators(user_id):
+    """依用戶資料最後寫入時間計算 (ETag, Last-Modified)，沒有寫入紀錄時回傳 (None, None)
+    
+    統計中的今日與本週上傳數會隨日期改變，因此驗證碼也包含目前的 UTC 日期，
+    Last-Modified 不早於當日零時。ETag 另包含路徑與查詢參數，不同頁面與篩選條件
+    各自驗證；回應可能經過壓縮，因此使用弱 ETag。
+    """
+    last_modified = storage.get_user_last_modified(user_id)
+    if last_modified is None:
+        return None, None
+    
+    today = datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    last_modified = max(last_modified, today)
+    digest = hashlib.sha1(
+        f"{user_id}\n{last_modified.isoformat()}\n{today.date().isoformat()}\n{request.full_path}".encode('utf-8')
+    ).hexdigest()[:20]
+    return digest, last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+
+
+def _not_modified(etag, last_modified):
+    """請求的 If-None-Match / If-Modified-Since 是否表示用戶端的版本仍有效
+    
+    有 If-None-Match 時忽略 If-Modified-Since（RFC 9110）。
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def _set_cache_headers(response, etag, last_modified, cache_control):
+    response.set_etag(etag, weak=True)
+    response.headers['Last-Modified'] = http_date(last_modified)
+    response.headers['Cache-Control'] = cache_control
+
+
+def conditional_get(cache_control=REVALIDATE):
+    """讓用戶資料的讀取 API 支援條件式請求
+    
+    在執行 view 之前由用戶資料最後寫入時間計算驗證碼，用戶端的快取仍有效時
+    直接回傳 304，不讀取列表或計算統計。用戶 ID 取自路由參數或 user_id 查詢參數；
+    沒有用戶 ID 或寫入紀錄時照常執行 view，只有成功的回應附帶驗證碼。
+    view 可以是 async def 視圖。
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            view_function = current_app.ensure_sync(view)
+            user_id = kwargs.get('user_id') or request.args.get('user_id')
+            etag, last_modified = _validators(user_id) if user_id else (None, None)
+            if etag is None:
+                return view_function(*args, **kwargs)
+            
+            if _not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(view_function(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            
+            _set_cache_headers(response, etag, last_modified, cache_control)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,22 @@
+﻿import importlib
+
+class LazyModule:
+    """首次存取屬性時才匯入的模組代理，用於延後載入耗時的第三方函式庫"""
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attribute):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attribute)
+    
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<LazyModule {self._name} ({state})>"
+
+def lazy_import(name):
+    """回傳延後匯入的模組（import 陳述式的執行延至第一次使用）"""
+    return LazyModule(name)
@@ -0,0 +1,34 @@
+﻿import json
+import base64
+from config import Config
+
+def encode_cursor(values):
+    """將分頁位置編碼為不透明的游標字串"""
+    payload = json.dumps(values, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """解碼游標字串，格式錯誤時拋出 ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        raise ValueError('無效的分頁游標')
+    
+    if not isinstance(values, dict):
+        raise ValueError('無效的分頁游標')
+    return values
+
+def decode_offset_cursor(cursor):
+    """解碼以位移量表示的游標（用於排序結果不具穩定鍵值的列表）"""
+    if not cursor:
+        return 0
+    
+    offset = decode_cursor(cursor).get('offset')
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError('無效的分頁游標')
+    return offset
+
+def clamp_page_size(limit):
+    """將每頁筆數限制在 1 到 MAX_PAGE_SIZE 之間"""
+    return max(1, min(int(limit), Config.MAX_PAGE_SIZE))
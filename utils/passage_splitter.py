@@ -0,0 +1,56 @@
+﻿import re
+
+# 段落切分時優先選擇的斷點：換行、中英文句末標點、空白
+_BREAK_PATTERNS = (
+    re.compile(r'\n\s*'),
+    re.compile(r'[。！？!?；;]\s*|\.\s+'),
+    re.compile(r'[，,、：:]\s*|\s+')
+)
+
+
+def _find_break(text, start, end, last=True):
+    """在 text[start:end] 中尋找最後（last 為 False 時為第一個）斷點，回傳斷點後的位置
+    
+    依斷點優先順序尋找，找不到任何斷點時回傳 None。
+    """
+    for pattern in _BREAK_PATTERNS:
+        found = None
+        for match in pattern.finditer(text, start, end):
+            if match.end() >= end:
+                continue
+            found = match.end()
+            if not last:
+                break
+        if found is not None and found > start:
+            return found
+    return None
+
+
+def split_passages(text, size=500, overlap=100):
+    """將文字切分為彼此重疊的段落，回傳 [(起始位置, 結束位置)]
+    
+    每段最多 size 個字元，相鄰段落重疊約 overlap 個字元；段落結尾盡量落在
+    換行、句末標點或空白上（只在段落後 40% 的範圍內尋找），避免切斷句子。
+    """
+    if not text:
+        return []
+    
+    length = len(text)
+    overlap = min(overlap, size // 2)
+    spans = []
+    start = 0
+    while start < length:
+        end = min(start + size, length)
+        if end < length:
+            end = _find_break(text, start + int(size * 0.6), end + 1) or end
+        
+        # 略過只有空白的段落
+        if text[start:end].strip():
+            spans.append((start, end))
+        if end >= length:
+            break
+        
+        # 下一段從重疊範圍內的斷點開始，避免從字詞中間開始
+        next_start = max(end - overlap, start + 1)
+        start = _find_break(text, next_start, end, last=False) or next_start
+    return spans
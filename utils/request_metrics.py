@@ -0,0 +1,39 @@
+﻿import time
+from flask import Response, g, request
+from services.metrics import metrics
+from services.storage import storage
+
+def register_request_metrics(app):
+    """註冊請求計時與儲存後端用量的記錄，並提供 Prometheus 格式的 /metrics 端點"""
+    
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        storage.reset_read_count()
+    
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.pop('request_start', None)
+        if start is None:
+            return response
+        
+        # 以路由規則作為標籤（如 /api/knowledge/<user_id>），避免每個用戶產生不同的時間序列
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        elapsed = time.perf_counter() - start
+        usage = storage.get_usage()
+        
+        metrics.inc('http_requests_total', {'method': request.method, 'route': route, 'status': str(response.status_code)})
+        metrics.observe('http_request_duration_seconds', elapsed, {'method': request.method, 'route': route})
+        metrics.observe('http_request_storage_reads', usage['reads'], {'route': route})
+        if usage['reads']:
+            metrics.inc('storage_documents_read_total', {'route': route}, usage['reads'])
+        if usage['writes']:
+            metrics.inc('storage_documents_written_total', {'route': route}, usage['writes'])
+        if usage['round_trips']:
+            metrics.inc('storage_round_trips_total', {'route': route}, usage['round_trips'])
+        metrics.flush()
+        return response
+    
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
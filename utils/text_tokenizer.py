@@ -0,0 +1,112 @@
+﻿import re
+import heapq
+from bisect import bisect_left
+
+# CJK 統一表意文字、擴展 A、相容表意文字、日文假名與韓文音節
+_CJK_RANGES = (
+    '぀-ヿ'
+    '㐀-䶿'
+    '一-鿿'
+    '가-힯'
+    '豈-﫿'
+)
+
+_TOKEN_PATTERN = re.compile(rf'([{_CJK_RANGES}]+)|([^\W_{_CJK_RANGES}]+)', re.UNICODE)
+_CJK_PATTERN = re.compile(rf'[{_CJK_RANGES}]+')
+
+# 以前綴比對的拉丁字母與數字查詢詞彙的最短長度（較短的詞彙只比對完全相同的詞彙）
+PREFIX_MIN_CHARS = 3
+
+# 單一查詢詞彙最多展開的索引詞彙數（常用字的二元組可達上千個，超過時保留出現於最多文件的詞彙）
+MAX_EXPANSIONS = 1024
+
+
+def tokenize(text):
+    """將文字切分為索引詞彙
+    
+    CJK 連續字元切成二元組 (bigram)，單一 CJK 字元保留為單字詞；
+    拉丁字母與數字以單字為單位並轉為小寫。回傳依出現順序排列的詞彙列表，
+    列表索引即為該詞彙的位置。
+    """
+    if not text:
+        return []
+    
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(text):
+        cjk_run, word = match.groups()
+        if cjk_run:
+            if len(cjk_run) == 1:
+                tokens.append(cjk_run)
+            else:
+                tokens.extend(cjk_run[i:i + 2] for i in range(len(cjk_run) - 1))
+        else:
+            tokens.append(word.lower())
+    return tokens
+
+
+class TermLookup:
+    """索引詞彙的排序清單，供查詢時展開無法直接比對的查詢詞彙
+    
+    CJK 文字以二元組索引，位於連續字元中的單一字元不會成為詞彙；拉丁字母以完整
+    單字索引，不能比對單字的開頭。查詢時單一 CJK 字元展開為以該字元開頭或結尾的
+    二元組，拉丁字母與數字展開為以其為前綴的詞彙。
+    
+    新詞彙先放入待合併集合，累積到一定數量才併入排序清單，避免逐筆插入；
+    已不存在於索引的詞彙不會移除，由呼叫端過濾並在重建索引時清除。
+    """
+    
+    def __init__(self, terms=()):
+        self._sorted = []
+        self._reversed = []
+        self._known = set()
+        self._pending = set(terms)
+    
+    def add(self, term):
+        """加入新詞彙"""
+        if term not in self._known:
+            self._pending.add(term)
+    
+    def _merge(self):
+        """將待合併的詞彙依序併入排序清單（線性合併，不重新排序既有詞彙）"""
+        new_terms = sorted(self._pending)
+        self._sorted = list(heapq.merge(self._sorted, new_terms))
+        self._reversed = list(heapq.merge(self._reversed, sorted(
+            term[::-1] for term in new_terms if len(term) == 2 and _CJK_PATTERN.fullmatch(term)
+        )))
+        self._known.update(new_terms)
+        self._pending = set()
+    
+    @staticmethod
+    def _with_prefix(terms, prefix):
+        start = bisect_left(terms, prefix)
+        matches = []
+        for term in terms[start:]:
+            if not term.startswith(prefix):
+                break
+            matches.append(term)
+        return matches
+    
+    def expand(self, token, frequency=None):
+        """回傳查詢詞彙對應的索引詞彙（可能包含已不在索引中的詞彙）
+        
+        最多回傳 MAX_EXPANSIONS 個詞彙，查詢詞彙本身總是在內。超過時以 frequency(詞彙)
+        （詞彙出現的文件數）由高到低保留，已不在索引中的詞彙最先捨棄；未指定
+        frequency 時保留排序在前的詞彙。
+        """
+        is_cjk_char = len(token) == 1 and _CJK_PATTERN.fullmatch(token)
+        if not is_cjk_char and len(token) < PREFIX_MIN_CHARS:
+            return [token]
+        
+        if len(self._pending) > 1024:
+            self._merge()
+        
+        terms = self._with_prefix(self._sorted, token)
+        terms.extend(sorted(term for term in self._pending if term.startswith(token)))
+        if is_cjk_char:
+            terms.extend(term[::-1] for term in self._with_prefix(self._reversed, token))
+            terms.extend(sorted(term for term in self._pending if len(term) == 2 and term.endswith(token)))
+        
+        terms = list(dict.fromkeys([token] + terms))
+        if len(terms) > MAX_EXPANSIONS and frequency is not None:
+            terms = [token] + heapq.nlargest(MAX_EXPANSIONS - 1, terms[1:], key=frequency)
+        return terms[:MAX_EXPANSIONS]
@@ -0,0 +1,20 @@
+﻿from datetime import datetime, timezone
+
+def to_utc_naive(value):
+    """將上傳日期（datetime 或 ISO 字串）統一轉為不含時區的 UTC 時間，無法解析時回傳 None"""
+    if not value:
+        return None
+    
+    if isinstance(value, str):
+        # 如果是字串，嘗試解析
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    
+    if not isinstance(value, datetime):
+        return None
+    
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
@@ -0,0 +1,90 @@
+﻿import os
+import shutil
+import tempfile
+from flask import Request
+from config import Config
+
+class SpoolFile:
+    """上傳文件暫存檔
+    
+    以固定大小區塊寫入具名暫存檔，超過大小上限後停止寫入並標記為超出限制，
+    使超大文件不會佔用記憶體或磁碟空間。暫存檔在關閉時自動刪除。
+    """
+    
+    def __init__(self, max_size, spool_dir=None):
+        self.max_size = max_size
+        self.size = 0
+        self.exceeded = False
+        self.content_hash = None
+        self._file = tempfile.NamedTemporaryFile(prefix='upload-', dir=spool_dir)
+    
+    @property
+    def path(self):
+        return self._file.name
+    
+    def write(self, data):
+        if self.exceeded:
+            return len(data)
+        
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            # 超出上限：捨棄已寫入的內容，後續資料直接丟棄
+            self.exceeded = True
+            self._file.truncate(0)
+            return len(data)
+        
+        return self._file.write(data)
+    
+    def __getattr__(self, name):
+        if name == '_file':
+            raise AttributeError(name)
+        return getattr(self._file, name)
+    
+    def __iter__(self):
+        return iter(self._file)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+class SpoolingRequest(Request):
+    """將 multipart 上傳文件直接串流至大小受限暫存檔的請求類別"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpoolFile(Config.MAX_FILE_SIZE, Config.UPLOAD_SPOOL_DIR)
+
+def spool_upload(file_storage, max_size=None, chunk_size=None):
+    """取得上傳文件的暫存檔
+    
+    SpoolingRequest 解析的文件直接回傳其暫存檔；其他來源則以固定大小區塊
+    複製到暫存檔，並在超過大小上限時提早停止讀取。
+    """
+    stream = file_storage.stream
+    if isinstance(stream, SpoolFile):
+        stream.flush()
+        return stream
+    
+    spool = SpoolFile(max_size or Config.MAX_FILE_SIZE, Config.UPLOAD_SPOOL_DIR)
+    chunk_size = chunk_size or Config.UPLOAD_CHUNK_SIZE
+    while not spool.exceeded:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        spool.write(chunk)
+    spool.flush()
+    return spool
+
+
+def persist_spool(spool, path):
+    """將暫存檔保存至指定路徑（暫存檔關閉後仍保留）
+    
+    同一檔案系統時以硬連結保存，避免複製文件內容；否則複製檔案。
+    """
+    spool.flush()
+    try:
+        os.link(spool.path, path)
+    except OSError:
+        shutil.copyfile(spool.path, path)
+    return path
\ No newline at end of file